@@ -0,0 +1,313 @@
+import gc
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+from datetime import datetime
+from datetime import timezone
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+import typer
+from benchmarks.schemas import array_heavy_struct
+from benchmarks.schemas import deep_struct
+from benchmarks.schemas import table_metadata
+from benchmarks.schemas import wide_struct
+from flatten.aws import GlueTable
+from flatten.aws import ToFlatParquet
+from flatten.hive_parser import HiveParser
+from flatten.hive_parser import serialize_type
+from flatten.utils import flatten_dict
+from flatten.utils import slugify_key
+from flatten.utils import slugify_segment
+
+RESULTS_VERSION = 1
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Differences below this many seconds are noise, whatever the ratio
+MIN_SECONDS = 0.001
+
+
+class Case(NamedTuple):
+    function: str
+    schema: str
+    # Builds the input of run, not measured
+    setup: Callable[[], Any]
+    run: Callable[[Any], Any]
+    # Clear the type, mapping and name caches before every run, the query_gen cases
+    # keep the mapping of their setup warm
+    cold: bool = True
+
+    @property
+    def name(self) -> str:
+        return f"{self.function}/{self.schema}"
+
+
+def schemas(quick=False) -> Dict[str, str]:
+    """
+    :param quick: Small schemas for a fast smoke run
+    :return: Synthetic hive types by name
+    """
+    if quick:
+        return {
+            "wide_1k": wide_struct(1000),
+            "deep_32": deep_struct(32),
+            "arrays_100": array_heavy_struct(100),
+        }
+    return {
+        "wide_10k": wide_struct(10_000),
+        "wide_100k": wide_struct(100_000),
+        "deep_32": deep_struct(32),
+        "deep_128": deep_struct(128),
+        "arrays_1k": array_heavy_struct(1000),
+    }
+
+
+def pretty_schemas(quick=False) -> Dict[str, str]:
+    """
+    :return: Hive types the formatted SQL is rendered for, smaller than schemas()
+        because formatting with sqlparse takes much longer than building the SQL
+    """
+    if quick:
+        return {"wide_200": wide_struct(200), "deep_32": deep_struct(32)}
+    return {
+        "wide_1k": wide_struct(1000),
+        "deep_32": deep_struct(32),
+        "arrays_200": array_heavy_struct(200),
+    }
+
+
+def _source_table(hive_type: str, version="1") -> GlueTable:
+    return GlueTable(
+        "bench",
+        "source",
+        metadata=table_metadata(
+            [("id", "string"), ("payload", hive_type)], version=version
+        ),
+    )
+
+
+def _flat_table(hive_type: str, version: str) -> ToFlatParquet:
+    """
+    :param version: Version of the source table, the mappings of the schemas are
+        cached under their own versions
+    """
+    flat_table = ToFlatParquet(
+        database="bench",
+        source_table=_source_table(hive_type, version),
+        target_table=GlueTable("bench", "flat", metadata=table_metadata([])),
+        target_table_location="s3://bench/flat/",
+        workgroup="primary",
+        s3_staging_dir="s3://bench/staging/",
+    )
+    # The mapping is computed in setup, only the rendering is measured
+    flat_table.source_table.flat_mapping()
+    return flat_table
+
+
+def cases(quick=False) -> List[Case]:
+    parser = HiveParser()
+    lark_parser = HiveParser(fast_path=False)
+    result = []
+    for name, hive_type in schemas(quick).items():
+        result += [
+            Case("parse", name, lambda t=hive_type: t, parser),
+            Case("parse_lark", name, lambda t=hive_type: t, lark_parser),
+            Case(
+                "flatten_dict",
+                name,
+                lambda t=hive_type: parser(t),
+                flatten_dict,
+            ),
+            Case(
+                "flat_mapping",
+                name,
+                lambda t=hive_type: _source_table(t),
+                lambda table: table.flat_mapping(),
+            ),
+            Case(
+                "serialize_type",
+                name,
+                lambda t=hive_type: parser(t),
+                serialize_type,
+            ),
+            Case(
+                "query_gen",
+                name,
+                lambda t=hive_type, n=name: _flat_table(t, n),
+                lambda flat_table: flat_table.generate_insert_overwrite_query(
+                    GlueTable("bench", "tmp"), "s3://bench/flat/"
+                ),
+                cold=False,
+            ),
+        ]
+    for name, hive_type in pretty_schemas(quick).items():
+        result.append(
+            Case(
+                "query_gen_pretty",
+                name,
+                lambda t=hive_type, n=name: _flat_table(t, n),
+                lambda flat_table: flat_table.generate_insert_overwrite_query(
+                    GlueTable("bench", "tmp"), "s3://bench/flat/", pretty=True
+                ),
+                cold=False,
+            )
+        )
+    return result
+
+
+def reset_caches() -> None:
+    """
+    Runs of cold cases start without parsed types, mappings or slugified names
+    """
+    GlueTable.type_cache.clear()
+    GlueTable.mapping_cache.clear()
+    slugify_key.cache_clear()
+    slugify_segment.cache_clear()
+
+
+def measure(case: Case, repeat=5, budget=10.0) -> Dict:
+    """
+    Measures the peak memory of one traced run, then times up to repeat runs,
+    fewer if they take longer than budget seconds together
+    """
+    argument = case.setup()
+    if case.cold:
+        reset_caches()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        case.run(argument)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    times = []
+    while len(times) < repeat and (not times or sum(times) < budget):
+        if case.cold:
+            reset_caches()
+        gc.collect()
+        start = time.perf_counter()
+        case.run(argument)
+        times.append(time.perf_counter() - start)
+    return {
+        "function": case.function,
+        "schema": case.schema,
+        "runs": len(times),
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "peak_bytes": peak,
+    }
+
+
+def run_benchmarks(
+    quick=False, repeat=5, budget=10.0, only: Optional[List[str]] = None
+) -> Dict:
+    """
+    :param only: Functions to benchmark, all if empty
+    :return: Results keyed by function/schema
+    """
+    results = {}
+    for case in cases(quick):
+        if only and case.function not in only:
+            continue
+        results[case.name] = measure(case, repeat=repeat, budget=budget)
+        typer.echo(
+            f"{case.name:32} {results[case.name]['median_s']:10.4f} s "
+            f"{results[case.name]['peak_bytes'] / 1024 ** 2:10.1f} MiB"
+        )
+    return {
+        "version": RESULTS_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": quick,
+        "results": results,
+    }
+
+
+def compare(results: Dict, baseline: Dict, threshold=0.25) -> List[str]:
+    """
+    :param threshold: Allowed relative increase of the median time and the peak memory
+    :return: Descriptions of the regressions of the results against the baseline,
+        benchmarks missing in either are ignored
+    """
+    regressions = []
+    for name, result in sorted(results["results"].items()):
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        limit = base["median_s"] * (1 + threshold)
+        if result["median_s"] > limit and (
+            result["median_s"] - base["median_s"] > MIN_SECONDS
+        ):
+            regressions.append(
+                f"{name}: {result['median_s']:.4f} s, "
+                f"{result['median_s'] / base['median_s']:.2f}x the baseline "
+                f"{base['median_s']:.4f} s"
+            )
+        if result["peak_bytes"] > base["peak_bytes"] * (1 + threshold):
+            regressions.append(
+                f"{name}: {result['peak_bytes']} bytes peak memory, "
+                f"{result['peak_bytes'] / base['peak_bytes']:.2f}x the baseline "
+                f"{base['peak_bytes']} bytes"
+            )
+    return regressions
+
+
+def main(
+    output: str = typer.Option(
+        "benchmark.json", help="Path of the machine readable results"
+    ),
+    baseline: str = typer.Option(
+        BASELINE, help="Results the run is compared with, skipped if missing"
+    ),
+    threshold: float = typer.Option(
+        0.25, help="Allowed relative increase of time and memory over the baseline"
+    ),
+    update_baseline: bool = typer.Option(
+        False, help="Store the results as the new baseline"
+    ),
+    quick: bool = typer.Option(False, help="Small schemas for a fast smoke run"),
+    repeat: int = typer.Option(5, help="Maximum number of timed runs per benchmark"),
+    budget: float = typer.Option(
+        10.0, help="Seconds after which a benchmark stops repeating"
+    ),
+    only: List[str] = typer.Option(
+        [], help='Benchmark only this function, e.g. "parse", can be repeated'
+    ),
+):
+    """
+    Times and measures the memory of the schema and SQL generation hot paths on
+    synthetic wide, deep and array heavy types
+    """
+    results = run_benchmarks(quick=quick, repeat=repeat, budget=budget, only=only)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    typer.echo(f"Wrote the results to {output}.")
+    if update_baseline:
+        with open(baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        typer.echo(f"Stored the results as baseline {baseline}.")
+        return
+    if not os.path.exists(baseline):
+        return
+    with open(baseline) as f:
+        stored = json.load(f)
+    if stored.get("quick") != quick:
+        typer.echo("The baseline was measured with other schema sizes, not comparing.")
+        return
+    regressions = compare(results, stored, threshold)
+    for regression in regressions:
+        typer.echo(f"Regression {regression}", err=True)
+    if regressions:
+        raise typer.Exit(1)
+    typer.echo(f"No regressions over {threshold:.0%} against {baseline}.")
+
+
+if __name__ == "__main__":
+    typer.run(main)
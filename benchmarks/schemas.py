@@ -0,0 +1,91 @@
+import random
+from typing import List
+
+PRIMITIVES = (
+    "string",
+    "bigint",
+    "int",
+    "double",
+    "boolean",
+    "timestamp",
+    "date",
+    "decimal(12,2)",
+    "varchar(64)",
+)
+
+
+def _primitive(rng: random.Random) -> str:
+    return rng.choice(PRIMITIVES)
+
+
+def wide_struct(leaves: int, fanout=100, seed=0) -> str:
+    """
+    :param leaves: Number of primitive fields
+    :param fanout: Fields per struct, groups of fanout leaves are nested in
+        structs of fanout groups until a single struct is left
+    :return: Hive type of a struct with the given number of leaves
+    """
+    rng = random.Random(seed)
+    fields = [f"field_{i}:{_primitive(rng)}" for i in range(leaves)]
+    level = 0
+    while len(fields) > fanout:
+        fields = [
+            f"group_{level}_{i // fanout}:struct<{','.join(fields[i : i + fanout])}>"
+            for i in range(0, len(fields), fanout)
+        ]
+        level += 1
+    return f"struct<{','.join(fields)}>"
+
+
+def deep_struct(depth: int, siblings=3, seed=0) -> str:
+    """
+    :param depth: Nesting depth of the innermost struct
+    :param siblings: Primitive fields next to the nested struct on every level
+    """
+    rng = random.Random(seed)
+    inner = ",".join(f"leaf_{i}:{_primitive(rng)}" for i in range(siblings))
+    for level in reversed(range(depth)):
+        fields = [f"value_{level}_{i}:{_primitive(rng)}" for i in range(siblings)]
+        inner = f"{','.join(fields)},level_{level + 1}:struct<{inner}>"
+    return f"struct<{inner}>"
+
+
+def array_heavy_struct(arrays: int, seed=0) -> str:
+    """
+    :param arrays: Number of array fields, of primitives, of structs and nested arrays
+    """
+    rng = random.Random(seed)
+    fields = []
+    for i in range(arrays):
+        kind = i % 3
+        if kind == 0:
+            element = _primitive(rng)
+        elif kind == 1:
+            element = (
+                "struct<"
+                + ",".join(f"item_{j}:{_primitive(rng)}" for j in range(5))
+                + f",tags:array<{_primitive(rng)}>>"
+            )
+        else:
+            element = f"array<struct<x:{_primitive(rng)},y:array<{_primitive(rng)}>>>"
+        fields.append(f"list_{i}:array<{element}>")
+        fields.append(f"scalar_{i}:{_primitive(rng)}")
+    return f"struct<{','.join(fields)}>"
+
+
+def table_metadata(columns: List[tuple], version="1") -> dict:
+    """
+    :param columns: (name, hive type)
+    :return: Glue metadata of a table with the columns, partitioned by dt
+    """
+    return {
+        "Name": "source",
+        "DatabaseName": "bench",
+        "VersionId": version,
+        "StorageDescriptor": {
+            "Columns": [{"Name": name, "Type": type_} for name, type_ in columns],
+            "Location": "s3://bench/source/",
+        },
+        "PartitionKeys": [{"Name": "dt", "Type": "string"}],
+        "Parameters": {},
+    }
@@ -0,0 +1,561 @@
+import multiprocessing
+import os
+import re
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+from urllib.parse import quote
+
+from flatten import aws
+from flatten.aws import GlueTable
+from flatten.aws import HIVE_NULL_PARTITION
+from flatten.aws import RUN_FINGERPRINT_PARAMETER
+from flatten.aws import splitted_s3_key
+from flatten.aws import ToFlatParquet
+from flatten.backend import current_backend
+from flatten.tracing import annotate
+from flatten.tracing import span
+from flatten.tracing import traced
+from lark import Tree
+from loguru import logger
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.fs as pafs
+    import pyarrow.json as pajson
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = None
+
+# Rows per record batch, the memory of a worker is bounded by a few batches
+BATCH_SIZE = 64 * 1024
+# Bytes of newline delimited JSON parsed at once, must hold the longest line
+JSON_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def require_pyarrow() -> None:
+    if pa is None:
+        raise ValueError(
+            "The arrow engine requires pyarrow, install flatten-athena-table[arrow]"
+        )
+
+
+def arrow_type(parsed) -> "pa.DataType":
+    """
+    :param parsed: Hive type parsed by HiveParser
+    :return: The arrow type Athena reads the hive type from in parquet files
+    """
+    if isinstance(parsed, dict):
+        return pa.struct([(name, arrow_type(type_)) for name, type_ in parsed.items()])
+    if isinstance(parsed, list):
+        return pa.list_(arrow_type(parsed[0]))
+    if isinstance(parsed, Tree):
+        return pa.map_(arrow_type(parsed.children[-2]), arrow_type(parsed.children[-1]))
+    name = parsed.strip().lower()
+    decimal = re.match(r"decimal\s*\(\s*(\d+)\s*,\s*(\d+)\s*\)", name)
+    if decimal:
+        return pa.decimal128(int(decimal.group(1)), int(decimal.group(2)))
+    return {
+        "tinyint": pa.int8(),
+        "smallint": pa.int16(),
+        "int": pa.int32(),
+        "integer": pa.int32(),
+        "bigint": pa.int64(),
+        "float": pa.float32(),
+        "double": pa.float64(),
+        "boolean": pa.bool_(),
+        "date": pa.date32(),
+        "timestamp": pa.timestamp("ms"),
+        "binary": pa.binary(),
+        "decimal": pa.decimal128(10, 0),
+    }.get(re.sub(r"\s*\(.*", "", name), pa.string())
+
+
+def arrow_schema(columns: List[tuple]) -> "pa.Schema":
+    """
+    :param columns: (name, hive type), e.g. ToFlatParquet.target_columns()
+    :return: Schema of parquet files matching the columns
+    """
+    return pa.schema(
+        [(name, arrow_type(GlueTable.hive_parser(type_))) for name, type_ in columns]
+    )
+
+
+def source_path(source_name: str) -> Tuple[str, ...]:
+    """
+    :param source_name: Source expression of a flat column, e.g. '"concert"."venue"'
+    :return: Column and field names, e.g. ("concert", "venue")
+    """
+    return tuple(part.strip('"') for part in source_name.split('"."'))
+
+
+class ColumnSpec(NamedTuple):
+    name: str
+    # Column and struct fields the values are taken from
+    path: Tuple[str, ...]
+    # Source partition key filling the column with the value of the file's partition
+    partition: Optional[str]
+    type: Any
+
+
+class FileTask(NamedTuple):
+    filesystem: Any
+    path: str
+    format: str
+    source_schema: Any
+    partition_values: Dict[str, str]
+    columns: List[ColumnSpec]
+    partition_columns: List[ColumnSpec]
+    output_filesystem: Any
+    output_path: str
+    file_name: str
+    compression: str
+    batch_size: int
+
+
+class FileResult(NamedTuple):
+    source: str
+    rows: int
+    # (partition values, directory relative to the output path, rows) per written file
+    files: List[Tuple[Tuple[str, ...], str, int]]
+
+
+class ArrowRun(NamedTuple):
+    source_files: int
+    files: int
+    rows: int
+
+
+def read_batches(task: FileTask) -> Iterator["pa.RecordBatch"]:
+    """
+    Streams the top level columns of task.source_schema from a parquet or
+    newline delimited JSON file in batches of at most task.batch_size rows
+    """
+    if task.format == "parquet":
+        with task.filesystem.open_input_file(task.path) as f:
+            parquet = pq.ParquetFile(f)
+            # Hive column names are case insensitive
+            names = {name.lower(): name for name in parquet.schema_arrow.names}
+            columns = [
+                names[field.name.lower()]
+                for field in task.source_schema
+                if field.name.lower() in names
+            ]
+            yield from parquet.iter_batches(
+                batch_size=task.batch_size, columns=columns, use_threads=False
+            )
+        return
+    # The input stream decompresses .gz, .bz2 and .zst files
+    with task.filesystem.open_input_stream(task.path) as f:
+        reader = pajson.open_json(
+            f,
+            read_options=pajson.ReadOptions(
+                use_threads=False, block_size=JSON_BLOCK_SIZE
+            ),
+            parse_options=pajson.ParseOptions(
+                explicit_schema=task.source_schema,
+                unexpected_field_behavior="ignore",
+            ),
+        )
+        for batch in reader:
+            for offset in range(0, batch.num_rows, task.batch_size):
+                yield batch.slice(offset, task.batch_size)
+
+
+def _field(array: "pa.Array", name: str) -> Optional["pa.Array"]:
+    """
+    :return: Field of a struct array, null where the struct is null
+    """
+    struct = array.type
+    index = struct.get_field_index(name)
+    if index < 0:
+        names = [struct.field(i).name.lower() for i in range(struct.num_fields)]
+        index = names.index(name.lower()) if name.lower() in names else -1
+    return pc.struct_field(array, [index]) if index >= 0 else None
+
+
+def extract(
+    columns: Dict[str, "pa.Array"],
+    num_rows: int,
+    spec: ColumnSpec,
+    partition_values: Dict[str, str],
+) -> "pa.Array":
+    """
+    Vectorized values of a flat column, fields missing in a file are null
+    :param columns: Top level columns of a batch by lower case name
+    """
+    if spec.partition is not None:
+        value = partition_values.get(spec.partition)
+        value = None if value == HIVE_NULL_PARTITION else value
+        return pa.repeat(pa.scalar(value, pa.string()), num_rows).cast(spec.type)
+    array = columns.get(spec.path[0].lower())
+    for name in spec.path[1:]:
+        if array is None or not pa.types.is_struct(array.type):
+            return pa.nulls(num_rows, spec.type)
+        array = _field(array, name)
+    if array is None:
+        return pa.nulls(num_rows, spec.type)
+    return array if array.type == spec.type else array.cast(spec.type)
+
+
+def partition_value(value) -> str:
+    """
+    :return: The hive partition value of a python value
+    """
+    if value is None:
+        return HIVE_NULL_PARTITION
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value)
+
+
+def split_partitions(
+    batch: "pa.RecordBatch", keys: List["pa.Array"]
+) -> Iterator[Tuple[Tuple[str, ...], "pa.RecordBatch"]]:
+    """
+    :param keys: Values of the partition columns of the rows of the batch
+    :return: The rows of every partition of the batch
+    """
+    names = [f"k{i}" for i in range(len(keys))]
+    distinct = pa.table(keys, names=names).group_by(names).aggregate([])
+    for row in distinct.to_pylist():
+        mask = None
+        for key, name in zip(keys, names):
+            value = row[name]
+            match = (
+                pc.is_null(key)
+                if value is None
+                else pc.fill_null(pc.equal(key, value), False)
+            )
+            mask = match if mask is None else pc.and_(mask, match)
+        yield tuple(partition_value(row[name]) for name in names), batch.filter(mask)
+
+
+def partition_directory(keys: List[str], values: Tuple[str, ...]) -> str:
+    return "".join(
+        f"{key}={quote(value, safe='')}/" for key, value in zip(keys, values)
+    )
+
+
+def flatten_file(task: FileTask) -> FileResult:
+    """
+    Flattens one source file into one parquet file per target partition, batch
+    by batch. Runs in the worker processes of ArrowFlattener.
+    """
+    schema = pa.schema([(spec.name, spec.type) for spec in task.columns])
+    partition_keys = [spec.name for spec in task.partition_columns]
+    # Partitions of the target that are partitions of the source hold the whole file
+    constant = all(spec.partition is not None for spec in task.partition_columns)
+    writers = {}
+    rows = 0
+    try:
+        for batch in read_batches(task):
+            columns = {
+                name.lower(): batch.column(i)
+                for i, name in enumerate(batch.schema.names)
+            }
+            flat = pa.RecordBatch.from_arrays(
+                [
+                    extract(columns, batch.num_rows, spec, task.partition_values)
+                    for spec in task.columns
+                ],
+                schema=schema,
+            )
+            if constant:
+                groups = [
+                    (
+                        tuple(
+                            task.partition_values.get(spec.partition, "")
+                            for spec in task.partition_columns
+                        ),
+                        flat,
+                    )
+                ]
+            else:
+                groups = split_partitions(
+                    flat,
+                    [
+                        extract(columns, batch.num_rows, spec, task.partition_values)
+                        for spec in task.partition_columns
+                    ],
+                )
+            for values, part in groups:
+                if not part.num_rows:
+                    continue
+                if values not in writers:
+                    directory = partition_directory(partition_keys, values)
+                    path = f"{task.output_path}/{directory}{task.file_name}"
+                    if isinstance(task.output_filesystem, pafs.LocalFileSystem):
+                        task.output_filesystem.create_dir(
+                            path.rsplit("/", 1)[0], recursive=True
+                        )
+                    stream = task.output_filesystem.open_output_stream(path)
+                    writer = pq.ParquetWriter(
+                        stream, schema, compression=task.compression
+                    )
+                    writers[values] = [writer, stream, directory, 0]
+                writers[values][0].write_batch(part)
+                writers[values][3] += part.num_rows
+                rows += part.num_rows
+    finally:
+        for writer, stream, _, _ in writers.values():
+            writer.close()
+            stream.close()
+    return FileResult(
+        task.path,
+        rows,
+        [
+            (values, directory, count)
+            for values, (_, _, directory, count) in writers.items()
+        ],
+    )
+
+
+class ArrowFlattener:
+    """
+    Full refresh of a flat table without Athena: the files of the source table are
+    read with pyarrow, the struct fields of the flat mapping are extracted batch by
+    batch and written as parquet to the target location. Every source file is
+    flattened by one worker process, so memory is bounded by the batch size and
+    the number of processes, not by the size of the table.
+    The target table is refreshed, registered and fingerprinted like by
+    ToFlatParquet.insert_overwrite, afterwards both engines can be used.
+    """
+
+    def __init__(
+        self, flat_table: ToFlatParquet, batch_size=BATCH_SIZE, processes=None
+    ) -> None:
+        """
+        :param flat_table: Source, target and output options of the run
+        :param batch_size: Rows per record batch
+        :param processes: Number of worker processes, defaults to the number of CPUs,
+            1 flattens in the current process
+        """
+        require_pyarrow()
+        self.flat_table = flat_table
+        self.batch_size = batch_size
+        self.processes = processes or os.cpu_count() or 1
+
+    def validate(self) -> None:
+        output = self.flat_table.output
+        if output.format != "parquet":
+            raise ValueError("The arrow engine only writes parquet")
+        if output.bucketed_by:
+            raise ValueError("The arrow engine can't bucket the flat table")
+
+    def source_format(self) -> str:
+        metadata = self.flat_table.source_table.metadata
+        serde = metadata["StorageDescriptor"].get("SerdeInfo", {})
+        library = serde.get("SerializationLibrary", "").lower()
+        if "parquet" in library:
+            return "parquet"
+        if "json" in library:
+            return "json"
+        raise ValueError(
+            f"The arrow engine can't read {self.flat_table.source_table.full_name} "
+            f"with the serde {library}"
+        )
+
+    def column_specs(self) -> Tuple[List[ColumnSpec], List[ColumnSpec]]:
+        """
+        :return: Specs of the columns and the partition columns of the flat table
+        """
+        source_keys = {
+            name.lower() for name, _ in self.flat_table.source_table.partition_keys()
+        }
+
+        def spec(source, name, type_):
+            path = source_path(source)
+            partition = (
+                path[0].lower()
+                if len(path) == 1 and path[0].lower() in source_keys
+                else None
+            )
+            return ColumnSpec(
+                name, path, partition, arrow_type(GlueTable.hive_parser(type_))
+            )
+
+        columns, partitions = self.flat_table._target_layout()
+        return [spec(*column) for column in columns], [
+            spec(*column) for column in partitions
+        ]
+
+    def source_schema(self, columns: List[ColumnSpec]) -> "pa.Schema":
+        """
+        :return: Schema of the top level source columns read from the files
+        """
+        read = {spec.path[0].lower() for spec in columns if spec.partition is None}
+        return arrow_schema(
+            [
+                (name, type_)
+                for name, type_ in self.flat_table.source_table.columns()
+                if name.lower() in read
+            ]
+        )
+
+    def source_files(self) -> List[Tuple[str, Dict[str, str]]]:
+        """
+        :return: s3 urls of the files Athena reads and the values of their partitions
+        """
+        source_table = self.flat_table.source_table
+        keys = [name.lower() for name, _ in source_table.partition_keys()]
+        if keys:
+            locations = [
+                (
+                    partition["StorageDescriptor"]["Location"],
+                    dict(zip(keys, partition["Values"])),
+                )
+                for partition in source_table.partitions()
+            ]
+        else:
+            locations = [(source_table.location(), {})]
+        paginator = aws.s3_client.get_paginator("list_objects_v2")
+        files = []
+        for location, values in locations:
+            s3_url_parts = splitted_s3_key(location)
+            prefix = s3_url_parts["path"]
+            if prefix and not prefix.endswith("/"):
+                prefix += "/"
+            files.extend(
+                (f"s3://{s3_url_parts['bucket']}/{obj['Key']}", values)
+                for page in paginator.paginate(
+                    Bucket=s3_url_parts["bucket"], Prefix=prefix
+                )
+                for obj in page.get("Contents", [])
+                # Athena skips folder markers and files starting with _ or .
+                if not obj["Key"].endswith("/")
+                and not obj["Key"].rsplit("/", 1)[-1].startswith(("_", "."))
+            )
+        return files
+
+    def tasks(self, location: str) -> List[FileTask]:
+        """
+        :param location: s3 location the flat files are written to
+        """
+        backend = current_backend()
+        columns, partition_columns = self.column_specs()
+        source_schema = self.source_schema(columns)
+        source_format = self.source_format()
+        output_filesystem, output_path = backend.arrow_filesystem(location)
+        compression = self.flat_table.output.compression.lower()
+        run = uuid.uuid4().hex[:12]
+        tasks = []
+        for i, (source, values) in enumerate(self.source_files()):
+            filesystem, path = backend.arrow_filesystem(source)
+            tasks.append(
+                FileTask(
+                    filesystem=filesystem,
+                    path=path,
+                    format=source_format,
+                    source_schema=source_schema,
+                    partition_values=values,
+                    columns=columns,
+                    partition_columns=partition_columns,
+                    output_filesystem=output_filesystem,
+                    output_path=output_path.rstrip("/"),
+                    file_name=f"{run}_{i:05d}.parquet",
+                    compression="none"
+                    if compression == "uncompressed"
+                    else compression,
+                    batch_size=self.batch_size,
+                )
+            )
+        return tasks
+
+    def _flatten_files(self, tasks: List[FileTask]) -> List[FileResult]:
+        processes = min(self.processes, len(tasks))
+        logger.info(f"Flattening {len(tasks)} files with {processes} processes.")
+        with span("arrow.files", cpu=True, files=len(tasks), processes=processes):
+            if processes <= 1:
+                return [flatten_file(task) for task in tasks]
+            # Forked workers could inherit locks held by threads of boto3 or arrow
+            with ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                return list(executor.map(flatten_file, tasks))
+
+    @traced("arrow.insert_overwrite")
+    def run(self, force=False) -> Optional[ArrowRun]:
+        """
+        :param force: Flatten even if nothing changed since the last successful run
+        :return: Counts of the run, None if it was skipped
+        """
+        flat_table = self.flat_table
+        annotate(
+            source=flat_table.source_table.full_name,
+            target=flat_table.target_table.full_name,
+        )
+        self.validate()
+        fingerprint = None if force else flat_table.run_fingerprint()
+        if not force and fingerprint == flat_table.stored_fingerprint():
+            logger.info(
+                f"{flat_table.source_table.full_name} is unchanged since the last run "
+                f"of {flat_table.target_table.full_name}, use --force to flatten it anyway."
+            )
+            return None
+        source_fingerprints = flat_table.source_partition_fingerprints()
+        source_files = (
+            None
+            if flat_table.source_table.partition_keys()
+            else flat_table.source_objects()
+        )
+        location = flat_table.run_location()
+        flat_table.refresh_target_table(location=location)
+        base = (location or flat_table.target_table.location()).rstrip("/")
+        results = self._flatten_files(self.tasks(base))
+
+        if flat_table.target_partition_keys():
+            directories = {
+                values: directory
+                for result in results
+                for values, directory, _ in result.files
+            }
+            descriptor = {
+                **flat_table.target_table.metadata["StorageDescriptor"],
+                "Columns": [
+                    {"Name": name, "Type": type_}
+                    for name, type_ in flat_table.target_columns()
+                ],
+            }
+            logger.info(f"Registering {len(directories)} partitions.")
+            flat_table.target_table.replace_partitions(
+                flat_table.fingerprinted(
+                    [
+                        {
+                            "Values": list(values),
+                            "StorageDescriptor": {
+                                **descriptor,
+                                "Location": f"{base}/{directory}",
+                            },
+                            "Parameters": {},
+                        }
+                        for values, directory in sorted(directories.items())
+                    ],
+                    source_fingerprints,
+                )
+            )
+        if source_files is not None:
+            flat_table.record_source_files(source_files)
+        parameters = {RUN_FINGERPRINT_PARAMETER: fingerprint or ""}
+        if location:
+            flat_table.swap_location(location, parameters)
+        else:
+            flat_table.target_table.update(parameters=parameters)
+        run = ArrowRun(
+            source_files=len(results),
+            files=sum(len(result.files) for result in results),
+            rows=sum(result.rows for result in results),
+        )
+        annotate(rows=run.rows, files=run.files)
+        logger.info(
+            f"Flattened {run.rows} rows of {run.source_files} files of "
+            f"{flat_table.source_table.full_name} into {run.files} files."
+        )
+        return run
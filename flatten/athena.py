@@ -0,0 +1,185 @@
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import InvalidStateError
+from typing import Dict
+from typing import Optional
+
+from loguru import logger
+from pyathena.error import OperationalError
+from pyathena.model import AthenaQueryExecution
+
+# Maximum number of ids accepted by batch_get_query_execution
+BATCH_SIZE = 50
+
+
+class QueryFuture(Future):
+    """Future of a running Athena query, resolves to its AthenaQueryExecution"""
+
+    def __init__(self, query_id: str) -> None:
+        super().__init__()
+        self.query_id = query_id
+
+
+class _PendingQuery:
+    __slots__ = ("future", "interval", "max_interval", "next_poll", "deadline")
+
+    def __init__(self, future, interval, max_interval, timeout):
+        now = time.monotonic()
+        self.future = future
+        self.interval = interval
+        self.max_interval = max_interval
+        self.next_poll = now + interval
+        self.deadline = now + timeout if timeout else None
+
+
+class AthenaQueryPoller:
+    """
+    Waits for many running Athena queries from a single background thread.
+    Every query is polled with exponential backoff, all queries due at the same
+    time are fetched with one batch_get_query_execution call.
+    """
+
+    def __init__(self, client, backoff=2.0, coalesce=0.5):
+        """
+        :param client: Boto3 athena client
+        :param backoff: Factor by which the poll interval of a query grows
+        :param coalesce: Queries due within this many seconds are polled together
+        """
+        self.client = client
+        self.backoff = backoff
+        self.coalesce = coalesce
+        self._pending: Dict[str, _PendingQuery] = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def watch(
+        self,
+        query_id: str,
+        poll_interval=1.0,
+        max_poll_interval=30.0,
+        timeout: Optional[float] = None,
+    ) -> QueryFuture:
+        """
+        :param query_id: Athena query execution id
+        :param poll_interval: Initial poll interval in seconds
+        :param max_poll_interval: Upper limit of the poll interval
+        :param timeout: Seconds after which the query is stopped, no limit if None
+        :return: Future resolving to the AthenaQueryExecution, raises OperationalError
+            if the query failed or was cancelled and TimeoutError on timeouts
+        """
+        future = QueryFuture(query_id)
+        with self._condition:
+            self._pending[query_id] = _PendingQuery(
+                future, poll_interval, max_poll_interval, timeout
+            )
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="athena-query-poller", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def cancel(self, query_id: str) -> None:
+        """
+        Stops a query with StopQueryExecution, its future raises OperationalError
+        once Athena reports it as cancelled
+        """
+        logger.info(f"Cancelling query {query_id}.")
+        self.client.stop_query_execution(QueryExecutionId=query_id)
+        with self._condition:
+            if query_id in self._pending:
+                self._pending[query_id].next_poll = time.monotonic()
+                self._condition.notify()
+
+    def _due_queries(self):
+        """Blocks until queries are due, returns None when there is nothing to wait for"""
+        with self._condition:
+            while True:
+                if not self._pending:
+                    self._thread = None
+                    return None
+                now = time.monotonic()
+                next_poll = min(query.next_poll for query in self._pending.values())
+                if next_poll <= now:
+                    return [
+                        query_id
+                        for query_id, query in self._pending.items()
+                        if query.next_poll <= now + self.coalesce
+                    ]
+                self._condition.wait(next_poll - now)
+
+    def _run(self):
+        while True:
+            due = self._due_queries()
+            if due is None:
+                return
+            for i in range(0, len(due), BATCH_SIZE):
+                batch = due[i : i + BATCH_SIZE]
+                try:
+                    self._poll(batch)
+                except Exception as e:
+                    logger.exception("Polling athena queries failed")
+                    for query_id in batch:
+                        if query_id in self._pending:
+                            self._resolve(query_id, e)
+
+    def _poll(self, query_ids):
+        try:
+            response = self.client.batch_get_query_execution(
+                QueryExecutionIds=query_ids
+            )
+        except Exception as e:
+            logger.warning(f"Polling athena queries failed, retrying: {e}")
+            response = {"QueryExecutions": [], "UnprocessedQueryExecutionIds": []}
+
+        executions = {
+            execution["QueryExecutionId"]: AthenaQueryExecution(
+                {"QueryExecution": execution}
+            )
+            for execution in response["QueryExecutions"]
+        }
+        unprocessed = {
+            error["QueryExecutionId"]: error.get("ErrorMessage")
+            for error in response["UnprocessedQueryExecutionIds"]
+        }
+        now = time.monotonic()
+        for query_id in query_ids:
+            with self._condition:
+                query = self._pending[query_id]
+            execution = executions.get(query_id)
+            if query_id in unprocessed:
+                self._resolve(query_id, OperationalError(unprocessed[query_id]))
+            elif execution is not None and execution.state in (
+                AthenaQueryExecution.STATE_FAILED,
+                AthenaQueryExecution.STATE_CANCELLED,
+            ):
+                self._resolve(query_id, OperationalError(execution.state_change_reason))
+            elif execution is not None and (
+                execution.state == AthenaQueryExecution.STATE_SUCCEEDED
+            ):
+                self._resolve(query_id, execution)
+            elif query.deadline is not None and now >= query.deadline:
+                try:
+                    self.client.stop_query_execution(QueryExecutionId=query_id)
+                except Exception as e:
+                    logger.warning(f"Stopping query {query_id} failed: {e}")
+                self._resolve(query_id, TimeoutError(f"Query {query_id} timed out"))
+            else:
+                query.interval = min(query.interval * self.backoff, query.max_interval)
+                query.next_poll = now + query.interval
+                if query.deadline is not None:
+                    query.next_poll = min(query.next_poll, query.deadline)
+
+    def _resolve(self, query_id, result):
+        with self._condition:
+            query = self._pending.pop(query_id)
+        try:
+            if isinstance(result, Exception):
+                query.future.set_exception(result)
+            else:
+                query.future.set_result(result)
+        except InvalidStateError:
+            # The caller cancelled the future, the other queries are not affected
+            logger.debug(f"The future of query {query_id} was cancelled.")
@@ -1,28 +1,70 @@
 from __future__ import annotations
 
+import functools
+import hashlib
+import json
+import math
 import os
-import random
-import string
-from functools import cached_property
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from contextlib import nullcontext
+from datetime import datetime
+from datetime import timezone
 from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
 from urllib.parse import urlsplit
 
 import boto3
 import pyathena
-import sqlparse
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from flatten.athena import AthenaQueryPoller
+from flatten.athena import QueryFuture
+from flatten.cache import TieredCache
 from flatten.hive_parser import HiveParser
-from flatten.hive_parser import reconstruct_array
-from flatten.utils import column_query_path_format
-from flatten.utils import flatten_dict
-from jinja2 import Template
+from flatten.hive_parser import serialize_type
+from flatten.ledger import QueryStats
+from flatten.ledger import RunLedger
+from flatten.ledger import summarize
+from flatten.manifest import ObjectManifest
+from flatten.output import bucket_count_for
+from flatten.output import OutputOptions
+from flatten.output import STORAGE_FORMATS
+from flatten.projection import ColumnProjection
+from flatten.purge import PurgeResult
+from flatten.purge import S3Purger
+from flatten.schema import ColumnChange
+from flatten.schema import diff_schema
+from flatten.schema import SchemaDiff
+from flatten.sql import create_table_as
+from flatten.sql import format_sql
+from flatten.sql import insert_into
+from flatten.sql import PRETTY_MAX_BYTES
+from flatten.sql import render_template
+from flatten.state import RunState
+from flatten.state import RunStateStore
+from flatten.tracing import annotate
+from flatten.tracing import span
+from flatten.tracing import traced
+from flatten.tracing import tracer
+from flatten.utils import cache_dir
+from flatten.utils import flatten_struct
 from loguru import logger
 from pkg_resources import resource_filename
 from pyathena.cursor import Cursor
+from pyathena.error import OperationalError
+from pyathena.model import AthenaQueryExecution
 
-s3 = boto3.resource("s3")
+s3_client = boto3.client("s3")
 
 
 def splitted_s3_key(s3_url: str) -> Dict:
@@ -35,50 +77,339 @@ def splitted_s3_key(s3_url: str) -> Dict:
     return parts
 
 
-def query_gen(template: str, query_args: Dict) -> str:
+def purge_location(location: str, dry_run=False, max_workers=8) -> PurgeResult:
     """
-    Uses jinja2 to render sql templates
+    Deletes all data under a s3 location
+    :param location: s3://bucket/prefix
+    :param dry_run: Only count the objects and bytes that would be deleted
+    :param max_workers: Number of concurrent delete requests
+    :return:
+    """
+    s3_url_parts = splitted_s3_key(location)
+    prefix = s3_url_parts["path"]
+    # Don't delete sibling prefixes, e.g. flat_table_2/ when purging flat_table
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    with span("s3.purge", location=location, dry_run=dry_run):
+        return S3Purger(s3_client, max_workers=max_workers).purge(
+            s3_url_parts["bucket"], prefix, dry_run=dry_run
+        )
+
+
+def table_size(metadata: Dict) -> int:
+    """
+    Size of a table in bytes as recorded by glue crawlers, 0 if unknown
+    :param metadata:
+    :return:
+    """
+    try:
+        return int(metadata.get("Parameters", {}).get("sizeKey", 0))
+    except ValueError:
+        return 0
+
+
+def s3_listing_totals(location: str) -> Tuple[int, int]:
+    """
+    :param location: s3://bucket/prefix
+    :return: Number and total size of all objects under the location
+    """
+    s3_url_parts = splitted_s3_key(location)
+    prefix = s3_url_parts["path"]
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    paginator = s3_client.get_paginator("list_objects_v2")
+    files, size = 0, 0
+    for page in paginator.paginate(Bucket=s3_url_parts["bucket"], Prefix=prefix):
+        for obj in page.get("Contents", []):
+            files += 1
+            size += obj["Size"]
+    return files, size
+
+
+def s3_listing_size(location: str) -> int:
+    """
+    :param location: s3://bucket/prefix
+    :return: Total size of all objects under the location
+    """
+    return s3_listing_totals(location)[1]
+
+
+def s3_listing_digest(location: str) -> str:
+    """
+    :param location: s3://bucket/prefix
+    :return: Hash of the keys, ETags and sizes of all objects under the location
+    """
+    s3_url_parts = splitted_s3_key(location)
+    prefix = s3_url_parts["path"]
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    digest = hashlib.sha256()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=s3_url_parts["bucket"], Prefix=prefix):
+        for obj in page.get("Contents", []):
+            digest.update(f"{obj['Key']}\x1f{obj['ETag']}\x1f{obj['Size']}\n".encode())
+    return digest.hexdigest()
+
+
+# Hive stores null partition values as this placeholder
+HIVE_NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+INTEGER_TYPES = ("tinyint", "smallint", "int", "integer", "bigint")
+NUMERIC_TYPES = INTEGER_TYPES + ("float", "double")
+INTEGER_LITERAL = re.compile(r"[-+]?\d+")
+DECIMAL_LITERAL = re.compile(r"[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?")
+# Target partition parameter holding the fingerprint of the flattened source partition
+FINGERPRINT_PARAMETER = "flatten.source_fingerprint"
+# Target table parameter holding the fingerprint of the last successful full refresh
+RUN_FINGERPRINT_PARAMETER = "flatten.run_fingerprint"
+# Target table parameter marking data written to the root of the location before the
+# first swap, it is deleted like the oldest version
+PRE_SWAP_DATA_PARAMETER = "flatten.pre_swap_data"
+
+
+def partition_literal(value: str, type_: str) -> str:
+    """
+    Glue stores partition values as strings, this turns them into sql literals
+    :param value:
+    :param type_: Hive type of the partition key
+    :return:
+    """
+    type_ = type_.lower()
+    if type_ in NUMERIC_TYPES or type_.startswith("decimal"):
+        # Refuses values that are no sql numbers, e.g. injected sql, "nan" or "1_000"
+        literal = INTEGER_LITERAL if type_ in INTEGER_TYPES else DECIMAL_LITERAL
+        if not literal.fullmatch(value):
+            raise ValueError(f"Partition value {value!r} is no {type_} literal")
+        return value
+    if type_ == "boolean":
+        return "true" if value.lower() == "true" else "false"
+    escaped = value.replace("'", "''")
+    if type_ in ("date", "timestamp"):
+        return f"{type_} '{escaped}'"
+    return f"'{escaped}'"
+
+
+def partition_filter(partition_keys: List[tuple], values: Tuple[str, ...]) -> str:
+    """
+    :param partition_keys: [("name", "type"), ...]
+    :param values: Partition values in the order of the keys
+    :return: Where condition selecting a single partition
+    """
+    conditions = []
+    for (name, type_), value in zip(partition_keys, values):
+        if value == HIVE_NULL_PARTITION:
+            conditions.append(f'"{name}" is null')
+        else:
+            conditions.append(f'"{name}" = {partition_literal(value, type_)}')
+    return " and ".join(conditions)
+
+
+def partition_fingerprint(partition: Dict, s3_listing=False) -> str:
+    """
+    Hash of everything that changes when a crawler or an ETL job updates a partition
+    :param partition: Glue partition
+    :param s3_listing: Include the objects under the partition location, detects files
+        that were added without updating glue
+    :return:
+    """
+    storage_descriptor = partition.get("StorageDescriptor", {})
+    parts = {
+        "location": storage_descriptor.get("Location"),
+        "parameters": partition.get("Parameters", {}),
+        "storage_parameters": storage_descriptor.get("Parameters", {}),
+        "last_analyzed": partition.get("LastAnalyzedTime"),
+    }
+    if s3_listing and parts["location"]:
+        parts["objects"] = s3_listing_digest(parts["location"])
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def query_gen(
+    template: str, query_args: Dict, pretty=True, max_pretty_bytes=PRETTY_MAX_BYTES
+) -> str:
+    """
+    Uses jinja2 to render sql templates, every template is compiled once per process
     :param template:
     :param query_args:
+    :param pretty: Format the rendered sql with sqlparse
+    :param max_pretty_bytes: Larger queries are not formatted, None formats all
     :return:
     """
-    with open(template) as f:
-        query_template = f.read()
-
-    query = Template(query_template).render(query_args)
-    formatted_query = sqlparse.format(
-        query,
-        comma_first=True,
-        reindent=True,
-        keyword_case="lower",
-        strip_comments=True,
-    )
-    return formatted_query
+    with span("query_gen", cpu=True, template=os.path.basename(template)):
+        query = render_template(template, query_args)
+        return format_sql(query, max_pretty_bytes) if pretty else query
 
 
 class AthenaConnection:
     """
     Base class for Athena queries.
     Provides methods to execute a query against Athena.
+    Connections and query pollers are shared by all instances with the same settings.
     """
 
-    def __init__(self, database, workgroup, s3_staging_dir, cursor_class=Cursor):
+    _pool = {}
+    _pool_lock = threading.Lock()
+
+    def __init__(
+        self,
+        database,
+        workgroup,
+        s3_staging_dir,
+        cursor_class=Cursor,
+        poll_interval=1.0,
+        max_poll_interval=30.0,
+        timeout=None,
+        max_pool_connections=10,
+    ):
+        """
+        :param poll_interval: Initial interval for polling running queries in seconds
+        :param max_poll_interval: Maximum poll interval, polling backs off exponentially
+        :param timeout: Seconds after which submitted queries are stopped, no limit if None
+        :param max_pool_connections: Size of the http connection pool of the athena client
+        """
         self.database = database
         self.workgroup = workgroup
         self.s3_staging_dir = s3_staging_dir
         self.cursor_class = cursor_class
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.max_pool_connections = max_pool_connections
+        # Statistics of the successful queries of this instance in completion order
+        self.query_stats: List[QueryStats] = []
+
+    def _pooled(self):
+        key = (self.workgroup, self.s3_staging_dir, self.cursor_class)
+        with self._pool_lock:
+            if key not in self._pool:
+                conn = pyathena.connect(
+                    work_group=self.workgroup,
+                    s3_staging_dir=self.s3_staging_dir,
+                    cursor_class=self.cursor_class,
+                    config=Config(max_pool_connections=self.max_pool_connections),
+                )
+                self._pool[key] = (conn, AthenaQueryPoller(conn.client))
+            return self._pool[key]
+
+    @property
+    def connection(self) -> pyathena.connection.Connection:
+        return self._pooled()[0]
+
+    @property
+    def poller(self) -> AthenaQueryPoller:
+        return self._pooled()[1]
 
     def query(self, sql: str):
         logger.info("{}".format(sql))
-        conn = pyathena.connect(
-            work_group=self.workgroup,
-            s3_staging_dir=self.s3_staging_dir,
-            cursor_class=self.cursor_class,
-        )
-        cursor = conn.cursor()
-        cursor.execute(sql.rstrip(";") + ";")
+        cursor = self.connection.cursor()
+        with span("athena.query") as current:
+            cursor.execute(sql.rstrip(";") + ";")
+            stats = QueryStats.from_execution(cursor)
+            if current is not None:
+                current.set(**stats._asdict())
+        self.query_stats.append(stats)
         return cursor
 
+    def _record_stats(self, future: QueryFuture) -> None:
+        if not future.cancelled() and future.exception() is None:
+            self.query_stats.append(QueryStats.from_execution(future.result()))
+
+    def _watched(self, future: QueryFuture) -> QueryFuture:
+        future.add_done_callback(self._record_stats)
+        active = tracer()
+        if active is not None:
+            # The query finishes in the poller thread, outside of the current span
+            parent, start = active.current(), time.perf_counter_ns()
+
+            def trace(future):
+                if future.cancelled():
+                    attributes = {"query_id": future.query_id, "error": "cancelled"}
+                elif future.exception() is not None:
+                    attributes = {
+                        "query_id": future.query_id,
+                        "error": str(future.exception()),
+                    }
+                else:
+                    attributes = QueryStats.from_execution(future.result())._asdict()
+                active.record("athena.query", start, parent, **attributes)
+
+            future.add_done_callback(trace)
+        return future
+
+    def output_rows(self, query_id: str) -> Optional[int]:
+        """
+        :return: Number of rows written by a CTAS or INSERT INTO query, None if unknown
+        """
+        try:
+            response = self.connection.client.get_query_runtime_statistics(
+                QueryExecutionId=query_id
+            )
+        except ClientError as e:
+            logger.warning(f"Getting the statistics of query {query_id} failed: {e}")
+            return None
+        return response["QueryRuntimeStatistics"].get("Rows", {}).get("OutputRows")
+
+    def submit(self, sql: str, timeout=None) -> QueryFuture:
+        """
+        Starts a query without waiting for it
+        :param sql:
+        :param timeout: Overrides the timeout of the connection
+        :return: Future resolving to the AthenaQueryExecution
+        """
+        logger.info("{}".format(sql))
+        request = {
+            "QueryString": sql.rstrip(";") + ";",
+            "QueryExecutionContext": {"Database": self.database},
+            "WorkGroup": self.workgroup,
+        }
+        if self.s3_staging_dir:
+            request["ResultConfiguration"] = {"OutputLocation": self.s3_staging_dir}
+        query_id = self.connection.client.start_query_execution(**request)[
+            "QueryExecutionId"
+        ]
+        logger.info(f"Started query {query_id}.")
+        future = self.poller.watch(
+            query_id,
+            poll_interval=self.poll_interval,
+            max_poll_interval=self.max_poll_interval,
+            timeout=timeout or self.timeout,
+        )
+        return self._watched(future)
+
+    def attach(self, query_id: str, timeout=None) -> QueryFuture:
+        """
+        Waits for a query started earlier, e.g. by an interrupted run
+        :param query_id:
+        :param timeout: Overrides the timeout of the connection
+        :return: Future resolving to the AthenaQueryExecution
+        """
+        logger.info(f"Attaching to query {query_id}.")
+        future = self.poller.watch(
+            query_id,
+            poll_interval=self.poll_interval,
+            max_poll_interval=self.max_poll_interval,
+            timeout=timeout or self.timeout,
+        )
+        return self._watched(future)
+
+    def cancel(self, query_id: str) -> None:
+        self.poller.cancel(query_id)
+
+    def execute(self, sql: str, timeout=None) -> AthenaQueryExecution:
+        """
+        Runs a query and waits for it, the query is stopped on KeyboardInterrupt
+        :param sql:
+        :param timeout: Overrides the timeout of the connection
+        :return:
+        """
+        future = self.submit(sql, timeout=timeout)
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            self.cancel(future.query_id)
+            raise
+
 
 class GlueColumnMapping(NamedTuple):
     source_name: str
@@ -86,34 +417,40 @@ class GlueColumnMapping(NamedTuple):
     type: str
 
 
-class GlueTable:
-    glue_client = boto3.client("glue")
-    hive_parser = HiveParser()
+class GlueMetadataCache:
+    """
+    Glue table metadata, fetched at most once per table.
+    Entries are replaced when a newer VersionId/UpdateTime is seen and invalidated
+    when tables are created or deleted through GlueTable.
+    """
 
-    def __init__(self, database_name, table_name, metadata=None, table_version_id=None):
-        self.database_name = database_name
-        self.table_name = table_name
-        self.table_version_id = table_version_id
-        if metadata:
-            self.metadata = metadata
+    def __init__(self):
+        # (database, table, version id) -> table metadata or None if the table does not exist
+        self._tables = {}
+        self._lock = threading.Lock()
+        self.fetches = 0
 
-    @cached_property
-    def metadata(self):
-        if self.exists():
-            metadata = self._get_table(
-                client=self.glue_client,
-                database=self.database_name,
-                table_name=self.table_name,
-                table_version_id=self.table_version_id,
-            )
-        return metadata
+    @staticmethod
+    def _version(metadata: Optional[Dict]):
+        if metadata is None:
+            return None
+        return metadata.get("VersionId"), str(metadata.get("UpdateTime"))
 
-    @property
-    def full_name(self):
-        return f'"{self.database_name}"."{self.table_name}"'
+    def _store(self, key, metadata) -> None:
+        with self._lock:
+            cached = self._tables.get(key)
+            if key in self._tables and self._version(cached) == self._version(metadata):
+                return
+            if cached is not None:
+                logger.debug(
+                    f"Glue table {key[0]}.{key[1]} changed, replacing metadata"
+                )
+            self._tables[key] = metadata
 
-    @staticmethod
-    def _get_table(client, database, table_name, table_version_id):
+    @traced("glue.get_table")
+    def _fetch(self, client, database, table_name, table_version_id) -> Optional[Dict]:
+        self.fetches += 1
+        annotate(table=f"{database}.{table_name}")
         try:
             if table_version_id:
                 response = client.get_table_version(
@@ -125,23 +462,147 @@ class GlueTable:
             else:
                 response = client.get_table(DatabaseName=database, Name=table_name)
                 return response["Table"]
-        except client.exceptions.EntityNotFoundException:
-            raise ValueError(f"Glue Table {table_name} not found")
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "EntityNotFoundException":
+                return None
+            raise
+
+    def get(
+        self, client, database, table_name, table_version_id=None
+    ) -> Optional[Dict]:
+        """
+        :return: Table metadata or None if the table does not exist
+        """
+        key = (database, table_name, table_version_id)
+        with self._lock:
+            if key in self._tables:
+                return self._tables[key]
+        metadata = self._fetch(client, database, table_name, table_version_id)
+        self._store(key, metadata)
+        return metadata
+
+    def prefetch(self, client, database, expression=None) -> List[Dict]:
+        """
+        Loads the metadata of all tables of a database with the paginated get_tables API
+        :param client: Glue client
+        :param database: Glue database
+        :param expression: Optional get_tables regex filter on table names
+        :return: Metadata of all fetched tables
+        """
+        paginate_args = {"DatabaseName": database}
+        if expression:
+            paginate_args["Expression"] = expression
+        tables = []
+        for page in client.get_paginator("get_tables").paginate(**paginate_args):
+            self.fetches += 1
+            for table in page["TableList"]:
+                self._store((database, table["Name"], None), table)
+                tables.append(table)
+        return tables
+
+    def invalidate(self, database, table_name=None) -> None:
+        with self._lock:
+            for key in list(self._tables):
+                if key[0] == database and table_name in (None, key[1]):
+                    del self._tables[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tables.clear()
+
+
+# Keys of get_table responses that update_table accepts as TableInput
+TABLE_INPUT_KEYS = (
+    "Name",
+    "Description",
+    "Owner",
+    "LastAccessTime",
+    "LastAnalyzedTime",
+    "Retention",
+    "StorageDescriptor",
+    "PartitionKeys",
+    "ViewOriginalText",
+    "ViewExpandedText",
+    "TableType",
+    "Parameters",
+    "TargetTable",
+)
+# Keys of get_partitions responses accepted as PartitionInput
+PARTITION_INPUT_KEYS = (
+    "Values",
+    "LastAccessTime",
+    "StorageDescriptor",
+    "Parameters",
+    "LastAnalyzedTime",
+)
+
+
+class GlueTable:
+    glue_client = boto3.client("glue")
+    metadata_cache = GlueMetadataCache()
+    hive_parser = HiveParser()
+    # Parsed column types keyed by type string, flat mappings keyed by table version
+    type_cache = TieredCache(maxsize=16384)
+    mapping_cache = TieredCache(maxsize=1024)
+
+    def __init__(
+        self,
+        database_name,
+        table_name,
+        metadata=None,
+        table_version_id=None,
+        projection: Optional[ColumnProjection] = None,
+    ):
+        """
+        :param projection: Selects the columns of the flat mapping, all if None
+        """
+        self.database_name = database_name
+        self.table_name = table_name
+        self.table_version_id = table_version_id
+        self._metadata = metadata
+        self.projection = projection
+
+    @property
+    def metadata(self):
+        if self._metadata:
+            return self._metadata
+        metadata = self.metadata_cache.get(
+            self.glue_client,
+            self.database_name,
+            self.table_name,
+            self.table_version_id,
+        )
+        if metadata is None:
+            raise ValueError(f"Glue Table {self.table_name} not found")
+        return metadata
 
-    def purge_data(self) -> int:
-        s3_url_parts = splitted_s3_key(self.location())
-        bucket = s3.Bucket(s3_url_parts["bucket"])
-        return bucket.objects.filter(Prefix=s3_url_parts["path"]).delete()
+    @property
+    def full_name(self):
+        return f'"{self.database_name}"."{self.table_name}"'
+
+    def purge_data(self, dry_run=False, max_workers=8) -> PurgeResult:
+        """
+        Deletes all data under the table location
+        :param dry_run: Only count the objects and bytes that would be deleted
+        :param max_workers: Number of concurrent delete requests
+        :return:
+        """
+        return purge_location(self.location(), dry_run=dry_run, max_workers=max_workers)
 
     def exists(self) -> bool:
-        try:
-            self.glue_client.get_table(
-                DatabaseName=self.database_name, Name=self.table_name
+        return (
+            self.metadata_cache.get(
+                self.glue_client, self.database_name, self.table_name
             )
-            return True
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "EntityNotFoundException":
-                return False
+            is not None
+        )
+
+    def invalidate(self) -> None:
+        """
+        Drops cached metadata, e.g. after the table was changed in Glue
+        """
+        self._metadata = None
+        self.metadata_cache.invalidate(self.database_name, self.table_name)
 
     def location(self):
         return self.metadata["StorageDescriptor"]["Location"]
@@ -164,8 +625,125 @@ class GlueTable:
             )
         return columns
 
-    def delete(self):
+    def partition_keys(self) -> List[tuple]:
+        return [
+            (key["Name"], key["Type"]) for key in self.metadata.get("PartitionKeys", [])
+        ]
 
+    @traced("glue.get_partitions")
+    def partitions(self, expression=None) -> List[Dict]:
+        """
+        :param expression: Glue partition filter, e.g. "dt >= '2020-01-01'"
+        :return: Glue partitions of the table
+        """
+        kwargs = {"Expression": expression} if expression else {}
+        paginator = self.glue_client.get_paginator("get_partitions")
+        return [
+            partition
+            for page in paginator.paginate(
+                DatabaseName=self.database_name, TableName=self.table_name, **kwargs
+            )
+            for partition in page["Partitions"]
+        ]
+
+    @traced("glue.replace_partitions")
+    def replace_partitions(self, partitions: List[Dict]) -> None:
+        """
+        Replaces all partitions of the table, e.g. with the partitions of
+        a table with the same layout that was written by a CTAS query.
+        Existing partitions are updated in place, so readers never miss them.
+        :param partitions: Glue partitions
+        :return:
+        """
+        existing = {tuple(partition["Values"]) for partition in self.partitions()}
+        new_values = {tuple(partition["Values"]) for partition in partitions}
+        created = [p for p in partitions if tuple(p["Values"]) not in existing]
+        updated = [
+            {
+                "PartitionValueList": list(partition["Values"]),
+                "PartitionInput": self._partition_input(partition),
+            }
+            for partition in partitions
+            if tuple(partition["Values"]) in existing
+        ]
+        deleted = sorted(existing - new_values)
+        errors = []
+        for i in range(0, len(created), 100):
+            response = self.glue_client.batch_create_partition(
+                DatabaseName=self.database_name,
+                TableName=self.table_name,
+                PartitionInputList=[
+                    self._partition_input(partition)
+                    for partition in created[i : i + 100]
+                ],
+            )
+            errors.extend(response.get("Errors", []))
+        for i in range(0, len(updated), 100):
+            response = self.glue_client.batch_update_partition(
+                DatabaseName=self.database_name,
+                TableName=self.table_name,
+                Entries=updated[i : i + 100],
+            )
+            errors.extend(response.get("Errors", []))
+        for i in range(0, len(deleted), 25):
+            response = self.glue_client.batch_delete_partition(
+                DatabaseName=self.database_name,
+                TableName=self.table_name,
+                PartitionsToDelete=[
+                    {"Values": list(values)} for values in deleted[i : i + 25]
+                ],
+            )
+            errors.extend(response.get("Errors", []))
+        if errors:
+            raise ValueError(
+                f"Replacing {len(errors)} partitions of {self.full_name} failed: {errors[:5]}"
+            )
+
+    @traced("glue.update_partition_parameters")
+    def update_partition_parameters(self, parameters: Dict[tuple, Dict]) -> None:
+        """
+        :param parameters: Parameters merged into the existing ones, keyed by partition values
+        :return:
+        """
+        entries = []
+        for partition in self.partitions():
+            values = tuple(partition["Values"])
+            if values in parameters:
+                partition_input = self._partition_input(partition)
+                partition_input["Parameters"] = {
+                    **partition_input.get("Parameters", {}),
+                    **parameters[values],
+                }
+                entries.append(
+                    {
+                        "PartitionValueList": list(values),
+                        "PartitionInput": partition_input,
+                    }
+                )
+        errors = []
+        for i in range(0, len(entries), 100):
+            response = self.glue_client.batch_update_partition(
+                DatabaseName=self.database_name,
+                TableName=self.table_name,
+                Entries=entries[i : i + 100],
+            )
+            errors.extend(response.get("Errors", []))
+        if errors:
+            raise ValueError(
+                f"Updating {len(errors)} partitions of {self.full_name} failed: {errors[:5]}"
+            )
+
+    @staticmethod
+    def _partition_input(partition: Dict) -> Dict:
+        return {
+            key: value
+            for key, value in partition.items()
+            if key in PARTITION_INPUT_KEYS
+        }
+
+    @traced("glue.delete_table")
+    def delete(self):
+        self.invalidate()
         return self.glue_client.delete_table(
             DatabaseName=self.database_name, Name=self.table_name
         )
@@ -176,40 +754,138 @@ class GlueTable:
 
     def flat_mapping(self) -> List[GlueColumnMapping]:
         """Flattens columns with complex types (structs,maps)
-        into multiple flat type columns
+        into multiple flat type columns.
+        Mappings of tables with a known glue VersionId are cached, keyed by their
+        columns too, since tables built from metadata can change them in place.
         Returns:
             List[GlueColumnMapping]: [description]
         """
+        version_id = self.metadata.get("VersionId") or self.table_version_id
+        if not version_id:
+            return self._flat_mapping()
+
+        key = self.mapping_cache.key(
+            self.database_name,
+            self.table_name,
+            version_id,
+            self.metadata.get("UpdateTime"),
+            self.projection.key() if self.projection else None,
+            self.columns(),
+        )
+        return [
+            GlueColumnMapping(*col)
+            for col in self.mapping_cache.get_or_set(key, self._flat_mapping)
+        ]
+
+    def parse_type(self, col_type: str):
+        return self.type_cache.get_or_set(
+            self.type_cache.key(col_type), lambda: self.hive_parser(col_type)
+        )
+
+    @traced("flat_mapping", cpu=True)
+    def _flat_mapping(self) -> List[GlueColumnMapping]:
         column_mapping = []
-        # TODO refactor nested logic
         for col_name, col_type in self.columns():
-            parsed_type = self.hive_parser(col_type)
+            if self.projection is not None:
+                # Pruned columns are never parsed
+                is_struct = col_type.lstrip().lower().startswith("struct")
+                if (
+                    self.projection.prunes((col_name,))
+                    if is_struct
+                    else not self.projection.selects((col_name,))
+                ):
+                    continue
+            parsed_type = self.parse_type(col_type)
             if isinstance(parsed_type, dict):
-                source_columns = flatten_dict(
-                    {col_name: parsed_type}, format_func=column_query_path_format
-                )
-                target_columns = flatten_dict({col_name: parsed_type})
-                for source_column, (target_column, target_type) in zip(
-                    source_columns, target_columns.items()
+                for source_column, target_column, target_type in flatten_struct(
+                    col_name, parsed_type, self.projection
                 ):
-                    if isinstance(target_type, list):
-                        target_type = reconstruct_array(
-                            self.hive_parser.parser, target_type
-                        )
+                    if not isinstance(target_type, str):
+                        target_type = serialize_type(target_type)
                     column_mapping.append(
                         GlueColumnMapping(source_column, target_column, target_type)
                     )
             else:
-                if isinstance(col_type, list):
-                    col_type = reconstruct_array(self.hive_parser.parser, col_type)
                 # Wrapping col_name in double quotes because hive and presto have different
                 # constraints on which character are allowed
                 column_mapping.append(
                     GlueColumnMapping(f"{col_name}", f"{col_name}", col_type)
                 )
 
+        if self.projection is not None and not column_mapping:
+            raise ValueError(
+                f"The column patterns {self.projection.key()} select no columns "
+                f"of {self.full_name}"
+            )
+        self._check_collisions(column_mapping)
         return column_mapping
 
+    @staticmethod
+    def _check_collisions(column_mapping: List[GlueColumnMapping]) -> None:
+        # Glue/hive column names are case insensitive
+        sources = {}
+        for col in column_mapping:
+            target_name = col.target_name.lower()
+            if target_name in sources:
+                raise ValueError(
+                    f"Columns {sources[target_name]} and {col.source_name} are both "
+                    f"flattened to {col.target_name}, please rename one of them!"
+                )
+            sources[target_name] = col.source_name
+
+    @traced("glue.update_table")
+    def update(
+        self,
+        columns=None,
+        location=None,
+        parameters=None,
+        partitions=None,
+        bucket_columns=None,
+        bucket_count=None,
+    ):
+        """
+        Updates the table in place with update_table, everything not given is kept
+        :param columns: New column definition of the form [("name", "type"), ...]
+        :param location: New location of the table data
+        :param parameters: Table parameters, merged into the existing ones
+        :param partitions: New partition columns of the form [("name", "type"), ...]
+        :param bucket_columns: New columns the rows are bucketed by, () for none
+        :param bucket_count: Number of buckets, only used with bucket_columns
+        :return:
+        """
+        table_input = {
+            key: value
+            for key, value in self.metadata.items()
+            if key in TABLE_INPUT_KEYS
+        }
+        storage_descriptor = dict(table_input["StorageDescriptor"])
+        if columns is not None:
+            storage_descriptor["Columns"] = [
+                {"Name": name, "Type": type_} for name, type_ in columns
+            ]
+        if location:
+            storage_descriptor["Location"] = location
+        if bucket_columns is not None:
+            storage_descriptor["BucketColumns"] = list(bucket_columns)
+            storage_descriptor["NumberOfBuckets"] = (
+                bucket_count if bucket_columns and bucket_count else -1
+            )
+        table_input["StorageDescriptor"] = storage_descriptor
+        if partitions is not None:
+            table_input["PartitionKeys"] = [
+                {"Name": name, "Type": type_} for name, type_ in partitions
+            ]
+        if parameters:
+            table_input["Parameters"] = {
+                **table_input.get("Parameters", {}),
+                **parameters,
+            }
+        self.invalidate()
+        return self.glue_client.update_table(
+            DatabaseName=self.database_name, TableInput=table_input
+        )
+
+    @traced("glue.create_table")
     def create(
         self,
         columns,
@@ -219,6 +895,8 @@ class GlueTable:
         output_format="org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
         serde="org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe",
         parameters=None,
+        bucket_columns=None,
+        bucket_count=None,
     ):
         """
         Creates a table in Glue. The default settings create a parquet table
@@ -229,16 +907,15 @@ class GlueTable:
         :param output_format: Format in which the table handles output (e.g., Parquet)
         :param serde: Serde for storing rows
         :param parameters: Dictionary of additional parameters
+        :param bucket_columns: Columns the rows are bucketed by
+        :param bucket_count: Number of buckets
         :return:
         """
         """
         Force reloading metadata by deleting it as there may be auto-generated info in
         there that will change
         """
-        try:
-            delattr(self, "metadata")
-        except AttributeError:
-            logger.debug("Attribute Metadata was not accessed before")
+        self.invalidate()
         # TODO consider moving the following creation of the glue table config into a separate jinja template
         if not parameters:
             parameters = {
@@ -272,10 +949,10 @@ class GlueTable:
                         "SkewedColumnValueLocationMaps": {},
                     },
                     "Parameters": {},
-                    "BucketColumns": [],
+                    "BucketColumns": list(bucket_columns or []),
                     "InputFormat": input_format,
                     "OutputFormat": output_format,
-                    "NumberOfBuckets": -1,
+                    "NumberOfBuckets": bucket_count or -1,
                     "SerdeInfo": serde_info,
                 },
                 "PartitionKeys": [
@@ -287,7 +964,66 @@ class GlueTable:
         )
 
 
+REFRESH_MODES = ("purge", "swap")
+SHARD_STRATEGIES = ("auto", "partition", "path", "hash")
+# Athena limit of partitions written by a single CTAS or INSERT INTO query
+MAX_PARTITIONS_PER_QUERY = 100
+# Files per INSERT INTO of new files, keeps the "$path" filter far below the query size limit
+MAX_FILES_PER_QUERY = 1000
+# Prefix of the run folders under the target location in swap mode
+VERSION_PREFIX = "run_"
+
+
+def recorded(mode: str):
+    """
+    Records a flatten run in the ledger of the ToFlatParquet instance: the statistics
+    of its queries, the rows written and the files under the target location.
+    Runs started by a recorded run are part of its record.
+    :param mode: Kind of the run, e.g. "overwrite"
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.ledger is None or self._recording:
+                return method(self, *args, **kwargs)
+            self._recording = True
+            first_query = len(self.conn.query_stats)
+            started = datetime.now(timezone.utc)
+            start = time.monotonic()
+            status, error = "failed", None
+            try:
+                result = method(self, *args, **kwargs)
+                status = "succeeded"
+                return result
+            except BaseException as e:
+                error = f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                self._recording = False
+                try:
+                    self.ledger.append(
+                        self.run_record(
+                            mode,
+                            status,
+                            error,
+                            started,
+                            time.monotonic() - start,
+                            self.conn.query_stats[first_query:],
+                        )
+                    )
+                except Exception as e:
+                    logger.warning(f"Recording the run in the ledger failed: {e}")
+
+        return wrapper
+
+    return decorator
+
+
 class ToFlatParquet:
+    # Creates the query connection, replaced by flatten.backend.use_backend
+    connection_factory = AthenaConnection
+
     def __init__(
         self,
         database,
@@ -297,7 +1033,62 @@ class ToFlatParquet:
         workgroup,
         s3_staging_dir,
         source_table_version_id=None,
+        state_store=None,
+        refresh_mode="purge",
+        keep_versions=2,
+        shards=1,
+        shard_by="auto",
+        shard_key=None,
+        shard_retries=2,
+        max_concurrent_queries=5,
+        verify_shards=False,
+        file_manifest=None,
+        rebuild_manifest=False,
+        output: Optional[OutputOptions] = None,
+        ledger: Optional[RunLedger] = None,
+        query_slots: Optional[threading.Semaphore] = None,
     ):
+        """
+        :param state_store: RunStateStore for resuming interrupted runs,
+            defaults to a store in the cache directory
+        :param refresh_mode: "purge" deletes the target data before the new data is written,
+            "swap" writes every run to a new prefix under target_table_location and
+            points the target table to it once the data is complete
+        :param keep_versions: Number of run prefixes kept in swap mode, including the current one
+        :param shards: Number of concurrent CTAS queries a full refresh is split into.
+            Partitioned sources with more than 100 partitions are always split by partition.
+        :param shard_by: "partition" splits the sorted source partitions into ranges,
+            "path" buckets the source files by a hash of "$path", "hash" buckets the rows
+            by a hash of shard_key, "auto" uses "partition" for partitioned sources
+            and "path" otherwise
+        :param shard_key: Column expression hashed by the "hash" strategy
+        :param shard_retries: Retries of a failed shard
+        :param max_concurrent_queries: Maximum number of shard queries in flight
+        :param verify_shards: Compare the row counts of the source and all shards
+        :param file_manifest: Local path or s3 url of the manifest of flattened source files
+            of incremental runs over unpartitioned sources, defaults to the cache directory.
+            Full refreshes of unpartitioned sources record all source files in it.
+        :param rebuild_manifest: Rebuild the empty manifest of an existing target table
+            with a full refresh, instead of refusing to append new files
+        :param output: Format, compression, partitioning and bucketing of the flat table
+        :param ledger: Records the query statistics of every run, nothing is recorded if None
+        :param query_slots: Semaphore shared by several flat tables, e.g. of a batch,
+            every query holds a slot until it finished
+        """
+        if refresh_mode not in REFRESH_MODES:
+            raise ValueError(
+                f"Unknown refresh mode {refresh_mode}, use one of {REFRESH_MODES}"
+            )
+        if keep_versions < 1:
+            raise ValueError("At least the current version has to be kept")
+        if shard_by not in SHARD_STRATEGIES:
+            raise ValueError(
+                f"Unknown shard strategy {shard_by}, use one of {SHARD_STRATEGIES}"
+            )
+        if shard_by == "hash" and not shard_key:
+            raise ValueError("Sharding by hash needs a shard_key")
+        output = output or OutputOptions()
+        output.validate()
         self.s3_staging_dir = s3_staging_dir
         self.workgroup = workgroup
         self.database = database
@@ -305,72 +1096,1062 @@ class ToFlatParquet:
         self.target_table = target_table
         self.target_table_location = target_table_location
         self.source_table_version_id = source_table_version_id
+        self._state_store = state_store
+        self.refresh_mode = refresh_mode
+        self.keep_versions = keep_versions
+        self.shards = shards
+        self.shard_by = shard_by
+        self.shard_key = shard_key
+        self.shard_retries = shard_retries
+        self.max_concurrent_queries = max_concurrent_queries
+        self.verify_shards = verify_shards
+        self._file_manifest = file_manifest
+        self.rebuild_manifest = rebuild_manifest
+        self.output = output
+        self._bucket_count = None
+        self.ledger = ledger
+        self.query_slots = query_slots
+        self._recording = False
+        self.gc_thread = None
 
-        self.conn = AthenaConnection(
+        self.conn = self.connection_factory(
             database=self.database,
             workgroup=self.workgroup,
             s3_staging_dir=self.s3_staging_dir,
         )
 
-    def refresh_target_table(self, drop_if_exists=False) -> None:
+    @traced("refresh_target_table")
+    def refresh_target_table(self, drop_if_exists=False, location=None) -> None:
+        """
+        :param drop_if_exists: Delete the target table first
+        :param location: Location of a newly created target table,
+            defaults to target_table_location
+        :return:
+        """
         if drop_if_exists:
             logger.info("Removing old target table data from glue.")
             self.target_table.delete()
-        if self.target_table.exists():
+        # In swap mode the new schema is applied together with the new location
+        if self.refresh_mode == "purge" and self.target_table.exists():
+            diff = self.evolve_schema()
+            if not diff.compatible:
+                logger.warning("Recreating the target table for the new schema.")
+                self.target_table.delete()
+        if self.refresh_mode == "purge" and self.target_table.exists():
+            if self.stored_fingerprint():
+                # The data is gone until the run succeeds, so it must not be skipped
+                self.target_table.update(parameters={RUN_FINGERPRINT_PARAMETER: ""})
             logger.info("Removing old target table data  s3.")
             self.target_table.purge_data()
 
         if not self.target_table.exists():
             logger.info(f"Creating target table {self.target_table.full_name}.")
+            storage = self.output.storage
             self.target_table.create(
-                columns=[
-                    (col.target_name, col.type)
-                    for col in self.source_table.flat_mapping()
-                ],
-                location=self.target_table_location,
-            )
-
-    def generate_insert_overwrite_query(self, tmp_table):
-        return query_gen(
-            template=resource_filename(
-                __name__, os.path.join("create_flat_tmp_table_parquet.sql")
-            ),
-            query_args={
-                "tmp_table": tmp_table.full_name,
-                "source_tb_name": self.source_table.full_name,
-                "location": self.target_table.location(),
-                "columns": [
-                    (col.source_name, col.target_name)
-                    for col in self.source_table.flat_mapping()
-                ],
-            },
+                columns=self.target_columns(),
+                location=location or self.target_table_location,
+                partitions=self.target_partition_keys(),
+                input_format=storage.input_format,
+                output_format=storage.output_format,
+                serde=storage.serde,
+                parameters=self.output.table_parameters(),
+                bucket_columns=self.output.bucketed_by,
+                bucket_count=self.bucket_count(),
+            )
+
+    @traced("fingerprint")
+    def run_fingerprint(self) -> str:
+        """
+        Hash of everything a full refresh depends on: the version of the source table,
+        the flatten sql and mapping and the files under the source locations
+        :return:
+        """
+        metadata = self.source_table.metadata
+        sql = self.generate_insert_overwrite_query(
+            GlueTable(self.database, "fingerprint"), self.target_table_location
+        )
+        parts = {
+            "version": metadata.get("VersionId") or self.source_table_version_id,
+            "updated": metadata.get("UpdateTime"),
+            "sql": hashlib.sha256(sql.encode()).hexdigest(),
+            "mapping": self.source_table.flat_mapping(),
+            "objects": [
+                s3_listing_digest(location) for location in self.source_locations()
+            ],
+        }
+        return hashlib.sha256(
+            json.dumps(parts, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def source_locations(self) -> List[str]:
+        """
+        :return: The source table location and the locations of source partitions
+            outside of it, e.g. partitions added with an explicit location
+        """
+        root = self.source_table.location().rstrip("/") + "/"
+        locations = {root}
+        if self.source_table.partition_keys():
+            for partition in self.source_table.partitions():
+                location = partition.get("StorageDescriptor", {}).get("Location")
+                if location and not (location.rstrip("/") + "/").startswith(root):
+                    locations.add(location.rstrip("/") + "/")
+        return sorted(locations)
+
+    def stored_fingerprint(self) -> Optional[str]:
+        """
+        :return: Fingerprint of the last successful full refresh of the target table
+        """
+        try:
+            return (
+                self.target_table.metadata.get("Parameters", {}).get(
+                    RUN_FINGERPRINT_PARAMETER
+                )
+                or None
+            )
+        except ValueError:
+            return None
+
+    def schema_diff(self) -> SchemaDiff:
+        """
+        :return: Changes between the columns of the target table and the flat source columns
+        """
+        serde = self.target_table.metadata["StorageDescriptor"].get("SerdeInfo", {})
+        diff = diff_schema(
+            self.target_table.columns(),
+            self.target_columns(),
+            parse=self.target_table.parse_type,
+            partition_keys=self.target_table.partition_keys(),
+            # Athena reads ORC files by column index instead of by name
+            by_index=serde.get("SerializationLibrary") == STORAGE_FORMATS["orc"].serde,
+        )
+        old_keys = [name.lower() for name, _ in self.target_table.partition_keys()]
+        new_keys = [name.lower() for name, _ in self.target_partition_keys()]
+        if old_keys != new_keys:
+            diff.changes.append(
+                ColumnChange(
+                    "incompatible",
+                    "partition keys",
+                    ", ".join(old_keys),
+                    ", ".join(new_keys),
+                    "the partitioning changed",
+                )
+            )
+        storage_descriptor = self.target_table.metadata["StorageDescriptor"]
+        old_buckets = [
+            name.lower() for name in storage_descriptor.get("BucketColumns") or []
+        ]
+        new_buckets = [name.lower() for name in self.output.bucketed_by]
+        old_count = storage_descriptor.get("NumberOfBuckets", -1)
+        # A derived bucket count follows the source size, only a configured one changes
+        if old_buckets != new_buckets or (
+            new_buckets and self.output.bucket_count not in (None, old_count)
+        ):
+            diff.changes.append(
+                ColumnChange(
+                    "incompatible",
+                    "bucketing",
+                    f"{', '.join(old_buckets)} ({old_count})" if old_buckets else "",
+                    f"{', '.join(new_buckets)} ({self.output.bucket_count or 'auto'})"
+                    if new_buckets
+                    else "",
+                    "the bucketing changed",
+                )
+            )
+        serde = storage_descriptor.get("SerdeInfo", {})
+        old_serde = serde.get("SerializationLibrary")
+        if old_serde and old_serde != self.output.storage.serde:
+            diff.changes.append(
+                ColumnChange(
+                    "incompatible",
+                    "format",
+                    old_serde,
+                    self.output.storage.serde,
+                    "the storage format changed",
+                )
+            )
+        return diff
+
+    def evolve_schema(self, dry_run=False) -> SchemaDiff:
+        """
+        Applies compatible schema changes of the source to the existing target table
+        in place, without rewriting its data
+        :param dry_run: Only report the changes
+        :return: The diff, incompatible diffs are never applied
+        """
+        diff = self.schema_diff()
+        logger.info(f"Schema of {self.target_table.full_name}: {diff.report()}")
+        if diff and diff.compatible and not dry_run:
+            self.target_table.update(columns=self.target_columns())
+        return diff
+
+    def _evolve_schema_in_place(self) -> None:
+        diff = self.evolve_schema()
+        if not diff.compatible:
+            raise ValueError(
+                f"The schema of {self.target_table.full_name} can't be changed in place, "
+                f"run a full refresh: {diff.report()}"
+            )
+
+    def run_location(self) -> Optional[str]:
+        """
+        :return: New versioned prefix for the data of this run in swap mode, None otherwise
+        """
+        if self.refresh_mode != "swap":
+            return None
+        version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        return f"{self.target_table_location.rstrip('/')}/{VERSION_PREFIX}{version}/"
+
+    @traced("swap_location")
+    def swap_location(self, location: str, parameters=None) -> None:
+        """
+        Points the target table to the data of a finished run and deletes old runs
+        in the background
+        :param location:
+        :param parameters: Table parameters set together with the location
+        """
+        logger.info(f"Pointing {self.target_table.full_name} to {location}.")
+        previous = self.target_table.location()
+        pre_swap_data = bool(
+            self.target_table.metadata.get("Parameters", {}).get(
+                PRE_SWAP_DATA_PARAMETER
+            )
+        )
+        if previous.rstrip("/") == self.target_table_location.rstrip("/"):
+            # First swap of a table that was flattened in purge mode before
+            parameters = {**(parameters or {}), PRE_SWAP_DATA_PARAMETER: "true"}
+            pre_swap_data = True
+        self.target_table.update(
+            columns=self.target_columns(),
+            location=location,
+            parameters=parameters,
+            partitions=self.target_partition_keys(),
+            bucket_columns=self.output.bucketed_by,
+            bucket_count=self.bucket_count(),
+        )
+        self.gc_thread = threading.Thread(
+            target=self.collect_old_versions,
+            args=(location, pre_swap_data),
+            name="flatten-version-gc",
+        )
+        self.gc_thread.start()
+
+    def collect_old_versions(self, current: str, pre_swap_data=False) -> None:
+        """
+        Deletes all but the newest keep_versions run prefixes, never the current one
+        :param pre_swap_data: The root of the location holds data written before the
+            first swap, everything outside of the run prefixes is deleted together
+            with the runs older than the kept ones
+        """
+        try:
+            s3_url_parts = splitted_s3_key(self.target_table_location)
+            bucket = s3_url_parts["bucket"]
+            base = s3_url_parts["path"].rstrip("/")
+            base = f"{base}/" if base else ""
+            paginator = s3_client.get_paginator("list_objects_v2")
+            prefixes = [
+                prefix["Prefix"]
+                for page in paginator.paginate(
+                    Bucket=bucket, Prefix=base, Delimiter="/"
+                )
+                for prefix in page.get("CommonPrefixes", [])
+            ]
+            versions = sorted(
+                prefix
+                for prefix in prefixes
+                if prefix[len(base) :].startswith(VERSION_PREFIX)
+            )
+            current_prefix = splitted_s3_key(current)["path"]
+            for prefix in versions[: -self.keep_versions]:
+                if prefix != current_prefix:
+                    logger.info(f"Deleting old version s3://{bucket}/{prefix}.")
+                    S3Purger(s3_client).purge(bucket, prefix)
+            if pre_swap_data and len(versions) >= self.keep_versions:
+                if not base:
+                    logger.warning(
+                        f"Not deleting the data written before the first swap, "
+                        f"it is in the root of the bucket {bucket}"
+                    )
+                    return
+                logger.info(
+                    f"Deleting the data written before the first swap "
+                    f"to s3://{bucket}/{base}."
+                )
+                S3Purger(s3_client).purge(bucket, base, recursive=False)
+                for prefix in prefixes:
+                    if not prefix[len(base) :].startswith(VERSION_PREFIX):
+                        S3Purger(s3_client).purge(bucket, prefix)
+        except Exception:
+            logger.exception("Deleting old versions failed")
+
+    def _target_layout(self) -> Tuple[List[tuple], List[tuple]]:
+        """
+        :return: Columns and partition columns of the flat table as
+            (source expression, name, type)
+        """
+        candidates = [
+            (col.source_name, col.target_name, col.type)
+            for col in self.source_table.flat_mapping()
+        ] + [
+            (f'"{name}"', name, type_)
+            for name, type_ in self.source_table.partition_keys()
+        ]
+        partitioned_by = [
+            name.lower()
+            for name in self.output.partitioned_by
+            or [name for name, _ in self.source_table.partition_keys()]
+        ]
+        by_name = {column[1].lower(): column for column in candidates}
+        missing = [name for name in partitioned_by if name not in by_name]
+        if missing:
+            raise ValueError(f"Partition columns {missing} are not flat columns")
+        columns = [
+            column for column in candidates if column[1].lower() not in partitioned_by
+        ]
+        return columns, [by_name[name] for name in partitioned_by]
+
+    def target_columns(self) -> List[tuple]:
+        return [(name, type_) for _, name, type_ in self._target_layout()[0]]
+
+    def target_partition_keys(self) -> List[tuple]:
+        return [(name, type_) for _, name, type_ in self._target_layout()[1]]
+
+    def bucket_count(self) -> Optional[int]:
+        """
+        :return: The configured bucket count or one that gives files of about
+            output.target_file_size, None without bucketing
+        """
+        if not self.output.bucketed_by:
+            return None
+        if self.output.bucket_count:
+            return self.output.bucket_count
+        if self._bucket_count is None:
+            source_bytes = table_size(self.source_table.metadata) or s3_listing_size(
+                self.source_table.location()
+            )
+            partitioned_by_source = self.target_partition_keys() == (
+                self.source_table.partition_keys()
+            )
+            partitions = (
+                len(self.source_table.partitions())
+                if partitioned_by_source and self.source_table.partition_keys()
+                else 1
+            )
+            self._bucket_count = bucket_count_for(
+                source_bytes,
+                partitions,
+                self.output.target_file_size,
+                self.output.compression_ratio,
+            )
+            logger.info(
+                f"Writing {self._bucket_count} buckets for {source_bytes} source bytes "
+                f"in {partitions} partitions."
+            )
+        return self._bucket_count
+
+    def _select_columns(self) -> List[tuple]:
+        # Partition columns go last, as CTAS and INSERT INTO expect them there
+        columns, partitions = self._target_layout()
+        return [(source, name) for source, name, _ in columns + partitions]
+
+    def _insert_overwrite_args(self, tmp_table, location=None, where=None) -> Dict:
+        return {
+            "tmp_table": tmp_table.full_name,
+            "source_tb_name": self.source_table.full_name,
+            "location": location or self.target_table.location(),
+            "columns": self._select_columns(),
+            "partitioned_by": [name for name, _ in self.target_partition_keys()],
+            "format": self.output.format,
+            "compression": self.output.compression,
+            "bucketed_by": self.output.bucketed_by,
+            "bucket_count": self.bucket_count(),
+            "where": where,
+        }
+
+    def insert_overwrite_statement(
+        self, tmp_table, location=None, where=None
+    ) -> Iterator[str]:
+        """
+        :return: Lines of the CTAS query writing the flat data of tmp_table
+        """
+        return create_table_as(
+            **self._insert_overwrite_args(tmp_table, location, where)
+        )
+
+    def generate_insert_overwrite_query(
+        self, tmp_table, location=None, where=None, pretty=False
+    ):
+        """
+        :param pretty: Render the sql template and format it with sqlparse instead of
+            building the formatted query directly
+        """
+        if pretty:
+            return query_gen(
+                template=resource_filename(
+                    __name__, os.path.join("create_flat_tmp_table_parquet.sql")
+                ),
+                query_args=self._insert_overwrite_args(tmp_table, location, where),
+            )
+        with span("query_gen", cpu=True, statement="create_table_as"):
+            return "".join(self.insert_overwrite_statement(tmp_table, location, where))
+
+    def _insert_into_args(self, where=None) -> Dict:
+        return {
+            "target_table": self.target_table.full_name,
+            "source_tb_name": self.source_table.full_name,
+            "columns": self._select_columns(),
+            "where": where,
+        }
+
+    def insert_into_statement(self, where=None) -> Iterator[str]:
+        """
+        :return: Lines of the INSERT INTO query appending flat data to the target table
+        """
+        return insert_into(**self._insert_into_args(where))
+
+    def generate_insert_into_query(self, where=None, pretty=False):
+        if pretty:
+            return query_gen(
+                template=resource_filename(
+                    __name__, os.path.join("insert_into_flat_table_parquet.sql")
+                ),
+                query_args=self._insert_into_args(where),
+            )
+        with span("query_gen", cpu=True, statement="insert_into"):
+            return "".join(self.insert_into_statement(where))
+
+    @property
+    def state_store(self) -> RunStateStore:
+        if self._state_store is None:
+            self._state_store = RunStateStore()
+        return self._state_store
+
+    def run_state(self) -> RunState:
+        return self.state_store.load(
+            self.source_table.full_name,
+            self.target_table.full_name,
+            self.target_table_location,
+        )
+
+    def temp_table(self, temp_db, run_id) -> GlueTable:
+        # Derived from the run, so that reruns find the temporary table of an interrupted run
+        return GlueTable(temp_db, f"tmp_flatten_{run_id}")
+
+    def shard_filters(self) -> List[str]:
+        """
+        :return: Where conditions of the shards of a full refresh,
+            empty if it runs as a single query
+        """
+        partition_keys = self.source_table.partition_keys()
+        partitions = self.source_table.partitions() if partition_keys else []
+        strategy = self.shard_by
+        if strategy == "auto":
+            strategy = "partition" if partition_keys else "path"
+
+        if strategy == "partition":
+            if not partition_keys:
+                raise ValueError(
+                    f"{self.source_table.full_name} has no partitions to shard by"
+                )
+            count = max(
+                self.shards, math.ceil(len(partitions) / MAX_PARTITIONS_PER_QUERY)
+            )
+            if count <= 1:
+                return []
+            if self.target_partition_keys() != partition_keys:
+                raise ValueError(
+                    f"Shards by partition would write the same partitions of "
+                    f"{self.target_table.full_name}, it isn't partitioned like "
+                    f"{self.source_table.full_name}"
+                )
+            values = sorted(tuple(partition["Values"]) for partition in partitions)
+            size = math.ceil(len(values) / count)
+            return [
+                " or ".join(
+                    f"({partition_filter(partition_keys, shard_values)})"
+                    for shard_values in values[i : i + size]
+                )
+                for i in range(0, len(values), size)
+            ]
+
+        if self.shards > 1 and self.target_partition_keys():
+            raise ValueError(
+                f"Shards by {strategy} would write the same partitions of "
+                f"{self.target_table.full_name}, shard it by partition"
+            )
+        if len(partitions) > MAX_PARTITIONS_PER_QUERY:
+            raise ValueError(
+                f"{self.source_table.full_name} has more than {MAX_PARTITIONS_PER_QUERY} "
+                "partitions, shard it by partition"
+            )
+        if self.shards <= 1:
+            return []
+        expression = '"$path"' if strategy == "path" else self.shard_key
+        bucket = (
+            f"abs(mod(from_big_endian_64(xxhash64(to_utf8(cast({expression} as varchar)))), "
+            f"{self.shards}))"
+        )
+        return [f"{bucket} = {i}" for i in range(self.shards)]
+
+    def shard_tables(self, temp_db, run_id, count) -> List[GlueTable]:
+        return [self.temp_table(temp_db, f"{run_id}_{i}") for i in range(count)]
+
+    def _run_shards(self, state: RunState, temp_db, location: str) -> None:
+        """
+        Runs one CTAS per shard into its own folder below the location, Athena reads
+        the folders of unpartitioned tables recursively. Failed shards are retried,
+        finished shards are recorded in the run state and skipped when resuming.
+        """
+        filters = state.get("shard_filters")
+        tables = self.shard_tables(temp_db, state.run_id, len(filters))
+        done = set(state.get("shards_done", []))
+        pending = [i for i in range(len(filters)) if i not in done]
+        attempts = {i: 0 for i in pending}
+        running = {}
+        logger.info(
+            f"Running {len(pending)} of {len(filters)} shards with up to "
+            f"{self.max_concurrent_queries} concurrent queries."
+        )
+
+        def submit(i):
+            shard_location = f"{location.rstrip('/')}/shard_{i:04d}/"
+            if tables[i].exists():
+                tables[i].delete()
+            # CTAS needs an empty location, a failed attempt may have written files
+            purge_location(shard_location)
+            future = self.submit(
+                self.generate_insert_overwrite_query(
+                    tables[i], shard_location, filters[i]
+                )
+            )
+            running[future] = i
+
+        try:
+            while pending or running:
+                while pending and len(running) < self.max_concurrent_queries:
+                    submit(pending.pop(0))
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                failed = None
+                for future in finished:
+                    i = running.pop(future)
+                    try:
+                        future.result()
+                    except (OperationalError, TimeoutError) as e:
+                        attempts[i] += 1
+                        if attempts[i] > self.shard_retries:
+                            failed = failed or e
+                            continue
+                        logger.warning(
+                            f"Shard {i} failed, retrying "
+                            f"({attempts[i]}/{self.shard_retries}): {e}"
+                        )
+                        pending.append(i)
+                    else:
+                        done.add(i)
+                        state.update(shards_done=sorted(done))
+                if failed:
+                    raise failed
+        except BaseException:
+            for future in running:
+                if not future.done():
+                    self.conn.cancel(future.query_id)
+            raise
+
+        if self.verify_shards:
+            self._verify_shards(tables)
+
+    def _verify_shards(self, tables: List[GlueTable]) -> None:
+        shard_rows = " union all ".join(
+            f"select count(*) as n from {table.full_name}" for table in tables
         )
+        with self.query_slots or nullcontext():
+            source_rows, flat_rows = self.conn.query(
+                f"select (select count(*) from {self.source_table.full_name}), "
+                f"(select sum(n) from ({shard_rows}))"
+            ).fetchone()
+        if source_rows != flat_rows:
+            raise ValueError(
+                f"The shards contain {flat_rows} rows, "
+                f"but {self.source_table.full_name} has {source_rows}"
+            )
+        logger.info(f"All {len(tables)} shards together contain {flat_rows} rows.")
+
+    def submit(self, sql: str) -> QueryFuture:
+        """
+        Starts a query, waits for a free query slot first if the flat table has some
+        :param sql:
+        :return: Future resolving to the AthenaQueryExecution
+        """
+        if self.query_slots is None:
+            return self.conn.submit(sql)
+        self.query_slots.acquire()
+        try:
+            future = self.conn.submit(sql)
+        except BaseException:
+            self.query_slots.release()
+            raise
+        future.add_done_callback(lambda _: self.query_slots.release())
+        return future
 
-    def insert_overwrite(self, temp_db=None) -> None:
+    def _resume(self, state: RunState) -> bool:
+        """
+        Reattaches to the query of an interrupted run
+        :return: True if the query of the interrupted run succeeded
+        """
+        if state.step == "succeeded":
+            logger.info("Query of the interrupted run succeeded already.")
+            return True
+        if state.step != "submitted" or state.get("shard_filters"):
+            return False
+        try:
+            self.conn.attach(state.get("query_id")).result()
+        except (OperationalError, TimeoutError) as e:
+            logger.warning(f"Query of the interrupted run failed, starting over: {e}")
+            return False
+        state.update(step="succeeded")
+        return True
+
+    def run_record(
+        self,
+        mode: str,
+        status: str,
+        error: Optional[str],
+        started: datetime,
+        seconds: float,
+        queries: List[QueryStats],
+    ) -> Dict:
+        """
+        :return: Ledger record of a run, runs without queries are "skipped"
+        """
+        if status == "succeeded" and not queries:
+            status = "skipped"
+        # Only CTAS and INSERT INTO queries write rows, their statistics are fetched
+        # concurrently since every query needs its own request
+        query_ids = [query.query_id for query in queries if query.writes]
+        output_rows = {}
+        if query_ids:
+            with ThreadPoolExecutor(
+                max_workers=min(len(query_ids), self.max_concurrent_queries)
+            ) as executor:
+                output_rows = dict(
+                    zip(query_ids, executor.map(self.conn.output_rows, query_ids))
+                )
+        queries = [
+            query._replace(output_rows=output_rows.get(query.query_id))
+            for query in queries
+        ]
+        target_files, target_bytes = None, None
+        if status == "succeeded" and self.ledger.list_target:
+            try:
+                target_files, target_bytes = s3_listing_totals(
+                    self.target_table.location()
+                )
+            except ClientError as e:
+                logger.warning(f"Listing the flat files failed: {e}")
+        return {
+            "run_id": uuid.uuid4().hex,
+            "started": started.isoformat(),
+            "seconds": round(seconds, 3),
+            "mode": mode,
+            "source_table": self.source_table.full_name,
+            "target_table": self.target_table.full_name,
+            "status": status,
+            "error": error,
+            **summarize(queries),
+            "target_files": target_files,
+            "target_bytes": target_bytes,
+            "query_stats": [query._asdict() for query in queries],
+        }
+
+    @recorded("overwrite")
+    @traced("insert_overwrite")
+    def insert_overwrite(self, temp_db=None, resume=True, force=False) -> None:
         """
         This functions first creates a temporary table with a s3 location equal to the "target" table for the
         specified partition.
         Existing files in the target table are removed in the refresh_target_table().
+        Every step is recorded in the run state, an interrupted run is resumed by reattaching
+        to its query instead of purging the target and running the query again.
         :param temp_db:
+        :param resume: Resume an interrupted run, otherwise start over
+        :param force: Flatten even if nothing changed since the last successful run
         :return:
         """
         assert self.source_table.columns() is not None
+        annotate(source=self.source_table.full_name, target=self.target_table.full_name)
 
-        self.refresh_target_table()
-        logger.info("Creating temporary table for data transformation.")
         if not temp_db:
             temp_db = self.database
+        state = self.run_state()
+        temp_table_glue = self.temp_table(temp_db, state.run_id)
+
+        if state.step and resume:
+            logger.info(
+                f"Resuming run from step {state.step} ({state.get('updated')})."
+            )
+            succeeded = self._resume(state)
+            fingerprint = state.get("fingerprint")
+        else:
+            succeeded = False
+            # A forced run doesn't list the source, it clears the stored fingerprint
+            fingerprint = None if force else self.run_fingerprint()
+            if not force and fingerprint == self.stored_fingerprint():
+                logger.info(
+                    f"{self.source_table.full_name} is unchanged since the last run "
+                    f"of {self.target_table.full_name}, use --force to flatten it anyway."
+                )
+                return
 
-        temp_table_name = "".join(random.choices(string.ascii_uppercase, k=10))
-        temp_table_glue = GlueTable(temp_db, temp_table_name)
+        # Taken before the data is written, a partition changing meanwhile is
+        # flattened again by the next incremental run
+        source_fingerprints = self.source_partition_fingerprints()
+        source_files = (
+            None if self.source_table.partition_keys() else self.source_objects()
+        )
+        if not succeeded and resume and state.get("shard_filters"):
+            logger.info("Continuing the unfinished shards of the interrupted run.")
+            self._run_shards(
+                state, temp_db, state.get("location") or self.target_table.location()
+            )
+            state.update(step="succeeded")
+        elif not succeeded:
+            state.clear()
+            state.update(step="started", fingerprint=fingerprint)
+            location = self.run_location()
+            shard_filters = self.shard_filters()
+            self.refresh_target_table(location=location)
+            state.update(step="refreshed", location=location)
+            if shard_filters:
+                state.update(step="submitted", shard_filters=shard_filters)
+                self._run_shards(
+                    state, temp_db, location or self.target_table.location()
+                )
+            else:
+                logger.info("Creating temporary table for data transformation.")
+                if temp_table_glue.exists():
+                    temp_table_glue.delete()
 
-        if temp_table_glue.exists():
-            temp_table_glue.delete()
+                future = self.submit(
+                    self.generate_insert_overwrite_query(temp_table_glue, location)
+                )
+                state.update(step="submitted", query_id=future.query_id)
+                try:
+                    future.result()
+                except KeyboardInterrupt:
+                    self.conn.cancel(future.query_id)
+                    raise
+            state.update(step="succeeded")
 
-        self.conn.query(self.generate_insert_overwrite_query(temp_table_glue))
-        logger.info("Deleting temporary table.")
-        temp_table_glue.delete()
+        temp_tables = [
+            table
+            for table in self.shard_tables(
+                temp_db, state.run_id, len(state.get("shard_filters") or [])
+            )
+            or [temp_table_glue]
+            if table.exists()
+        ]
+        if self.target_partition_keys() and temp_tables:
+            logger.info("Registering the partitions of the temporary tables.")
+            self.target_table.replace_partitions(
+                self.fingerprinted(
+                    [
+                        partition
+                        for table in temp_tables
+                        for partition in table.partitions()
+                    ],
+                    source_fingerprints,
+                )
+            )
+        logger.info("Deleting temporary tables.")
+        with span("cleanup", tables=len(temp_tables)):
+            for table in temp_tables:
+                table.delete()
+        if source_files is not None:
+            self.record_source_files(source_files)
+        parameters = {RUN_FINGERPRINT_PARAMETER: fingerprint or ""}
+        if state.get("location"):
+            self.swap_location(state.get("location"), parameters)
+        else:
+            self.target_table.update(parameters=parameters)
+        state.clear()
         logger.info(f"Successfully flattend {self.source_table.full_name}!")
         logger.info(
             f"You can find the flattend table in athena {self.target_table.full_name}"
         )
+
+    def source_partition_fingerprints(self) -> Dict[Tuple[str, ...], str]:
+        """
+        :return: Fingerprints of the source partitions by partition values, empty if
+            the flat table isn't partitioned like the source
+        """
+        partition_keys = self.source_table.partition_keys()
+        if not partition_keys or self.target_partition_keys() != partition_keys:
+            return {}
+        return {
+            tuple(partition["Values"]): partition_fingerprint(partition)
+            for partition in self.source_table.partitions()
+        }
+
+    @staticmethod
+    def fingerprinted(
+        partitions: List[Dict], fingerprints: Dict[Tuple[str, ...], str]
+    ) -> List[Dict]:
+        """
+        :return: The target partitions with the fingerprints of their source partitions,
+            so that incremental runs skip them
+        """
+        result = []
+        for partition in partitions:
+            fingerprint = fingerprints.get(tuple(partition["Values"]))
+            if fingerprint:
+                partition = {
+                    **partition,
+                    "Parameters": {
+                        **partition.get("Parameters", {}),
+                        FINGERPRINT_PARAMETER: fingerprint,
+                    },
+                }
+            result.append(partition)
+        return result
+
+    @recorded("incremental")
+    @traced("insert_incremental")
+    def insert_incremental(
+        self, detect_changes="glue", max_concurrent_queries=None
+    ) -> List[Tuple[str, ...]]:
+        """
+        Flattens only the new or changed partitions of a partitioned source table with one
+        INSERT INTO query per partition. The fingerprint of every flattened source partition
+        is stored in the parameters of its target partition, partitions whose query failed
+        or was interrupted are flattened again by the next run.
+        Unpartitioned sources are handed to insert_new_files.
+        :param detect_changes: "glue" compares the glue metadata of the source partitions,
+            "s3" also lists their objects to notice files added without updating glue
+        :param max_concurrent_queries: Maximum number of partition queries in flight,
+            defaults to the one of the instance
+        :return: Values of the flattened partitions (keys of the flattened files)
+        """
+        if self.refresh_mode == "swap":
+            raise ValueError(
+                "Incremental flattening writes into the live table and can't be swapped"
+            )
+        if detect_changes not in ("glue", "s3"):
+            raise ValueError(f"Unknown change detection {detect_changes}")
+        if self.output.bucketed_by:
+            raise ValueError("Athena can't INSERT INTO bucketed tables")
+        max_concurrent_queries = max_concurrent_queries or self.max_concurrent_queries
+        partition_keys = self.source_table.partition_keys()
+        if not partition_keys:
+            return self.insert_new_files()
+        if self.target_partition_keys() != partition_keys:
+            raise ValueError(
+                "Incremental flattening needs the partitioning of the source table"
+            )
+        if not self.target_table.exists():
+            self.refresh_target_table()
+        else:
+            self._evolve_schema_in_place()
+
+        target_partitions = {
+            tuple(partition["Values"]): partition
+            for partition in self.target_table.partitions()
+        }
+        source_partitions = self.source_table.partitions()
+        changed = []
+        for partition in source_partitions:
+            values = tuple(partition["Values"])
+            fingerprint = partition_fingerprint(
+                partition, s3_listing=detect_changes == "s3"
+            )
+            target = target_partitions.get(values, {})
+            if target.get("Parameters", {}).get(FINGERPRINT_PARAMETER) != fingerprint:
+                changed.append((values, fingerprint))
+        logger.info(
+            f"{len(changed)} of {len(source_partitions)} partitions of "
+            f"{self.source_table.full_name} are new or changed."
+        )
+
+        running = {}
+        flattened = {}
+        errors = []
+
+        def collect(done):
+            for future in done:
+                values, fingerprint = running.pop(future)
+                try:
+                    future.result()
+                except (OperationalError, TimeoutError) as e:
+                    logger.error(f"Flattening partition {values} failed: {e}")
+                    errors.append(e)
+                else:
+                    flattened[values] = {FINGERPRINT_PARAMETER: fingerprint}
+
+        try:
+            for values, fingerprint in changed:
+                if len(running) >= max_concurrent_queries:
+                    collect(wait(running, return_when=FIRST_COMPLETED).done)
+                if values in target_partitions:
+                    # INSERT INTO appends, so the outdated data has to go first
+                    purge_location(
+                        target_partitions[values]["StorageDescriptor"]["Location"]
+                    )
+                future = self.submit(
+                    self.generate_insert_into_query(
+                        partition_filter(partition_keys, values)
+                    )
+                )
+                running[future] = (values, fingerprint)
+            collect(wait(running).done)
+        except KeyboardInterrupt:
+            for future in running:
+                self.conn.cancel(future.query_id)
+            raise
+        finally:
+            if flattened:
+                self.target_table.update_partition_parameters(flattened)
+
+        if errors:
+            raise errors[0]
+        logger.info(
+            f"Flattened {len(flattened)} partitions into {self.target_table.full_name}."
+        )
+        return list(flattened)
+
+    @property
+    def file_manifest(self) -> str:
+        if self._file_manifest is None:
+            directory = os.path.join(cache_dir(), "manifests")
+            os.makedirs(directory, exist_ok=True)
+            self._file_manifest = os.path.join(
+                directory, f"{self.run_state().run_id}.json.gz"
+            )
+        return self._file_manifest
+
+    def source_objects(self) -> List[Tuple[str, str]]:
+        """
+        :return: (key, etag) of all files under the source location that Athena reads
+        """
+        s3_url_parts = splitted_s3_key(self.source_table.location())
+        prefix = s3_url_parts["path"]
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        paginator = s3_client.get_paginator("list_objects_v2")
+        return [
+            (obj["Key"], obj["ETag"])
+            for page in paginator.paginate(Bucket=s3_url_parts["bucket"], Prefix=prefix)
+            for obj in page.get("Contents", [])
+            # Athena skips folder markers and files starting with _ or .
+            if not obj["Key"].endswith("/")
+            and not obj["Key"].rsplit("/", 1)[-1].startswith(("_", "."))
+        ]
+
+    def record_source_files(self, objects: List[Tuple[str, str]]) -> None:
+        """
+        Replaces the file manifest with the source files of a full refresh,
+        the next incremental run only appends files that were added since
+        :param objects: (key, etag) of the source files, listed before the refresh
+        """
+        logger.info(
+            f"Recording {len(objects)} flattened files in {self.file_manifest}."
+        )
+        ObjectManifest(objects).save(self.file_manifest, s3_client)
+
+    @recorded("new_files")
+    @traced("insert_new_files")
+    def insert_new_files(self) -> List[str]:
+        """
+        Appends the rows of source files that were not flattened yet to the target table,
+        for unpartitioned sources that only ever receive new files. The flattened files are
+        recorded with their ETags in the file manifest, the new files are selected with
+        "$path" filters of up to MAX_FILES_PER_QUERY files per INSERT INTO.
+        Files whose content changed are flattened again, their old rows stay in the target.
+        An existing target with an empty manifest, e.g. on a new machine, is refused or
+        rebuilt with a full refresh if rebuild_manifest is set.
+        :return: Keys of the flattened files
+        """
+        if self.refresh_mode == "swap":
+            raise ValueError(
+                "Incremental flattening writes into the live table and can't be swapped"
+            )
+        if self.output.bucketed_by:
+            raise ValueError("Athena can't INSERT INTO bucketed tables")
+        manifest = ObjectManifest.load(self.file_manifest, s3_client)
+        if not self.target_table.exists():
+            # Files recorded for an earlier, deleted target table are flattened again
+            manifest = ObjectManifest()
+            self.refresh_target_table()
+        elif not manifest:
+            if not self.rebuild_manifest:
+                raise ValueError(
+                    f"The file manifest {self.file_manifest} of "
+                    f"{self.target_table.full_name} is empty, appending all files "
+                    "would duplicate the flattened rows. Pass the manifest of the "
+                    "earlier runs or rebuild it with a full refresh (--rebuild-manifest)."
+                )
+            logger.warning(
+                f"The file manifest {self.file_manifest} is empty, rebuilding it "
+                "with a full refresh."
+            )
+            self.insert_overwrite(force=True)
+            return ObjectManifest.load(self.file_manifest, s3_client).keys
+        else:
+            self._evolve_schema_in_place()
+        bucket = splitted_s3_key(self.source_table.location())["bucket"]
+        objects = self.source_objects()
+        new_objects = manifest.diff(objects)
+        changed = sum(1 for key, _ in new_objects if manifest.get(key) is not None)
+        logger.info(
+            f"{len(new_objects)} of {len(objects)} files of "
+            f"{self.source_table.full_name} are new or changed."
+        )
+        if changed:
+            logger.warning(
+                f"{changed} flattened files changed, their old rows stay in the target."
+            )
+
+        batches = [
+            new_objects[i : i + MAX_FILES_PER_QUERY]
+            for i in range(0, len(new_objects), MAX_FILES_PER_QUERY)
+        ]
+        running = {}
+        flattened = []
+        errors = []
+
+        def collect(done):
+            for future in done:
+                batch = running.pop(future)
+                try:
+                    future.result()
+                except (OperationalError, TimeoutError) as e:
+                    logger.error(f"Flattening {len(batch)} files failed: {e}")
+                    errors.append(e)
+                else:
+                    flattened.extend(batch)
+
+        try:
+            for batch in batches:
+                if len(running) >= self.max_concurrent_queries:
+                    collect(wait(running, return_when=FIRST_COMPLETED).done)
+                paths = ", ".join(
+                    "'s3://{}/{}'".format(bucket, key.replace("'", "''"))
+                    for key, _ in batch
+                )
+                future = self.submit(
+                    self.generate_insert_into_query(f'"$path" in ({paths})')
+                )
+                running[future] = batch
+            collect(wait(running).done)
+        except KeyboardInterrupt:
+            for future in running:
+                self.conn.cancel(future.query_id)
+            raise
+        finally:
+            if flattened:
+                manifest.update(flattened)
+                manifest.save(self.file_manifest, s3_client)
+
+        if errors:
+            raise errors[0]
+        logger.info(
+            f"Flattened {len(flattened)} files into {self.target_table.full_name}."
+        )
+        return [key for key, _ in flattened]
@@ -0,0 +1,85 @@
+from abc import ABC
+from abc import abstractmethod
+
+import boto3
+from flatten import aws
+from flatten.aws import AthenaConnection
+from flatten.aws import GlueTable
+from flatten.aws import splitted_s3_key
+from flatten.aws import ToFlatParquet
+
+
+class Backend(ABC):
+    """
+    Catalog, object storage and query engine behind GlueTable, purge_location and
+    ToFlatParquet. The catalog and the storage are accessed through clients with the
+    interface of the boto3 glue and s3 clients, the queries through an AthenaConnection.
+    """
+
+    @abstractmethod
+    def glue_client(self):
+        """
+        :return: Client with the interface of the boto3 glue client
+        """
+
+    @abstractmethod
+    def s3_client(self):
+        """
+        :return: Client with the interface of the boto3 s3 client
+        """
+
+    @abstractmethod
+    def connection(self, database, workgroup, s3_staging_dir) -> AthenaConnection:
+        """
+        :return: Connection running the queries of a ToFlatParquet
+        """
+
+    @abstractmethod
+    def arrow_filesystem(self, location: str):
+        """
+        :param location: s3://bucket/prefix
+        :return: pyarrow FileSystem and path of the location, used by the arrow engine
+        """
+
+
+class AwsBackend(Backend):
+    """Glue, S3 and Athena of the configured AWS account"""
+
+    def glue_client(self):
+        return boto3.client("glue")
+
+    def s3_client(self):
+        return boto3.client("s3")
+
+    def connection(self, database, workgroup, s3_staging_dir) -> AthenaConnection:
+        return AthenaConnection(
+            database=database, workgroup=workgroup, s3_staging_dir=s3_staging_dir
+        )
+
+    def arrow_filesystem(self, location: str):
+        from pyarrow import fs
+
+        s3_url_parts = splitted_s3_key(location)
+        return (
+            fs.S3FileSystem(region=boto3.session.Session().region_name),
+            f"{s3_url_parts['bucket']}/{s3_url_parts['path']}",
+        )
+
+
+_backend: Backend = AwsBackend()
+
+
+def use_backend(backend: Backend) -> None:
+    """
+    Switches all tables, purges and flatten runs created afterwards to the backend
+    """
+    global _backend
+    _backend = backend
+    GlueTable.glue_client = backend.glue_client()
+    GlueTable.metadata_cache.clear()
+    aws.s3_client = backend.s3_client()
+    ToFlatParquet.connection_factory = backend.connection
+
+
+def current_backend() -> Backend:
+    return _backend
@@ -0,0 +1,246 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+from flatten.aws import GlueTable
+from flatten.aws import table_size
+from flatten.aws import ToFlatParquet
+from loguru import logger
+
+
+class FlattenJob(NamedTuple):
+    source_table: str
+    target_table: str
+    target_table_location: str
+    size: int = 0
+
+
+class FlattenResult(NamedTuple):
+    job: FlattenJob
+    succeeded: bool
+    seconds: float
+    error: Optional[str] = None
+
+
+def target_location(location_prefix: str, target_table: str) -> str:
+    return f"{location_prefix.rstrip('/')}/{target_table}/"
+
+
+def load_manifest(path: str) -> List[Dict]:
+    """
+    Reads a JSON or YAML manifest of the form
+    {"tables": [{"source": "raw_a", "target": "flat_a", "location": "s3://..."}, ...]}
+    Only "source" is required.
+    :param path:
+    :return: List of table entries
+    """
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError(
+                    "Reading YAML manifests requires pyyaml, "
+                    "install flatten-athena-table[yaml]"
+                )
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    tables = manifest.get("tables") if isinstance(manifest, dict) else manifest
+    if not isinstance(tables, list):
+        raise ValueError(f"Manifest {path} has no list of tables")
+    entries = []
+    for table in tables:
+        if isinstance(table, str):
+            table = {"source": table}
+        if "source" not in table:
+            raise ValueError(f"Manifest entry {table} has no source table")
+        entries.append(table)
+    return entries
+
+
+def plan_jobs(
+    tables: List[Dict],
+    location_prefix: str,
+    include=("*",),
+    exclude=(),
+    target_prefix="flat_",
+    manifest: Optional[List[Dict]] = None,
+) -> List[FlattenJob]:
+    """
+    Creates the jobs for a batch, largest source tables first
+    :param tables: Glue metadata of the tables in the database
+    :param location_prefix: S3 prefix of the target tables, each table gets its own folder
+    :param include: Glob patterns of source tables to flatten
+    :param exclude: Glob patterns of source tables to skip
+    :param target_prefix: Prefix of the target table names
+    :param manifest: Manifest entries, replaces include and exclude
+    :return:
+    """
+    metadata = {table["Name"]: table for table in tables}
+    jobs = []
+    if manifest is not None:
+        for entry in manifest:
+            source = entry["source"]
+            if source not in metadata:
+                raise ValueError(f"Glue Table {source} not found")
+            target = entry.get("target", f"{target_prefix}{source}")
+            jobs.append(
+                FlattenJob(
+                    source_table=source,
+                    target_table=target,
+                    target_table_location=entry.get(
+                        "location", target_location(location_prefix, target)
+                    ),
+                    size=table_size(metadata[source]),
+                )
+            )
+    else:
+        for name, table in metadata.items():
+            if table.get("TableType") == "VIRTUAL_VIEW":
+                continue
+            if not any(fnmatchcase(name, pattern) for pattern in include):
+                continue
+            if any(fnmatchcase(name, pattern) for pattern in exclude):
+                continue
+            target = f"{target_prefix}{name}"
+            jobs.append(
+                FlattenJob(
+                    source_table=name,
+                    target_table=target,
+                    target_table_location=target_location(location_prefix, target),
+                    size=table_size(table),
+                )
+            )
+        # Don't flatten the targets of this batch (e.g. from a previous run) again
+        targets = {job.target_table for job in jobs}
+        jobs = [job for job in jobs if job.source_table not in targets]
+
+    return sorted(jobs, key=lambda job: job.size, reverse=True)
+
+
+class BatchFlattener:
+    """
+    Flattens many tables of a database concurrently.
+    Every worker runs one flatten at a time and all flattens share concurrency query
+    slots, so concurrency limits the number of Athena queries in flight, including
+    the shards and partition queries of every table.
+    """
+
+    def __init__(
+        self,
+        database,
+        workgroup,
+        s3_staging_dir,
+        concurrency=5,
+        temp_db=None,
+        resume=True,
+        force=False,
+        projection=None,
+        incremental=False,
+        detect_changes="glue",
+        file_manifests=None,
+        **flatten_options,
+    ):
+        """
+        :param force: Flatten tables whose source is unchanged since their last run
+        :param projection: ColumnProjection applied to every source table
+        :param incremental: Flatten only new or changed partitions
+        :param detect_changes: Change detection of incremental runs, "glue" or "s3"
+        :param file_manifests: Local directory or s3 prefix of the file manifests,
+            one <target_table>.json.gz per table, defaults to the cache directory
+        :param flatten_options: Further arguments of ToFlatParquet, e.g. refresh_mode
+        """
+        self.database = database
+        self.workgroup = workgroup
+        self.s3_staging_dir = s3_staging_dir
+        self.concurrency = concurrency
+        self.query_slots = threading.BoundedSemaphore(concurrency)
+        self.temp_db = temp_db
+        self.resume = resume
+        self.force = force
+        self.projection = projection
+        self.incremental = incremental
+        self.detect_changes = detect_changes
+        self.file_manifests = file_manifests
+        self.flatten_options = flatten_options
+
+    def file_manifest(self, job: FlattenJob) -> Optional[str]:
+        if self.file_manifests is None:
+            return None
+        if self.file_manifests.startswith("s3://"):
+            return f"{self.file_manifests.rstrip('/')}/{job.target_table}.json.gz"
+        os.makedirs(self.file_manifests, exist_ok=True)
+        return os.path.join(self.file_manifests, f"{job.target_table}.json.gz")
+
+    def run_job(self, job: FlattenJob) -> FlattenResult:
+        start = time.monotonic()
+        try:
+            flat_table = ToFlatParquet(
+                database=self.database,
+                source_table=GlueTable(
+                    self.database, job.source_table, projection=self.projection
+                ),
+                target_table=GlueTable(self.database, job.target_table),
+                target_table_location=job.target_table_location,
+                workgroup=self.workgroup,
+                s3_staging_dir=self.s3_staging_dir,
+                file_manifest=self.file_manifest(job),
+                query_slots=self.query_slots,
+                **self.flatten_options,
+            )
+            if self.incremental:
+                flat_table.insert_incremental(detect_changes=self.detect_changes)
+            else:
+                flat_table.insert_overwrite(
+                    temp_db=self.temp_db, resume=self.resume, force=self.force
+                )
+        except Exception as e:
+            logger.exception(f"Flattening {job.source_table} failed")
+            return FlattenResult(job, False, time.monotonic() - start, repr(e))
+        return FlattenResult(job, True, time.monotonic() - start)
+
+    def run(self, jobs: List[FlattenJob]) -> List[FlattenResult]:
+        """
+        Runs the jobs in the given order and continues past failures
+        :param jobs:
+        :return: Results in the order of the jobs
+        """
+        logger.info(
+            f"Flattening {len(jobs)} tables with at most {self.concurrency} "
+            "concurrent queries."
+        )
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {
+                executor.submit(self.run_job, job): i for i, job in enumerate(jobs)
+            }
+            results = [None] * len(jobs)
+            for done, future in enumerate(as_completed(futures), start=1):
+                result = future.result()
+                results[futures[future]] = result
+                logger.info(
+                    f"{done}/{len(jobs)} {result.job.source_table}: "
+                    f"{'succeeded' if result.succeeded else 'failed'} "
+                    f"after {result.seconds:.1f}s"
+                )
+        return results
+
+
+def summary(results: List[FlattenResult]) -> str:
+    failed = [result for result in results if not result.succeeded]
+    lines = [
+        f"Flattened {len(results) - len(failed)}/{len(results)} tables "
+        f"({sum(result.seconds for result in results):.1f}s total job time)."
+    ]
+    for result in failed:
+        lines.append(f"FAILED {result.job.source_table}: {result.error}")
+    return "\n".join(lines)
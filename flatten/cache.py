@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any
+from typing import Callable
+from typing import Dict
+
+from loguru import logger
+
+# Bump when the structure of cached values changes, invalidates old disk entries
+CACHE_VERSION = "1"
+
+_MISSING = object()
+
+
+class TieredCache:
+    """
+    Content-addressed cache with an in-memory LRU tier and an optional on-disk tier.
+    Values have to be JSON serializable to be stored on disk.
+    """
+
+    def __init__(self, maxsize=4096, directory=None, max_disk_bytes=256 * 1024 * 1024):
+        """
+        :param maxsize: Number of entries kept in memory
+        :param directory: Directory of the on-disk tier, disabled if None
+        :param max_disk_bytes: Size of the on-disk tier before the oldest entries are evicted
+        """
+        self.maxsize = maxsize
+        self.directory = None
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if directory:
+            self.attach_disk(directory, max_disk_bytes)
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha256(
+            "\x1f".join([CACHE_VERSION, *map(str, parts)]).encode()
+        ).hexdigest()
+
+    def attach_disk(self, directory: str, max_disk_bytes=None) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        if max_disk_bytes is not None:
+            self.max_disk_bytes = max_disk_bytes
+        self._disk_bytes = sum(entry.stat().st_size for entry in self._disk_entries())
+
+    def get(self, key: str, default=None) -> Any:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+        value = self._disk_get(key)
+        with self._lock:
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.disk_hits += 1
+            self._memory_set(key, value)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._memory_set(key, value)
+        self._disk_set(key, value)
+
+    def get_or_set(self, key: str, factory: Callable[[], Any]) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        for entry in self._disk_entries():
+            os.remove(entry.path)
+        self._disk_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+            "disk_bytes": self._disk_bytes,
+        }
+
+    def _memory_set(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _disk_entries(self):
+        if not self.directory:
+            return []
+        return [
+            entry
+            for entry in os.scandir(self.directory)
+            if entry.is_file() and entry.name.endswith(".json")
+        ]
+
+    def _disk_get(self, key):
+        if not self.directory:
+            return _MISSING
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return _MISSING
+        # Reading refreshes the mtime so that eviction drops the least recently used entries
+        os.utime(path)
+        return value
+
+    def _disk_set(self, key, value):
+        if not self.directory:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(value, f, separators=(",", ":"))
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.debug(f"Could not write cache entry {key}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._disk_bytes += size
+        if self._disk_bytes > self.max_disk_bytes:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        entries = sorted(self._disk_entries(), key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_disk_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self.evictions += 1
+        self._disk_bytes = total
@@ -1,8 +1,108 @@
+import os
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List
+from typing import Optional
+
+import click
 import typer
+from flatten.arrow import ArrowFlattener
+from flatten.arrow import BATCH_SIZE
 from flatten.aws import GlueTable
 from flatten.aws import ToFlatParquet
+from flatten.backend import use_backend
+from flatten.batch import BatchFlattener
+from flatten.batch import load_manifest
+from flatten.batch import plan_jobs
+from flatten.batch import summary
+from flatten.ledger import format_trends
+from flatten.ledger import RunLedger
+from flatten.ledger import table_trends
+from flatten.local import LocalBackend
+from flatten.output import OutputOptions
+from flatten.projection import ColumnProjection
+from flatten.sql import write_sql
+from flatten.tracing import disable_tracing
+from flatten.tracing import enable_tracing
+from flatten.tracing import TRACE_FORMATS
+from flatten.utils import cache_dir
+from flatten.vertical import MAX_COLUMNS
+from flatten.vertical import MAX_SQL_BYTES
+from flatten.vertical import VerticalSplit
+from loguru import logger
+
+
+class DefaultCommandGroup(click.Group):
+    """
+    Runs the "table" command if the first argument is no command,
+    so that `flatten <database> <source_table> ...` keeps working
+    """
+
+    default_command = "table"
+
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and not args[0].startswith("-"):
+            args.insert(0, self.default_command)
+        return super().parse_args(ctx, args)
+
+
+app = typer.Typer(cls=DefaultCommandGroup)
+
+ENGINES = ("athena", "arrow")
+
 
+def output_options(
+    format, compression, partitioned_by, bucketed_by, bucket_count, target_file_size
+) -> OutputOptions:
+    return OutputOptions(
+        format=format,
+        compression=compression,
+        partitioned_by=tuple(partitioned_by),
+        bucketed_by=tuple(bucketed_by),
+        bucket_count=bucket_count,
+        target_file_size=target_file_size * 1024 * 1024,
+    )
+
+
+@contextmanager
+def tracing(trace: Optional[str], trace_format: str, profile: bool, profile_dir):
+    """
+    Traces the phases of the flatten runs in the block, writes the trace to the path
+    trace and the profiles of the CPU phases to profile_dir
+    """
+    if trace_format not in TRACE_FORMATS:
+        raise ValueError(
+            f"Unknown trace format {trace_format}, use one of {TRACE_FORMATS}"
+        )
+    if not trace and not profile:
+        yield
+        return
+    active = enable_tracing(profile=profile)
+    try:
+        yield
+    finally:
+        # Disabling stops tracemalloc, so the memory profile is saved before
+        try:
+            if trace:
+                active.save(trace, trace_format)
+                logger.info(f"Wrote the trace to {trace}.")
+            if profile:
+                directory = profile_dir or os.path.join(
+                    cache_dir(), "profiles", datetime.now().strftime("%Y%m%dT%H%M%S")
+                )
+                for path in active.save_profile(directory):
+                    logger.info(f"Wrote the profile {path}.")
+        finally:
+            disable_tracing()
+
+
+def use_disk_cache():
+    GlueTable.type_cache.attach_disk(os.path.join(cache_dir(), "types"))
+    GlueTable.mapping_cache.attach_disk(os.path.join(cache_dir(), "mappings"))
 
+
+@app.command("table")
 def main(
     database: str = typer.Argument(..., help="The name of glue database"),
     source_table: str = typer.Argument(
@@ -21,22 +121,548 @@ def main(
     workgroup: str = typer.Option(
         "primary", help="The athena workspace, if you use them"
     ),
+    disk_cache: bool = typer.Option(
+        False, help="Persist parsed column types and flat mappings on disk"
+    ),
+    resume: bool = typer.Option(
+        True, help="Resume an interrupted run instead of starting over"
+    ),
+    force: bool = typer.Option(
+        False, help="Flatten even if the source is unchanged since the last run"
+    ),
+    refresh_mode: str = typer.Option(
+        "purge",
+        help='"purge" deletes the old data first, "swap" writes to a new prefix '
+        "and switches the table to it when the data is complete",
+    ),
+    keep_versions: int = typer.Option(
+        2, help="Number of data versions kept in swap mode"
+    ),
+    incremental: bool = typer.Option(
+        False, help="Flatten only new or changed partitions of partitioned tables"
+    ),
+    detect_changes: str = typer.Option(
+        "glue",
+        help='How incremental runs detect changed partitions, "glue" metadata or '
+        '"s3" object listings',
+    ),
+    shards: int = typer.Option(
+        1, help="Split a full refresh into this many concurrent queries"
+    ),
+    shard_by: str = typer.Option(
+        "auto",
+        help='Split the source by "partition" ranges, "path" (file) buckets or '
+        '"hash" of --shard-key, "auto" uses partitions if there are any',
+    ),
+    shard_key: Optional[str] = typer.Option(
+        None, help="Column that is hashed to split the source with --shard-by hash"
+    ),
+    verify_shards: bool = typer.Option(
+        False, help="Compare the row counts of source and shards (scans the source)"
+    ),
+    select: List[str] = typer.Option(
+        [],
+        help='Column path pattern, e.g. "payload.device.*", prefix with "!" to exclude, '
+        "can be repeated",
+    ),
+    file_manifest: Optional[str] = typer.Option(
+        None,
+        help="Local path or s3 url of the manifest of flattened files, used by "
+        "incremental runs over unpartitioned tables",
+    ),
+    rebuild_manifest: bool = typer.Option(
+        False,
+        help="Rebuild an empty manifest of an existing flat table with a full refresh, "
+        "instead of refusing the incremental run",
+    ),
+    row_key: List[str] = typer.Option(
+        [],
+        help="Flat column identifying a row, can be repeated. Splits very wide tables "
+        "into several tables of at most --max-columns columns sharing this key",
+    ),
+    max_columns: int = typer.Option(
+        MAX_COLUMNS, help="Maximum number of columns per table when splitting"
+    ),
+    max_sql_bytes: int = typer.Option(
+        MAX_SQL_BYTES, help="Maximum size of the select list per table when splitting"
+    ),
+    join_view: bool = typer.Option(
+        True, help="Create a view named like the target table joining the split tables"
+    ),
+    format: str = typer.Option("parquet", help='"parquet" or "orc"'),
+    compression: str = typer.Option(
+        "SNAPPY", help='Codec of the flat files, e.g. "ZSTD", "SNAPPY" or "GZIP"'
+    ),
+    partitioned_by: List[str] = typer.Option(
+        [],
+        help="Flat column the table is partitioned by, can be repeated, "
+        "defaults to the partition keys of the source",
+    ),
+    bucketed_by: List[str] = typer.Option(
+        [], help="Flat column the rows are bucketed by, can be repeated"
+    ),
+    bucket_count: Optional[int] = typer.Option(
+        None, help="Number of buckets, derived from the source size if not set"
+    ),
+    target_file_size: int = typer.Option(
+        256, help="Wanted file size in MB for the derived bucket count"
+    ),
+    record: bool = typer.Option(
+        True, help="Record the query statistics of the run in the ledger"
+    ),
+    ledger: Optional[str] = typer.Option(
+        None, help="Path of the run ledger, defaults to ledger.jsonl in the cache dir"
+    ),
+    list_target: bool = typer.Option(
+        True,
+        help="Record the files and bytes under the target location in the ledger, "
+        "lists the whole location after every run",
+    ),
+    trace: Optional[str] = typer.Option(
+        None, help="Write the spans of the phases of the run to this JSON file"
+    ),
+    trace_format: str = typer.Option(
+        "chrome", help='"chrome" (chrome://tracing, Perfetto) or "json"'
+    ),
+    profile: bool = typer.Option(
+        False, help="Profile CPU time and memory of the local phases"
+    ),
+    profile_dir: Optional[str] = typer.Option(
+        None, help="Directory of the profiles, defaults to profiles/ in the cache dir"
+    ),
+    local_root: Optional[str] = typer.Option(
+        None,
+        help="Run against a catalog and s3 buckets in this local directory, "
+        "queried with DuckDB, instead of AWS",
+    ),
+    engine: str = typer.Option(
+        "athena",
+        help='"athena" runs CTAS queries, "arrow" flattens the source files locally '
+        "with pyarrow (full refreshes of parquet and JSON tables)",
+    ),
+    processes: Optional[int] = typer.Option(
+        None, help="Worker processes of the arrow engine, defaults to the CPU count"
+    ),
+    batch_size: int = typer.Option(
+        BATCH_SIZE, help="Rows per record batch of the arrow engine"
+    ),
 ):
+    """
+    Flattens a single table
+    """
     # TODO add a check if logged into AWS CLI
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine}, use one of {ENGINES}")
+    if engine == "arrow" and incremental:
+        raise ValueError("The arrow engine only runs full refreshes")
+    if local_root:
+        use_backend(LocalBackend(local_root))
+    if disk_cache:
+        use_disk_cache()
     source_table = GlueTable(
         database_name=database,
         table_name=source_table,
+        projection=ColumnProjection(select) if select else None,
     )
     target_table = GlueTable(database_name=database, table_name=target_table)
-    ToFlatParquet(
+    flat_table = ToFlatParquet(
         database=database,
         source_table=source_table,
         target_table=target_table,
         target_table_location=target_table_location,
         workgroup=workgroup,
         s3_staging_dir=s3_staging_dir,
-    ).insert_overwrite()
+        refresh_mode=refresh_mode,
+        keep_versions=keep_versions,
+        shards=shards,
+        shard_by=shard_by,
+        shard_key=shard_key,
+        verify_shards=verify_shards,
+        file_manifest=file_manifest,
+        rebuild_manifest=rebuild_manifest,
+        output=output_options(
+            format,
+            compression,
+            partitioned_by,
+            bucketed_by,
+            bucket_count,
+            target_file_size,
+        ),
+        ledger=RunLedger(ledger, list_target) if record else None,
+    )
+
+    def flatten(table):
+        if engine == "arrow":
+            ArrowFlattener(table, batch_size=batch_size, processes=processes).run(
+                force=force
+            )
+        elif incremental:
+            table.insert_incremental(detect_changes=detect_changes)
+        else:
+            table.insert_overwrite(resume=resume, force=force)
+
+    with tracing(trace, trace_format, profile, profile_dir):
+        if row_key:
+            VerticalSplit(
+                flat_table,
+                row_key=row_key,
+                max_columns=max_columns,
+                max_sql_bytes=max_sql_bytes,
+                join_view=join_view,
+            ).run(flatten)
+        else:
+            flatten(flat_table)
+    logger.debug(f"Type cache: {GlueTable.type_cache.stats()}")
+    logger.debug(f"Mapping cache: {GlueTable.mapping_cache.stats()}")
+
+
+@app.command("schema")
+def schema(
+    database: str = typer.Argument(..., help="The name of glue database"),
+    source_table: str = typer.Argument(
+        ..., help="The name of the (nested) source table"
+    ),
+    target_table: str = typer.Argument(
+        ..., help="The name of the flattend target table"
+    ),
+    apply: bool = typer.Option(
+        False, help="Apply compatible changes to the target table in place"
+    ),
+    format: str = typer.Option("parquet", help='"parquet" or "orc"'),
+    compression: str = typer.Option(
+        "SNAPPY", help='Codec of the flat files, e.g. "ZSTD", "SNAPPY" or "GZIP"'
+    ),
+    partitioned_by: List[str] = typer.Option(
+        [],
+        help="Flat column the table is partitioned by, can be repeated, "
+        "defaults to the partition keys of the source",
+    ),
+    bucketed_by: List[str] = typer.Option(
+        [], help="Flat column the rows are bucketed by, can be repeated"
+    ),
+    bucket_count: Optional[int] = typer.Option(
+        None, help="Number of buckets, derived from the source size if not set"
+    ),
+    target_file_size: int = typer.Option(
+        256, help="Wanted file size in MB for the derived bucket count"
+    ),
+):
+    """
+    Shows the schema changes of the flat table, without --apply nothing is changed.
+    The output options have to match the ones the table is flattened with.
+    """
+    flat_table = ToFlatParquet(
+        database=database,
+        source_table=GlueTable(database_name=database, table_name=source_table),
+        target_table=GlueTable(database_name=database, table_name=target_table),
+        target_table_location=None,
+        workgroup="primary",
+        s3_staging_dir=None,
+        output=output_options(
+            format,
+            compression,
+            partitioned_by,
+            bucketed_by,
+            bucket_count,
+            target_file_size,
+        ),
+    )
+    diff = flat_table.evolve_schema(dry_run=not apply)
+    typer.echo(diff.report())
+    if not diff.compatible:
+        raise typer.Exit(code=1)
+
+
+@app.command("sql")
+def sql(
+    database: str = typer.Argument(..., help="The name of glue database"),
+    source_table: str = typer.Argument(
+        ..., help="The name of the (nested) source table"
+    ),
+    target_table: str = typer.Argument(
+        ..., help="The name of the flattend target table"
+    ),
+    target_table_location: str = typer.Argument(
+        ..., help="The s3 location for the data of the flattend table"
+    ),
+    output: str = typer.Option(
+        "-", help='File the query is written to, "-" for stdout'
+    ),
+    insert: bool = typer.Option(
+        False,
+        help="The INSERT INTO query of incremental runs instead of the CTAS query",
+    ),
+    pretty: bool = typer.Option(
+        False, help="Format the query with sqlparse, slow for thousands of columns"
+    ),
+    select: List[str] = typer.Option(
+        [], help='Column path pattern, e.g. "payload.device.*", can be repeated'
+    ),
+    format: str = typer.Option("parquet", help='"parquet" or "orc"'),
+    compression: str = typer.Option("SNAPPY", help="Codec of the flat files"),
+    partitioned_by: List[str] = typer.Option(
+        [], help="Flat column the table is partitioned by, can be repeated"
+    ),
+    bucketed_by: List[str] = typer.Option(
+        [], help="Flat column the rows are bucketed by, can be repeated"
+    ),
+    bucket_count: Optional[int] = typer.Option(None, help="Number of buckets"),
+):
+    """
+    Writes the query flattening the table without running it
+    """
+    flat_table = ToFlatParquet(
+        database=database,
+        source_table=GlueTable(
+            database_name=database,
+            table_name=source_table,
+            projection=ColumnProjection(select) if select else None,
+        ),
+        target_table=GlueTable(database_name=database, table_name=target_table),
+        target_table_location=target_table_location,
+        workgroup="primary",
+        s3_staging_dir=None,
+        output=output_options(
+            format, compression, partitioned_by, bucketed_by, bucket_count, 256
+        ),
+    )
+    temp_table = flat_table.temp_table(database, flat_table.run_state().run_id)
+    if pretty:
+        statement = [
+            flat_table.generate_insert_into_query(pretty=True)
+            if insert
+            else flat_table.generate_insert_overwrite_query(
+                temp_table, target_table_location, pretty=True
+            )
+        ]
+    elif insert:
+        statement = flat_table.insert_into_statement()
+    else:
+        statement = flat_table.insert_overwrite_statement(
+            temp_table, target_table_location
+        )
+    write_sql(statement, sys.stdout if output == "-" else output)
+
+
+@app.command("stats")
+def stats(
+    table: str = typer.Option(
+        "*", help='Glob pattern of the flat tables, e.g. "db.flat_*"'
+    ),
+    runs: int = typer.Option(0, help="Also list the last runs of every matching table"),
+    window: int = typer.Option(
+        5, help="Number of earlier runs the scanned bytes are compared with"
+    ),
+    ledger: Optional[str] = typer.Option(
+        None, help="Path of the run ledger, defaults to ledger.jsonl in the cache dir"
+    ),
+):
+    """
+    Shows the scanned bytes, cost and queue time of the flatten runs per table
+    """
+    records = list(RunLedger(ledger).records(table))
+    if not records:
+        typer.echo("No runs recorded.")
+        return
+    typer.echo(format_trends(table_trends(records, window=window)))
+    if runs:
+        by_table = {}
+        for record in records:
+            by_table.setdefault(record["target_table"], []).append(record)
+        for name, table_runs in by_table.items():
+            typer.echo(f"\n{name}")
+            for record in table_runs[-runs:]:
+                typer.echo(
+                    f"{record['started']}  {record['mode']:<11} {record['status']:<9} "
+                    f"{record['queries']:>3} queries  "
+                    f"{record['data_scanned_bytes']:>15} bytes scanned  "
+                    f"queue {record['queue_ms']} ms  engine {record['engine_ms']} ms"
+                )
+
+
+@app.command("batch")
+def batch(
+    database: str = typer.Argument(..., help="The name of glue database"),
+    target_location: str = typer.Argument(
+        ...,
+        help="The s3 prefix for the flattend tables, each table is stored in <prefix>/<target_table>/",
+    ),
+    s3_staging_dir: str = typer.Argument(
+        ...,
+        help="The s3 location where athena is allowed to write its query results",
+    ),
+    include: List[str] = typer.Option(
+        ["*"], help="Glob pattern of source tables to flatten, can be repeated"
+    ),
+    exclude: List[str] = typer.Option(
+        [], help="Glob pattern of source tables to skip, can be repeated"
+    ),
+    manifest: Optional[str] = typer.Option(
+        None,
+        help="JSON/YAML manifest with the tables to flatten, replaces include/exclude",
+    ),
+    target_prefix: str = typer.Option(
+        "flat_", help="Prefix of the flattend table names"
+    ),
+    concurrency: int = typer.Option(
+        5,
+        help="Maximum number of concurrently running athena queries, "
+        "shared by all tables and their shards",
+    ),
+    workgroup: str = typer.Option(
+        "primary", help="The athena workspace, if you use them"
+    ),
+    disk_cache: bool = typer.Option(
+        False, help="Persist parsed column types and flat mappings on disk"
+    ),
+    resume: bool = typer.Option(
+        True, help="Resume interrupted runs instead of starting over"
+    ),
+    force: bool = typer.Option(
+        False, help="Flatten even if the sources are unchanged since the last run"
+    ),
+    select: List[str] = typer.Option(
+        [],
+        help='Column path pattern, e.g. "payload.device.*", prefix with "!" to exclude, '
+        "can be repeated",
+    ),
+    refresh_mode: str = typer.Option(
+        "purge",
+        help='"purge" deletes the old data first, "swap" writes to a new prefix '
+        "and switches the table to it when the data is complete",
+    ),
+    keep_versions: int = typer.Option(
+        2, help="Number of data versions kept in swap mode"
+    ),
+    incremental: bool = typer.Option(
+        False, help="Flatten only new or changed partitions of partitioned tables"
+    ),
+    detect_changes: str = typer.Option(
+        "glue",
+        help='How incremental runs detect changed partitions, "glue" metadata or '
+        '"s3" object listings',
+    ),
+    shards: int = typer.Option(
+        1, help="Split a full refresh into this many concurrent queries"
+    ),
+    shard_by: str = typer.Option(
+        "auto",
+        help='Split the source by "partition" ranges, "path" (file) buckets or '
+        '"hash" of --shard-key, "auto" uses partitions if there are any',
+    ),
+    shard_key: Optional[str] = typer.Option(
+        None, help="Column that is hashed to split the source with --shard-by hash"
+    ),
+    verify_shards: bool = typer.Option(
+        False, help="Compare the row counts of source and shards (scans the source)"
+    ),
+    file_manifest: Optional[str] = typer.Option(
+        None,
+        help="Local directory or s3 prefix of the manifests of flattened files, one "
+        "<target_table>.json.gz per table, used by incremental runs over "
+        "unpartitioned tables",
+    ),
+    rebuild_manifest: bool = typer.Option(
+        False,
+        help="Rebuild empty manifests of existing flat tables with a full refresh, "
+        "instead of refusing the incremental runs",
+    ),
+    format: str = typer.Option("parquet", help='"parquet" or "orc"'),
+    compression: str = typer.Option(
+        "SNAPPY", help='Codec of the flat files, e.g. "ZSTD", "SNAPPY" or "GZIP"'
+    ),
+    partitioned_by: List[str] = typer.Option(
+        [],
+        help="Flat column the table is partitioned by, can be repeated, "
+        "defaults to the partition keys of the source",
+    ),
+    bucketed_by: List[str] = typer.Option(
+        [], help="Flat column the rows are bucketed by, can be repeated"
+    ),
+    bucket_count: Optional[int] = typer.Option(
+        None, help="Number of buckets, derived from the source size if not set"
+    ),
+    target_file_size: int = typer.Option(
+        256, help="Wanted file size in MB for the derived bucket count"
+    ),
+    record: bool = typer.Option(
+        True, help="Record the query statistics of the run in the ledger"
+    ),
+    ledger: Optional[str] = typer.Option(
+        None, help="Path of the run ledger, defaults to ledger.jsonl in the cache dir"
+    ),
+    list_target: bool = typer.Option(
+        True,
+        help="Record the files and bytes under the target location in the ledger, "
+        "lists the whole location after every run",
+    ),
+    trace: Optional[str] = typer.Option(
+        None, help="Write the spans of the phases of the run to this JSON file"
+    ),
+    trace_format: str = typer.Option(
+        "chrome", help='"chrome" (chrome://tracing, Perfetto) or "json"'
+    ),
+    profile: bool = typer.Option(
+        False, help="Profile CPU time and memory of the local phases"
+    ),
+    profile_dir: Optional[str] = typer.Option(
+        None, help="Directory of the profiles, defaults to profiles/ in the cache dir"
+    ),
+    local_root: Optional[str] = typer.Option(
+        None,
+        help="Run against a catalog and s3 buckets in this local directory, "
+        "queried with DuckDB, instead of AWS",
+    ),
+):
+    """
+    Flattens all matching tables of a database concurrently
+    """
+    if local_root:
+        use_backend(LocalBackend(local_root))
+    if disk_cache:
+        use_disk_cache()
+    tables = GlueTable.metadata_cache.prefetch(GlueTable.glue_client, database)
+    jobs = plan_jobs(
+        tables,
+        location_prefix=target_location,
+        include=include,
+        exclude=exclude,
+        target_prefix=target_prefix,
+        manifest=load_manifest(manifest) if manifest else None,
+    )
+    with tracing(trace, trace_format, profile, profile_dir):
+        results = BatchFlattener(
+            database=database,
+            workgroup=workgroup,
+            s3_staging_dir=s3_staging_dir,
+            concurrency=concurrency,
+            resume=resume,
+            force=force,
+            projection=ColumnProjection(select) if select else None,
+            incremental=incremental,
+            detect_changes=detect_changes,
+            refresh_mode=refresh_mode,
+            keep_versions=keep_versions,
+            shards=shards,
+            shard_by=shard_by,
+            shard_key=shard_key,
+            verify_shards=verify_shards,
+            file_manifests=file_manifest,
+            rebuild_manifest=rebuild_manifest,
+            output=output_options(
+                format,
+                compression,
+                partitioned_by,
+                bucketed_by,
+                bucket_count,
+                target_file_size,
+            ),
+            ledger=RunLedger(ledger, list_target) if record else None,
+        ).run(jobs)
+    logger.info(summary(results))
+    if not all(result.succeeded for result in results):
+        raise typer.Exit(code=1)
 
 
 def cli():
-    typer.run(main)
+    app()
@@ -1,11 +1,15 @@
 create TABLE {{tmp_table}}
             with (
                 external_location = '{{location}}',
-                format = 'PARQUET',
-                parquet_compression = 'SNAPPY'
+                format = '{{format|upper}}',
+                {{format|lower}}_compression = '{{compression|upper}}'{% if bucketed_by %},
+                bucketed_by = ARRAY[{% for column in bucketed_by %}'{{column}}'{% if not loop.last %}, {% endif %}{% endfor %}],
+                bucket_count = {{bucket_count}}{% endif %}{% if partitioned_by %},
+                partitioned_by = ARRAY[{% for partition in partitioned_by %}'{{partition}}'{% if not loop.last %}, {% endif %}{% endfor %}]{% endif %}
             )
             AS
             select
 {% for source_column, target_column in columns %}
 {{source_column}} as {{target_column}}{% if not loop.last %},{% endif %}{% endfor %}
 from {{source_tb_name}}
+{% if where %}where {{where}}{% endif %}
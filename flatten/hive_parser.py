@@ -1,24 +1,96 @@
+import hashlib
 import os
+import re
+import tempfile
 from typing import List
 from typing import Union
 
+import lark
+from flatten.utils import cache_dir
 from flatten.utils import flatten_dict
 from lark import Lark
 from lark import Token
 from lark import Transformer
 from lark import Tree
-from lark.reconstruct import Reconstructor
+from loguru import logger
 
 
 class HiveParser:
-    def __init__(self) -> None:
+    def __init__(self, parser="lalr", cache=True, fast_path=True) -> None:
+        """
+        :param parser: Lark parsing algorithm, "lalr" or the slower "earley"
+        :param cache: Load/store the built LALR parser in the on-disk cache
+        :param fast_path: Try the hand-written parser before falling back to lark
+        """
         self.grammar = self._load_grammar()
-        self.parser = Lark(self.grammar, start="type_db_col")
+        self.parser_type = parser
+        self.fast_path = fast_path
         self.transformer = SchemaTransformer()
+        if cache and parser == "lalr":
+            self.parser = self._load_cached_parser()
+        else:
+            self.parser = self._build_parser()
 
     def __call__(self, hive_str):
+        if self.fast_path:
+            try:
+                return fast_parse(hive_str)
+            except UnsupportedType:
+                pass
         return self.transformer.transform(self.parser.parse(hive_str))
 
+    @property
+    def cache_file(self) -> str:
+        """
+        Cache file name, versioned by the lark version and the grammar content
+        """
+        grammar_hash = hashlib.md5(
+            (self.grammar + self.parser_type).encode()
+        ).hexdigest()
+        return os.path.join(
+            cache_dir(), f"hive_grammar_{lark.__version__}_{grammar_hash}.lark.pickle"
+        )
+
+    def _build_parser(self) -> Lark:
+        return Lark(self.grammar, start="type_db_col", parser=self.parser_type)
+
+    def _load_cached_parser(self) -> Lark:
+        """
+        Loads the parser from the cache file or builds and stores it. A cache that
+        can't be read or written, e.g. a read-only or full cache dir, is a cache miss.
+        """
+        try:
+            cache_file = self.cache_file
+        except OSError:
+            return self._build_parser()
+        try:
+            with open(cache_file, "rb") as f:
+                return Lark.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # Unreadable or corrupted cache file, it is replaced below
+            logger.debug(f"Not using the parser cache {cache_file}: {e}")
+        parser = self._build_parser()
+        tmp_file = None
+        try:
+            # Written under a temporary name, so that concurrent processes never
+            # read a partially written file
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(cache_file), suffix=".tmp", delete=False
+            ) as f:
+                tmp_file = f.name
+                parser.save(f)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            logger.debug(f"Not storing the parser cache {cache_file}: {e}")
+            if tmp_file:
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
+        return parser
+
     @staticmethod
     def _load_grammar():
         with open(
@@ -28,6 +100,146 @@ class HiveParser:
         return grammar
 
 
+# Keywords of the primitivetype rule and the name of the tree they are parsed to
+PRIMITIVE_TYPES = {
+    "string": "string",
+    "bigint": "bigint",
+    "boolean": "boolean",
+    "int": "int",
+    "integer": "int",
+    "float": "float",
+    "double": "double",
+    "timestamp": "timestamp",
+    "tinyint": "tinyint",
+    "smallint": "smallint",
+    "precision": "precision",
+    "date": "date",
+    "datetime": "datetime",
+    "timestamplocaltz": "timestamplocaltz",
+    "time": "time",
+    "zone": "zone",
+    "interval": "interval",
+    "decimal": "decimal",
+    "dec": "decimal",
+    "numeric": "decimal",
+    "char": "char",
+    "varchar": "varchar",
+}
+
+_WORD = re.compile(r"[ \t\f\r\n]*([A-Za-z_\-][A-Za-z0-9_\-]*)")
+_NUMBER = re.compile(r"[ \t\f\r\n]*([0-9]+)")
+_SYMBOL = re.compile(r"[ \t\f\r\n]*([<>:,()]?)")
+
+
+class UnsupportedType(Exception):
+    """Raised by fast_parse for input it leaves to the lark parser"""
+
+
+class _TypeReader:
+    """
+    Recursive descent parser for the common subset of the grammar
+    (primitives, structs and arrays) without building a parse tree
+    """
+
+    __slots__ = ("text", "pos")
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.pos = 0
+
+    def _match(self, pattern) -> str:
+        match = pattern.match(self.text, self.pos)
+        if not match:
+            raise UnsupportedType(self.pos)
+        self.pos = match.end()
+        return match.group(1)
+
+    def _peek_symbol(self) -> str:
+        return _SYMBOL.match(self.text, self.pos).group(1)
+
+    def _expect(self, symbol: str) -> None:
+        if self._match(_SYMBOL) != symbol:
+            raise UnsupportedType(self.pos)
+
+    def read(self):
+        result = self.read_type()
+        if self._match(_SYMBOL) or self.pos != len(self.text):
+            raise UnsupportedType(self.pos)
+        return result
+
+    def read_type(self):
+        word = self._match(_WORD)
+        if word == "struct":
+            return self._read_struct()
+        if word == "array":
+            return self._read_array()
+        if word not in PRIMITIVE_TYPES:
+            raise UnsupportedType(word)
+        datatype = PRIMITIVE_TYPES[word]
+        if datatype in ("char", "varchar"):
+            self._expect("(")
+            return f"{datatype}({self._read_numbers()})"
+        if datatype == "decimal" and self._peek_symbol() == "(":
+            self._expect("(")
+            datatype = f"{datatype}({self._read_numbers()})"
+            if self._peek_symbol() == "(":
+                raise UnsupportedType(self.pos)
+        return datatype
+
+    def _read_numbers(self) -> str:
+        numbers = [self._match(_NUMBER)]
+        symbol = self._match(_SYMBOL)
+        while symbol == ",":
+            numbers.append(self._match(_NUMBER))
+            symbol = self._match(_SYMBOL)
+        if symbol != ")":
+            raise UnsupportedType(self.pos)
+        return ",".join(numbers)
+
+    def _read_struct(self) -> dict:
+        self._expect("<")
+        result = {}
+        if self._peek_symbol() == ">":
+            self._expect(">")
+            return result
+        symbol = ","
+        while symbol == ",":
+            name = self._match(_WORD)
+            self._expect(":")
+            result[name] = self.read_type()
+            symbol = self._match(_SYMBOL)
+        if symbol != ">":
+            raise UnsupportedType(self.pos)
+        return result
+
+    def _read_array(self) -> list:
+        self._expect("<")
+        result = []
+        if self._peek_symbol() == ">":
+            self._expect(">")
+            return result
+        symbol = ","
+        while symbol == ",":
+            result.append(self.read_type())
+            symbol = self._match(_SYMBOL)
+        if symbol != ">":
+            raise UnsupportedType(self.pos)
+        return result
+
+
+def fast_parse(hive_str: str):
+    """
+    Parses primitive, struct and array types into the same structure as SchemaTransformer
+    in a single pass. Raises UnsupportedType for anything else, e.g. maps or invalid types.
+    :param hive_str:
+    :return:
+    """
+    try:
+        return _TypeReader(hive_str).read()
+    except RecursionError:
+        raise UnsupportedType("nesting too deep")
+
+
 class SchemaTransformer(Transformer):
     def structtype(self, items):
         result = {}
@@ -61,17 +273,45 @@ class SchemaTransformer(Transformer):
         return result
 
 
-def convert_to_tree(k: str, v: Union[str, List]) -> Tree:
-    if isinstance(v, list):
-        return Tree(
-            "name_type",
-            [Token("NAME", k), Tree("primitivetype", [Tree("string", [])])],
-        )
+def _serialize_parts(parsed_type, parts: List[str]) -> None:
+    if isinstance(parsed_type, str):
+        parts.append(parsed_type)
+    elif isinstance(parsed_type, dict):
+        parts.append("struct<")
+        for i, (name, value) in enumerate(parsed_type.items()):
+            if i:
+                parts.append(",")
+            parts.append(f"{name}:")
+            _serialize_parts(value, parts)
+        parts.append(">")
+    elif isinstance(parsed_type, list):
+        parts.append("array<")
+        for i, value in enumerate(parsed_type):
+            if i:
+                parts.append(",")
+            _serialize_parts(value, parts)
+        parts.append(">")
+    elif isinstance(parsed_type, Tree) and parsed_type.data == "maptype":
+        # SchemaTransformer leaves maps as trees: [Tree("map"), key type, value type]
+        _, key_type, value_type = parsed_type.children
+        parts.append("map<")
+        _serialize_parts(key_type, parts)
+        parts.append(",")
+        _serialize_parts(value_type, parts)
+        parts.append(">")
     else:
-        return Tree(
-            "name_type",
-            [Token("NAME", k), Tree("primitivetype", [Tree(v, [])])],
-        )
+        raise ValueError("Serialization Error", parsed_type)
+
+
+def serialize_type(parsed_type: Union[str, dict, list, Tree]) -> str:
+    """
+    Serializes a parsed type, as produced by HiveParser, back into a canonical hive type string
+    :param parsed_type:
+    :return:
+    """
+    parts = []
+    _serialize_parts(parsed_type, parts)
+    return "".join(parts)
 
 
 def flatten_type(parser, hive_str):
@@ -80,52 +320,12 @@ def flatten_type(parser, hive_str):
     if isinstance(transformed, dict):
         flattend_tree = flatten_dict(transformed)
         for k, v in flattend_tree.items():
-            hive_tree = convert_to_tree(k, v)
-            new_hive = Reconstructor(parser.parser).reconstruct(hive_tree)
-            list_of_columns.append(new_hive)
+            # arrays are flattened to strings
+            if isinstance(v, list):
+                v = "string"
+            list_of_columns.append(f"{k}:{serialize_type(v)}")
     else:
         flattend_tree = transformed
         list_of_columns.append(flattend_tree)
 
     return list_of_columns
-
-
-def reconstruct_primitive_type(k, v):
-    return Tree(
-        "name_type",
-        [
-            Token("NAME", k),
-            Tree("primitivetype", [Tree(v, [])]),
-        ],
-    )
-
-
-def reconstruct_struct_type(type: dict):
-    tree = Tree("structtype", [])
-    for k, v in type.items():
-        if isinstance(v, dict):
-            tree.children.append(
-                Tree("name_type", [Token("NAME", k), reconstruct_struct_type(v)])
-            )
-        else:
-            tree.children.append(reconstruct_primitive_type(k, v))
-    return tree
-
-
-def reconstruct_array_type(type: List):
-    tree = Tree("listtype", [])
-    for i in type:
-        if isinstance(i, dict):
-            # for example array<struct<a:string,b:string>>
-            tree.children.append(reconstruct_struct_type(i))
-        else:
-            # for example array<string>
-            tree.children.append(
-                Tree("primitivetype", [Tree(i, [])]),
-            )
-    return tree
-
-
-def reconstruct_array(parser, type: List):
-    tree = reconstruct_array_type(type)
-    return Reconstructor(parser).reconstruct(tree)
@@ -0,0 +1,6 @@
+insert into {{target_table}}
+            select
+{% for source_column, target_column in columns %}
+{{source_column}} as {{target_column}}{% if not loop.last %},{% endif %}{% endfor %}
+from {{source_tb_name}}
+{% if where %}where {{where}}{% endif %}
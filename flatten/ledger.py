@@ -0,0 +1,204 @@
+import json
+import os
+import re
+import threading
+from fnmatch import fnmatchcase
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+from flatten.utils import cache_dir
+from loguru import logger
+
+# Athena bills 5 USD per TB scanned, at least 10 MB per query
+PRICE_PER_TB = 5.0
+MIN_BILLED_BYTES = 10 * 1000**2
+# CTAS and INSERT INTO queries write the rows of the flat table, selects only read
+WRITING_QUERY = re.compile(
+    r"\s*(create\s+table\s.*\sas\s|insert\s+into\s)", re.I | re.S
+)
+
+
+class QueryStats(NamedTuple):
+    query_id: str
+    statement_type: Optional[str] = None
+    data_scanned_bytes: int = 0
+    engine_ms: int = 0
+    queue_ms: int = 0
+    planning_ms: int = 0
+    service_processing_ms: int = 0
+    output_rows: Optional[int] = None
+    writes: bool = False
+
+    @classmethod
+    def from_execution(cls, execution) -> "QueryStats":
+        """
+        :param execution: AthenaQueryExecution or executed pyathena cursor
+        """
+        return cls(
+            query_id=execution.query_id,
+            statement_type=execution.statement_type,
+            data_scanned_bytes=execution.data_scanned_in_bytes or 0,
+            engine_ms=execution.engine_execution_time_in_millis or 0,
+            queue_ms=execution.query_queue_time_in_millis or 0,
+            planning_ms=execution.query_planning_time_in_millis or 0,
+            service_processing_ms=execution.service_processing_time_in_millis or 0,
+            writes=bool(WRITING_QUERY.match(execution.query or "")),
+        )
+
+    @property
+    def cost(self) -> float:
+        """Estimated cost in USD"""
+        billed = max(self.data_scanned_bytes, MIN_BILLED_BYTES)
+        return billed * PRICE_PER_TB / 1000**4
+
+
+def summarize(queries: List[QueryStats]) -> Dict:
+    """
+    :return: Totals of the statistics of the queries of a run, the rows written
+        are the output rows of the writing queries with row statistics
+    """
+    output_rows = [
+        query.output_rows
+        for query in queries
+        if query.writes and query.output_rows is not None
+    ]
+    return {
+        "queries": len(queries),
+        "data_scanned_bytes": sum(query.data_scanned_bytes for query in queries),
+        "engine_ms": sum(query.engine_ms for query in queries),
+        "queue_ms": sum(query.queue_ms for query in queries),
+        "planning_ms": sum(query.planning_ms for query in queries),
+        "service_processing_ms": sum(query.service_processing_ms for query in queries),
+        "cost_usd": round(sum(query.cost for query in queries), 6),
+        "rows_written": sum(output_rows) if output_rows else None,
+    }
+
+
+class RunLedger:
+    """
+    Append-only JSON lines file with one record per flatten run, shared by the
+    threads of a batch
+    """
+
+    def __init__(self, path: str = None, list_target=True) -> None:
+        """
+        :param path: Defaults to ledger.jsonl in the cache dir
+        :param list_target: Record the files and bytes under the target location
+            of successful runs, lists the whole location
+        """
+        self.path = path or os.path.join(cache_dir(), "ledger.jsonl")
+        self.list_target = list_target
+        self._lock = threading.Lock()
+
+    def append(self, record: Dict) -> None:
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(line)
+
+    def records(self, table: str = "*") -> Iterator[Dict]:
+        """
+        :param table: Glob pattern of the target tables, e.g. "db.flat_*"
+        :return: The records in the order of the runs, lines that can't be read are skipped
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Skipping line {number} of {self.path}.")
+                    continue
+                name = record.get("target_table", "").replace('"', "")
+                if fnmatchcase(name, table):
+                    yield record
+
+
+class TableTrend(NamedTuple):
+    table: str
+    runs: int
+    failed: int
+    last_run: str
+    data_scanned_bytes: int
+    scanned_change: Optional[float]
+    cost_usd: float
+    queue_share: float
+    target_bytes: Optional[int]
+
+
+def table_trends(records: List[Dict], window=5) -> List[TableTrend]:
+    """
+    Summarizes the runs of every target table
+    :param records: Ledger records in the order of the runs
+    :param window: Number of earlier runs the last run is compared with
+    :return: Tables with the most expensive last run first
+    """
+    by_table = {}
+    for record in records:
+        by_table.setdefault(record["target_table"], []).append(record)
+    trends = []
+    for table, runs in by_table.items():
+        measured = [run for run in runs if run.get("status") == "succeeded"]
+        last = measured[-1] if measured else runs[-1]
+        earlier = [run["data_scanned_bytes"] for run in measured[:-1][-window:]]
+        mean = sum(earlier) / len(earlier) if earlier else 0
+        queue_ms = sum(run.get("queue_ms", 0) for run in runs)
+        busy_ms = queue_ms + sum(run.get("engine_ms", 0) for run in runs)
+        trends.append(
+            TableTrend(
+                table=table,
+                runs=len(runs),
+                failed=sum(1 for run in runs if run.get("status") == "failed"),
+                last_run=runs[-1]["started"],
+                data_scanned_bytes=last.get("data_scanned_bytes", 0),
+                scanned_change=(
+                    last["data_scanned_bytes"] / mean - 1 if mean and measured else None
+                ),
+                cost_usd=round(sum(run.get("cost_usd", 0) for run in runs), 4),
+                queue_share=queue_ms / busy_ms if busy_ms else 0.0,
+                target_bytes=last.get("target_bytes"),
+            )
+        )
+    return sorted(trends, key=lambda trend: trend.data_scanned_bytes, reverse=True)
+
+
+def _size(num_bytes: Optional[float]) -> str:
+    if num_bytes is None:
+        return "-"
+    for unit in ("B", "KB", "MB", "GB"):
+        if num_bytes < 1000:
+            return f"{num_bytes:.0f} {unit}"
+        num_bytes /= 1000
+    return f"{num_bytes:.1f} TB"
+
+
+def format_trends(trends: List[TableTrend]) -> str:
+    rows = [("table", "runs", "failed", "scanned", "change", "cost", "queue", "size")]
+    for trend in trends:
+        rows.append(
+            (
+                trend.table,
+                str(trend.runs),
+                str(trend.failed),
+                _size(trend.data_scanned_bytes),
+                "-" if trend.scanned_change is None else f"{trend.scanned_change:+.0%}",
+                f"${trend.cost_usd:.4f}",
+                f"{trend.queue_share:.0%}",
+                _size(trend.target_bytes),
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(
+            value.ljust(width) if i == 0 else value.rjust(width)
+            for i, (value, width) in enumerate(zip(row, widths))
+        )
+        for row in rows
+    )
@@ -0,0 +1,946 @@
+import copy
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+from datetime import timezone
+from types import SimpleNamespace
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from urllib.parse import unquote
+
+from botocore.exceptions import ClientError
+from flatten.athena import QueryFuture
+from flatten.aws import AthenaConnection
+from flatten.aws import GlueTable
+from flatten.aws import HIVE_NULL_PARTITION
+from flatten.aws import splitted_s3_key
+from flatten.backend import Backend
+from flatten.tracing import span
+from lark import Tree
+from loguru import logger
+from pyathena.error import OperationalError
+from pyathena.model import AthenaQueryExecution
+
+PAGE_SIZE = 1000
+TIME_KEYS = ("CreateTime", "UpdateTime", "CreationTime", "LastAccessTime")
+
+HIVE_TO_DUCKDB = {
+    "string": "VARCHAR",
+    "varchar": "VARCHAR",
+    "char": "VARCHAR",
+    "tinyint": "TINYINT",
+    "smallint": "SMALLINT",
+    "int": "INTEGER",
+    "integer": "INTEGER",
+    "bigint": "BIGINT",
+    "float": "FLOAT",
+    "double": "DOUBLE",
+    "boolean": "BOOLEAN",
+    "date": "DATE",
+    "timestamp": "TIMESTAMP",
+    "binary": "BLOB",
+}
+DUCKDB_TO_HIVE = {
+    "varchar": "string",
+    "tinyint": "tinyint",
+    "smallint": "smallint",
+    "integer": "int",
+    "bigint": "bigint",
+    "hugeint": "decimal(38,0)",
+    "float": "float",
+    "double": "double",
+    "boolean": "boolean",
+    "date": "date",
+    "timestamp": "timestamp",
+    "blob": "binary",
+}
+
+_TABLE = r'"[^"]+"\."[^"]+"|"[^"]+"|[\w.]+'
+_CTAS = re.compile(
+    rf"^\s*create\s+table\s+(?P<table>{_TABLE})\s+with\s*\((?P<properties>.*?)\)"
+    r"\s*as\s+(?P<select>.*)$",
+    re.I | re.S,
+)
+_INSERT = re.compile(
+    rf"^\s*insert\s+into\s+(?P<table>{_TABLE})\s+(?P<select>select\s.*)$", re.I | re.S
+)
+_VIEW = re.compile(
+    rf"^\s*create\s+or\s+replace\s+view\s+(?P<table>{_TABLE})\s+as\s+(?P<select>.*)$",
+    re.I | re.S,
+)
+_PROPERTY = re.compile(r"(\w+)\s*=\s*(ARRAY\[[^\]]*\]|'[^']*'|\d+)", re.I)
+_RELATION = re.compile(rf"\b(from|join)\s+({_TABLE})", re.I)
+# Presto hash of ToFlatParquet.shard_filters, DuckDB has its own hash function
+_SHARD_HASH = re.compile(
+    r"abs\(mod\(from_big_endian_64\(xxhash64\(to_utf8\((cast\(.+? as varchar\))\)\)\),"
+    r"\s*(\d+)\)\)",
+    re.I,
+)
+
+
+def client_error(code: str, message: str, operation: str) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class NoSuchKey(ClientError):
+    pass
+
+
+class _Paginator:
+    def __init__(self, pages) -> None:
+        self._pages = pages
+
+    def paginate(self, **kwargs) -> Iterator[Dict]:
+        return self._pages(**kwargs)
+
+
+class LocalS3Client:
+    """
+    The part of the boto3 s3 client used by flatten, on a directory:
+    s3://bucket/key is stored as <root>/bucket/key
+    """
+
+    exceptions = SimpleNamespace(NoSuchKey=NoSuchKey)
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def path(self, bucket: str, key: str = "") -> str:
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def _objects(self, bucket: str, prefix: str) -> List[Dict]:
+        bucket_dir = self.path(bucket)
+        # Only walk the deepest directory that contains all keys with the prefix
+        start = self.path(bucket, prefix.rsplit("/", 1)[0] if "/" in prefix else "")
+        objects = []
+        for directory, _, files in os.walk(start):
+            for name in files:
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, bucket_dir).replace(os.sep, "/")
+                if not key.startswith(prefix):
+                    continue
+                stat = os.stat(path)
+                etag = hashlib.md5(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+                objects.append(
+                    {
+                        "Key": key,
+                        "Size": stat.st_size,
+                        "ETag": f'"{etag.hexdigest()}"',
+                        "LastModified": datetime.fromtimestamp(
+                            stat.st_mtime, timezone.utc
+                        ),
+                    }
+                )
+        return sorted(objects, key=lambda obj: obj["Key"])
+
+    def _list_pages(self, Bucket, Prefix="", **kwargs) -> Iterator[Dict]:
+        objects = self._objects(Bucket, Prefix)
+        if not objects:
+            yield {"KeyCount": 0}
+        for i in range(0, len(objects), PAGE_SIZE):
+            page = objects[i : i + PAGE_SIZE]
+            yield {"Contents": page, "KeyCount": len(page)}
+
+    def get_paginator(self, operation: str) -> _Paginator:
+        if operation != "list_objects_v2":
+            raise NotImplementedError(f"The local s3 client can't paginate {operation}")
+        return _Paginator(self._list_pages)
+
+    def list_objects_v2(self, Bucket, Prefix="", **kwargs) -> Dict:
+        return next(self._list_pages(Bucket, Prefix))
+
+    def delete_objects(self, Bucket, Delete) -> Dict:
+        deleted = []
+        for obj in Delete["Objects"]:
+            try:
+                os.remove(self.path(Bucket, obj["Key"]))
+            except FileNotFoundError:
+                pass
+            deleted.append({"Key": obj["Key"]})
+        return {"Errors": []} if Delete.get("Quiet") else {"Deleted": deleted}
+
+    def get_object(self, Bucket, Key) -> Dict:
+        try:
+            with open(self.path(Bucket, Key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise NoSuchKey(
+                {"Error": {"Code": "NoSuchKey", "Message": f"{Key} does not exist"}},
+                "GetObject",
+            )
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def put_object(self, Bucket, Key, Body) -> Dict:
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode()
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(Body)
+        os.replace(f"{path}.tmp", path)
+        return {}
+
+
+def _encode(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def _decode_times(item: Dict) -> Dict:
+    item = copy.deepcopy(item)
+    for key in TIME_KEYS:
+        if isinstance(item.get(key), str):
+            item[key] = datetime.fromisoformat(item[key])
+    return item
+
+
+class LocalGlueClient:
+    """
+    The part of the boto3 glue client used by flatten, on a directory with one JSON file
+    per table (<root>/<database>/<table>.json) holding its versions and partitions
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self._lock = threading.RLock()
+
+    def _path(self, database: str, table: str) -> str:
+        return os.path.join(self.root, database, f"{table}.json")
+
+    def _load(self, database: str, table: str, operation: str) -> Dict:
+        try:
+            with open(self._path(database, table)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise client_error(
+                "EntityNotFoundException",
+                f"Table {table} not found in {database}",
+                operation,
+            )
+
+    def _save(self, database: str, table: str, data: Dict) -> None:
+        path = self._path(database, table)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(data, f, default=_encode)
+        os.replace(f"{path}.tmp", path)
+
+    def get_table(self, DatabaseName, Name) -> Dict:
+        return {
+            "Table": _decode_times(self._load(DatabaseName, Name, "GetTable")["Table"])
+        }
+
+    def get_table_version(self, DatabaseName, TableName, VersionId) -> Dict:
+        data = self._load(DatabaseName, TableName, "GetTableVersion")
+        for table in data["Versions"]:
+            if table["VersionId"] == str(VersionId):
+                return {
+                    "TableVersion": {
+                        "Table": _decode_times(table),
+                        "VersionId": table["VersionId"],
+                    }
+                }
+        raise client_error(
+            "EntityNotFoundException",
+            f"Version {VersionId} of {TableName} not found",
+            "GetTableVersion",
+        )
+
+    def create_table(self, DatabaseName, TableInput) -> Dict:
+        with self._lock:
+            if os.path.exists(self._path(DatabaseName, TableInput["Name"])):
+                raise client_error(
+                    "AlreadyExistsException",
+                    f"Table {TableInput['Name']} already exists",
+                    "CreateTable",
+                )
+            now = datetime.now(timezone.utc)
+            table = {
+                **copy.deepcopy(TableInput),
+                "DatabaseName": DatabaseName,
+                "CreateTime": now,
+                "UpdateTime": now,
+                "VersionId": "0",
+            }
+            self._save(
+                DatabaseName,
+                TableInput["Name"],
+                {"Table": table, "Versions": [table], "Partitions": []},
+            )
+        return {}
+
+    def update_table(self, DatabaseName, TableInput) -> Dict:
+        with self._lock:
+            data = self._load(DatabaseName, TableInput["Name"], "UpdateTable")
+            old = data["Table"]
+            table = {
+                **copy.deepcopy(TableInput),
+                "DatabaseName": DatabaseName,
+                "CreateTime": old["CreateTime"],
+                "UpdateTime": datetime.now(timezone.utc),
+                "VersionId": str(int(old["VersionId"]) + 1),
+            }
+            data["Table"] = table
+            data["Versions"].append(table)
+            self._save(DatabaseName, TableInput["Name"], data)
+        return {}
+
+    def delete_table(self, DatabaseName, Name) -> Dict:
+        with self._lock:
+            self._load(DatabaseName, Name, "DeleteTable")
+            os.remove(self._path(DatabaseName, Name))
+        return {}
+
+    def _table_pages(self, DatabaseName, Expression=None, **kwargs) -> Iterator[Dict]:
+        directory = os.path.join(self.root, DatabaseName)
+        names = sorted(
+            name[: -len(".json")]
+            for name in (os.listdir(directory) if os.path.isdir(directory) else [])
+            if name.endswith(".json")
+        )
+        if Expression:
+            names = [name for name in names if re.fullmatch(Expression, name)]
+        tables = [self.get_table(DatabaseName, name)["Table"] for name in names]
+        yield {"TableList": tables}
+
+    def _partition_pages(
+        self, DatabaseName, TableName, Expression=None, **kwargs
+    ) -> Iterator[Dict]:
+        if Expression:
+            raise client_error(
+                "InvalidInputException",
+                "The local catalog doesn't support partition expressions",
+                "GetPartitions",
+            )
+        partitions = self._load(DatabaseName, TableName, "GetPartitions")["Partitions"]
+        for i in range(0, len(partitions), PAGE_SIZE):
+            yield {
+                "Partitions": [
+                    _decode_times(partition)
+                    for partition in partitions[i : i + PAGE_SIZE]
+                ]
+            }
+        if not partitions:
+            yield {"Partitions": []}
+
+    def get_paginator(self, operation: str) -> _Paginator:
+        if operation == "get_tables":
+            return _Paginator(self._table_pages)
+        if operation == "get_partitions":
+            return _Paginator(self._partition_pages)
+        raise NotImplementedError(f"The local glue client can't paginate {operation}")
+
+    def batch_create_partition(
+        self, DatabaseName, TableName, PartitionInputList
+    ) -> Dict:
+        errors = []
+        with self._lock:
+            data = self._load(DatabaseName, TableName, "BatchCreatePartition")
+            existing = {tuple(partition["Values"]) for partition in data["Partitions"]}
+            for partition_input in PartitionInputList:
+                values = tuple(partition_input["Values"])
+                if values in existing:
+                    errors.append(
+                        {
+                            "PartitionValues": list(values),
+                            "ErrorDetail": {
+                                "ErrorCode": "AlreadyExistsException",
+                                "ErrorMessage": "Partition already exists",
+                            },
+                        }
+                    )
+                    continue
+                existing.add(values)
+                data["Partitions"].append(
+                    {
+                        **copy.deepcopy(partition_input),
+                        "DatabaseName": DatabaseName,
+                        "TableName": TableName,
+                        "CreationTime": datetime.now(timezone.utc),
+                    }
+                )
+            self._save(DatabaseName, TableName, data)
+        return {"Errors": errors}
+
+    def batch_delete_partition(
+        self, DatabaseName, TableName, PartitionsToDelete
+    ) -> Dict:
+        with self._lock:
+            data = self._load(DatabaseName, TableName, "BatchDeletePartition")
+            deleted = {tuple(partition["Values"]) for partition in PartitionsToDelete}
+            errors = [
+                {
+                    "PartitionValues": list(values),
+                    "ErrorDetail": {
+                        "ErrorCode": "EntityNotFoundException",
+                        "ErrorMessage": "Partition not found",
+                    },
+                }
+                for values in deleted
+                - {tuple(partition["Values"]) for partition in data["Partitions"]}
+            ]
+            data["Partitions"] = [
+                partition
+                for partition in data["Partitions"]
+                if tuple(partition["Values"]) not in deleted
+            ]
+            self._save(DatabaseName, TableName, data)
+        return {"Errors": errors}
+
+    def batch_update_partition(self, DatabaseName, TableName, Entries) -> Dict:
+        errors = []
+        with self._lock:
+            data = self._load(DatabaseName, TableName, "BatchUpdatePartition")
+            partitions = {
+                tuple(partition["Values"]): partition
+                for partition in data["Partitions"]
+            }
+            for entry in Entries:
+                values = tuple(entry["PartitionValueList"])
+                if values not in partitions:
+                    errors.append(
+                        {
+                            "PartitionValueList": list(values),
+                            "ErrorDetail": {
+                                "ErrorCode": "EntityNotFoundException",
+                                "ErrorMessage": "Partition not found",
+                            },
+                        }
+                    )
+                    continue
+                partitions[values].update(copy.deepcopy(entry["PartitionInput"]))
+            self._save(DatabaseName, TableName, data)
+        return {"Errors": errors}
+
+
+def duckdb_type(parsed) -> str:
+    """
+    :param parsed: Hive type parsed by HiveParser
+    :return: The DuckDB type of the hive type
+    """
+    if isinstance(parsed, dict):
+        fields = ", ".join(
+            f'"{name}" {duckdb_type(type_)}' for name, type_ in parsed.items()
+        )
+        return f"STRUCT({fields})"
+    if isinstance(parsed, list):
+        return f"{duckdb_type(parsed[0])}[]"
+    if isinstance(parsed, Tree):
+        return f"MAP({duckdb_type(parsed.children[-2])}, {duckdb_type(parsed.children[-1])})"
+    name = parsed.strip().lower()
+    if name.startswith("decimal"):
+        return name.upper()
+    return HIVE_TO_DUCKDB.get(re.sub(r"\(.*", "", name), "VARCHAR")
+
+
+def hive_type(duck_type) -> str:
+    """
+    :param duck_type: duckdb.typing.DuckDBPyType
+    :return: The hive type of the DuckDB type
+    """
+    kind = duck_type.id
+    if kind == "struct":
+        fields = ",".join(
+            f"{name}:{hive_type(child)}" for name, child in duck_type.children
+        )
+        return f"struct<{fields}>"
+    if kind == "list":
+        return f"array<{hive_type(duck_type.children[0][1])}>"
+    if kind == "map":
+        key, value = (child for _, child in duck_type.children)
+        return f"map<{hive_type(key)},{hive_type(value)}>"
+    if kind == "decimal":
+        return str(duck_type).lower().replace(" ", "")
+    return DUCKDB_TO_HIVE.get(kind, "string")
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _unquote(value: str) -> str:
+    return value.strip().strip("'")
+
+
+class LocalResult(AthenaQueryExecution):
+    """Execution of a local query with its result rows, stands in for a pyathena cursor"""
+
+    def __init__(self, response: Dict, rows: List[tuple]) -> None:
+        super().__init__(response)
+        self.rows = rows
+
+    def fetchone(self) -> Optional[tuple]:
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self) -> List[tuple]:
+        return list(self.rows)
+
+
+class LocalAthenaConnection(AthenaConnection):
+    """
+    Runs the queries of ToFlatParquet with DuckDB on the local catalog and storage:
+    CTAS, INSERT INTO, CREATE OR REPLACE VIEW and plain selects. The tables are read
+    from the files of their partitions, JSON and Parquet sources are supported.
+    Queries run synchronously, so their futures are done when submit returns.
+    """
+
+    def __init__(
+        self, backend: "LocalBackend", database, workgroup=None, s3_staging_dir=None
+    ):
+        super().__init__(database, workgroup, s3_staging_dir)
+        self.backend = backend
+        self._executions: Dict[str, LocalResult] = {}
+        self._output_rows: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            try:
+                import duckdb
+            except ImportError:
+                raise ValueError(
+                    "The local backend requires duckdb, "
+                    "install flatten-athena-table[local]"
+                )
+            self._db = duckdb.connect()
+        return self._db
+
+    def _table(self, database: str, name: str) -> Dict:
+        try:
+            return self.backend.glue.get_table(DatabaseName=database, Name=name)[
+                "Table"
+            ]
+        except ClientError:
+            raise ValueError(f'Table "{database}"."{name}" does not exist')
+
+    def _name(self, text: str) -> Tuple[str, str]:
+        parts = [part.strip('"') for part in re.split(r'"\."|\.', text.strip())]
+        return (self.database, parts[0]) if len(parts) == 1 else (parts[0], parts[1])
+
+    def _files(self, location: str) -> List[Tuple[str, int]]:
+        s3_url_parts = splitted_s3_key(location)
+        bucket, prefix = s3_url_parts["bucket"], s3_url_parts["path"]
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        return [
+            (self.backend.s3.path(bucket, obj["Key"]), obj["Size"])
+            for page in self.backend.s3.get_paginator("list_objects_v2").paginate(
+                Bucket=bucket, Prefix=prefix
+            )
+            for obj in page.get("Contents", [])
+            # Athena skips files starting with _ or .
+            if not obj["Key"].rsplit("/", 1)[-1].startswith(("_", "."))
+        ]
+
+    def _reader(self, table: Dict, files: List[str], with_path: bool) -> str:
+        serde = table["StorageDescriptor"].get("SerdeInfo", {})
+        library = serde.get("SerializationLibrary", "").lower()
+        paths = "[" + ", ".join(_literal(path) for path in files) + "]"
+        if "parquet" in library:
+            reader = f"read_parquet({paths}, union_by_name = true, filename = true, hive_partitioning = false)"
+        elif "json" in library:
+            columns = ", ".join(
+                f"{_literal(col['Name'])}: "
+                f"{_literal(duckdb_type(GlueTable.hive_parser(col['Type'])))}"
+                for col in table["StorageDescriptor"]["Columns"]
+            )
+            reader = (
+                f"read_json({paths}, format = 'newline_delimited', "
+                f"columns = {{{columns}}}, filename = true, hive_partitioning = false)"
+            )
+        else:
+            raise ValueError(
+                f"The local backend can't read tables with the serde {library}"
+            )
+        path = (
+            f", 's3://' || substr(filename, {len(self.backend.s3.root) + 2}) as \"$path\""
+            if with_path
+            else ""
+        )
+        return f"select * exclude (filename){path} from {reader}"
+
+    def _relation(self, database: str, name: str, with_path: bool) -> Tuple[str, int]:
+        """
+        :return: Subquery reading the table and the bytes it scans
+        """
+        table = self._table(database, name)
+        if table.get("TableType") == "VIRTUAL_VIEW":
+            query, scanned = self._translate(table["ViewOriginalText"])
+            return f"({query})", scanned
+        keys = table.get("PartitionKeys", [])
+        if keys:
+            locations = [
+                (partition["StorageDescriptor"]["Location"], partition["Values"])
+                for page in self.backend.glue.get_paginator("get_partitions").paginate(
+                    DatabaseName=database, TableName=name
+                )
+                for partition in page["Partitions"]
+            ]
+        else:
+            locations = [(table["StorageDescriptor"]["Location"], [])]
+        parts, scanned = [], 0
+        for location, values in locations:
+            files = self._files(location)
+            if not files:
+                continue
+            scanned += sum(size for _, size in files)
+            literals = "".join(
+                f", cast({'null' if value == HIVE_NULL_PARTITION else _literal(value)} "
+                f"as {duckdb_type(key['Type'])}) as \"{key['Name']}\""
+                for key, value in zip(keys, values)
+            )
+            parts.append(
+                f"select *{literals} from "
+                f"({self._reader(table, [path for path, _ in files], with_path)})"
+            )
+        if not parts:
+            columns = table["StorageDescriptor"]["Columns"] + keys
+            nulls = ", ".join(
+                f"cast(null as {duckdb_type(GlueTable.hive_parser(col['Type']))}) "
+                f"as \"{col['Name']}\""
+                for col in columns
+            )
+            path = ', cast(null as varchar) as "$path"' if with_path else ""
+            parts.append(f"select {nulls}{path} where false")
+        return "(" + " union all by name ".join(parts) + ")", scanned
+
+    def _translate(self, sql: str) -> Tuple[str, int]:
+        """
+        :return: The DuckDB version of a select and the bytes it scans
+        """
+        scanned = 0
+        with_path = '"$path"' in sql
+
+        def relation(match):
+            nonlocal scanned
+            database, name = self._name(match.group(2))
+            subquery, size = self._relation(database, name, with_path)
+            scanned += size
+            return f'{match.group(1)} {subquery} as "{name}"'
+
+        sql = _SHARD_HASH.sub(r"abs(hash(\1) % \2)", sql)
+        return _RELATION.sub(relation, sql), scanned
+
+    def _write(
+        self,
+        query: str,
+        location: str,
+        partition_keys: List[str],
+        compression: str,
+        existing: Dict[tuple, str] = None,
+    ) -> Tuple[int, List[Tuple[List[str], str]]]:
+        """
+        Writes the rows of the query as parquet files below location, partitions
+        go to their existing location or to <location>/<key>=<value>/
+        :return: Number of written rows and the new partitions (values, location)
+        """
+        existing = existing or {}
+        prefix = f"{uuid.uuid4().hex}"
+        staging = os.path.join(self.backend.root, "staging", prefix)
+        os.makedirs(staging)
+        options = f"FORMAT PARQUET, COMPRESSION {compression.lower()}"
+        try:
+            if partition_keys:
+                columns = ", ".join(f'"{key}"' for key in partition_keys)
+                target = staging
+                options += (
+                    f", PARTITION_BY ({columns}), FILENAME_PATTERN '{prefix}_{{i}}'"
+                )
+            else:
+                target = os.path.join(staging, f"{prefix}.parquet")
+            rows = self.db.execute(
+                f"COPY ({query}) TO {_literal(target)} ({options})"
+            ).fetchone()[0]
+            new_partitions = []
+            for directory, _, files in os.walk(staging):
+                if not files:
+                    continue
+                relative = os.path.relpath(directory, staging)
+                values = (
+                    [unquote(part.split("=", 1)[1]) for part in relative.split(os.sep)]
+                    if partition_keys
+                    else []
+                )
+                values = [HIVE_NULL_PARTITION if v == "NULL" else v for v in values]
+                destination = existing.get(tuple(values))
+                if destination is None:
+                    destination = (
+                        location.rstrip("/")
+                        + "/"
+                        + "".join(
+                            f"{key}={value}/"
+                            for key, value in zip(partition_keys, values)
+                        )
+                    )
+                    if partition_keys:
+                        new_partitions.append((values, destination))
+                local_dir = self.backend.local_path(destination)
+                os.makedirs(local_dir, exist_ok=True)
+                for name in files:
+                    shutil.move(
+                        os.path.join(directory, name), os.path.join(local_dir, name)
+                    )
+            return rows, new_partitions
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def _partition_inputs(self, table: Dict, partitions) -> List[Dict]:
+        return [
+            {
+                "Values": values,
+                "StorageDescriptor": {
+                    **table["StorageDescriptor"],
+                    "Location": location,
+                },
+                "Parameters": {},
+            }
+            for values, location in partitions
+        ]
+
+    def _ctas(self, match) -> Tuple[int, int]:
+        database, name = self._name(match.group("table"))
+        properties = {
+            key.lower(): value
+            for key, value in _PROPERTY.findall(match.group("properties"))
+        }
+        format = _unquote(properties.get("format", "'PARQUET'")).lower()
+        if format != "parquet":
+            raise ValueError("The local backend only writes parquet")
+        if "bucketed_by" in properties:
+            logger.warning("The local backend ignores bucketing.")
+        location = _unquote(properties["external_location"])
+        if self._files(location):
+            raise ValueError(f"The location {location} of the new table is not empty")
+        table = GlueTable(database, name)
+        table.glue_client = self.backend.glue
+        if table.exists():
+            raise ValueError(f'Table "{database}"."{name}" already exists')
+        partitioned_by = re.findall(r"'([^']*)'", properties.get("partitioned_by", ""))
+        query, scanned = self._translate(match.group("select"))
+        relation = self.db.sql(query)
+        types = dict(zip(relation.columns, relation.types))
+        rows, partitions = self._write(
+            query,
+            location,
+            partitioned_by,
+            _unquote(properties.get("parquet_compression", "'SNAPPY'")),
+        )
+        table.create(
+            columns=[
+                (column, hive_type(type_))
+                for column, type_ in types.items()
+                if column not in partitioned_by
+            ],
+            location=location,
+            partitions=[(key, hive_type(types[key])) for key in partitioned_by],
+        )
+        if partitions:
+            self.backend.glue.batch_create_partition(
+                DatabaseName=database,
+                TableName=name,
+                PartitionInputList=self._partition_inputs(table.metadata, partitions),
+            )
+        return rows, scanned
+
+    def _insert(self, match) -> Tuple[int, int]:
+        database, name = self._name(match.group("table"))
+        table = self._table(database, name)
+        keys = [key["Name"] for key in table.get("PartitionKeys", [])]
+        existing = {
+            tuple(partition["Values"]): partition["StorageDescriptor"]["Location"]
+            for page in self.backend.glue.get_paginator("get_partitions").paginate(
+                DatabaseName=database, TableName=name
+            )
+            for partition in page["Partitions"]
+        }
+        query, scanned = self._translate(match.group("select"))
+        # Athena inserts by position, the files have the names of the table
+        names = [col["Name"] for col in table["StorageDescriptor"]["Columns"]] + keys
+        relation = self.db.sql(query)
+        if len(relation.columns) != len(names):
+            raise ValueError(
+                f"The query has {len(relation.columns)} columns, "
+                f'"{database}"."{name}" has {len(names)}'
+            )
+        renamed = ", ".join(
+            f'"{old}" as "{new}"' for old, new in zip(relation.columns, names)
+        )
+        parameters = table.get("Parameters", {})
+        rows, partitions = self._write(
+            f"select {renamed} from ({query})",
+            table["StorageDescriptor"]["Location"],
+            keys,
+            parameters.get("parquet.compression", "SNAPPY"),
+            existing,
+        )
+        if partitions:
+            self.backend.glue.batch_create_partition(
+                DatabaseName=database,
+                TableName=name,
+                PartitionInputList=self._partition_inputs(table, partitions),
+            )
+        return rows, scanned
+
+    def _view(self, match) -> None:
+        database, name = self._name(match.group("table"))
+        query, _ = self._translate(match.group("select"))
+        relation = self.db.sql(query)
+        table_input = {
+            "Name": name,
+            "TableType": "VIRTUAL_VIEW",
+            "ViewOriginalText": match.group("select"),
+            "StorageDescriptor": {
+                "Columns": [
+                    {"Name": column, "Type": hive_type(type_)}
+                    for column, type_ in zip(relation.columns, relation.types)
+                ],
+                "Location": "",
+            },
+            "PartitionKeys": [],
+        }
+        try:
+            self.backend.glue.create_table(
+                DatabaseName=database, TableInput=table_input
+            )
+        except ClientError:
+            self.backend.glue.update_table(
+                DatabaseName=database, TableInput=table_input
+            )
+
+    def _run(self, sql: str) -> LocalResult:
+        query_id = uuid.uuid4().hex
+        submitted = datetime.now(timezone.utc)
+        start = time.monotonic()
+        statement = sql.strip().rstrip(";")
+        rows, output_rows, scanned, statement_type = [], None, 0, "DML"
+        state, reason = AthenaQueryExecution.STATE_SUCCEEDED, None
+        try:
+            with self._lock, span("duckdb.query", cpu=True):
+                if _CTAS.match(statement):
+                    statement_type = "DDL"
+                    output_rows, scanned = self._ctas(_CTAS.match(statement))
+                elif _INSERT.match(statement):
+                    output_rows, scanned = self._insert(_INSERT.match(statement))
+                elif _VIEW.match(statement):
+                    statement_type = "DDL"
+                    self._view(_VIEW.match(statement))
+                elif statement.lower().startswith(("select", "with")):
+                    query, scanned = self._translate(statement)
+                    rows = self.db.execute(query).fetchall()
+                else:
+                    raise ValueError(f"The local backend can't run {statement[:80]}")
+        except Exception as e:
+            logger.error(f"Local query failed: {e}")
+            state, reason = AthenaQueryExecution.STATE_FAILED, str(e)
+        elapsed = int((time.monotonic() - start) * 1000)
+        result = LocalResult(
+            {
+                "QueryExecution": {
+                    "QueryExecutionId": query_id,
+                    "Query": sql,
+                    "StatementType": statement_type,
+                    "QueryExecutionContext": {"Database": self.database},
+                    "Status": {
+                        "State": state,
+                        "StateChangeReason": reason,
+                        "SubmissionDateTime": submitted,
+                        "CompletionDateTime": datetime.now(timezone.utc),
+                    },
+                    "Statistics": {
+                        "DataScannedInBytes": scanned,
+                        "EngineExecutionTimeInMillis": elapsed,
+                        "TotalExecutionTimeInMillis": elapsed,
+                        "QueryQueueTimeInMillis": 0,
+                        "QueryPlanningTimeInMillis": 0,
+                        "ServiceProcessingTimeInMillis": 0,
+                    },
+                    "WorkGroup": self.workgroup,
+                }
+            },
+            rows,
+        )
+        self._executions[query_id] = result
+        if output_rows is not None:
+            self._output_rows[query_id] = output_rows
+        return result
+
+    def _future(self, result: LocalResult) -> QueryFuture:
+        future = QueryFuture(result.query_id)
+        if result.state == AthenaQueryExecution.STATE_SUCCEEDED:
+            future.set_result(result)
+        else:
+            future.set_exception(OperationalError(result.state_change_reason))
+        return future
+
+    def query(self, sql: str):
+        logger.info("{}".format(sql))
+        result = self._run(sql)
+        if result.state != AthenaQueryExecution.STATE_SUCCEEDED:
+            raise OperationalError(result.state_change_reason)
+        self._record_stats(self._future(result))
+        return result
+
+    def submit(self, sql: str, timeout=None) -> QueryFuture:
+        logger.info("{}".format(sql))
+        return self._watched(self._future(self._run(sql)))
+
+    def attach(self, query_id: str, timeout=None) -> QueryFuture:
+        if query_id not in self._executions:
+            future = QueryFuture(query_id)
+            future.set_exception(OperationalError(f"Unknown local query {query_id}"))
+            return future
+        return self._watched(self._future(self._executions[query_id]))
+
+    def cancel(self, query_id: str) -> None:
+        pass
+
+    def output_rows(self, query_id: str) -> Optional[int]:
+        return self._output_rows.get(query_id)
+
+
+class LocalBackend(Backend):
+    """
+    Glue, S3 and Athena on a local directory, for offline runs, tests and benchmarks:
+    the catalog is stored in <root>/catalog/, s3://bucket/key in <root>/s3/bucket/key
+    and the queries run with DuckDB
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = os.path.abspath(root)
+        self.glue = LocalGlueClient(os.path.join(self.root, "catalog"))
+        self.s3 = LocalS3Client(os.path.join(self.root, "s3"))
+
+    def glue_client(self) -> LocalGlueClient:
+        return self.glue
+
+    def s3_client(self) -> LocalS3Client:
+        return self.s3
+
+    def connection(self, database, workgroup, s3_staging_dir) -> LocalAthenaConnection:
+        return LocalAthenaConnection(self, database, workgroup, s3_staging_dir)
+
+    def local_path(self, location: str) -> str:
+        """
+        :param location: s3://bucket/prefix
+        :return: The directory standing in for the location
+        """
+        s3_url_parts = splitted_s3_key(location)
+        return self.s3.path(s3_url_parts["bucket"], s3_url_parts["path"])
+
+    def arrow_filesystem(self, location: str):
+        from pyarrow import fs
+
+        return fs.LocalFileSystem(), self.local_path(location)
@@ -0,0 +1,170 @@
+import base64
+import gzip
+import hashlib
+import json
+import math
+import os
+from bisect import bisect_left
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+from urllib.parse import urlsplit
+
+# Bump when the structure of the manifest changes, old manifests are ignored
+MANIFEST_VERSION = 1
+
+
+class BloomFilter:
+    """
+    Set membership with false positives but without false negatives,
+    a few bits per key instead of the keys themselves
+    """
+
+    def __init__(self, capacity: int, error_rate=0.01) -> None:
+        """
+        :param capacity: Expected number of keys
+        :param error_rate: False positive rate at capacity
+        """
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / pow(math.log(2), 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "size": self.size,
+            "hashes": self.hashes,
+            "bits": base64.b64encode(self.bits).decode(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "BloomFilter":
+        bloom = cls.__new__(cls)
+        bloom.size = data["size"]
+        bloom.hashes = data["hashes"]
+        bloom.bits = bytearray(base64.b64decode(data["bits"]))
+        return bloom
+
+
+class ObjectManifest:
+    """
+    S3 objects that were flattened already, as sorted keys with their ETags.
+    A bloom filter answers most lookups of new keys without searching the keys.
+    Stored as gzipped JSON, either locally or on S3.
+    """
+
+    def __init__(self, objects: Iterable[Tuple[str, str]] = ()) -> None:
+        """
+        :param objects: (key, etag) pairs
+        """
+        self.keys: List[str] = []
+        self.etags: List[str] = []
+        self.bloom = BloomFilter(0)
+        self.update(objects)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        :return: ETag of the key, None if it is not in the manifest
+        """
+        if key not in self.bloom:
+            return None
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.etags[i]
+        return None
+
+    def diff(self, objects: Iterable[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """
+        :param objects: (key, etag) pairs of the current listing
+        :return: Objects that are new or whose ETag changed
+        """
+        return [(key, etag) for key, etag in objects if self.get(key) != etag]
+
+    def update(self, objects: Iterable[Tuple[str, str]]) -> None:
+        merged = dict(zip(self.keys, self.etags))
+        merged.update(objects)
+        self.keys = sorted(merged)
+        self.etags = [merged[key] for key in self.keys]
+        # Sized with headroom, so that the next runs don't fill it up
+        self.bloom = BloomFilter(2 * len(self.keys))
+        for key in self.keys:
+            self.bloom.add(key)
+
+    def dumps(self) -> bytes:
+        return gzip.compress(
+            json.dumps(
+                {
+                    "version": MANIFEST_VERSION,
+                    "keys": self.keys,
+                    "etags": self.etags,
+                    "bloom": self.bloom.to_dict(),
+                }
+            ).encode()
+        )
+
+    @classmethod
+    def loads(cls, data: bytes) -> "ObjectManifest":
+        content = json.loads(gzip.decompress(data))
+        manifest = cls()
+        if content.get("version") != MANIFEST_VERSION:
+            return manifest
+        manifest.keys = content["keys"]
+        manifest.etags = content["etags"]
+        manifest.bloom = BloomFilter.from_dict(content["bloom"])
+        return manifest
+
+    @classmethod
+    def load(cls, path: str, client=None) -> "ObjectManifest":
+        """
+        :param path: Local path or s3://bucket/key
+        :param client: Boto3 s3 client, required for s3 paths
+        :return: The manifest, empty if it doesn't exist yet
+        """
+        if path.startswith("s3://"):
+            _, bucket, key, _, _ = urlsplit(path)
+            try:
+                data = client.get_object(Bucket=bucket, Key=key.lstrip("/"))[
+                    "Body"
+                ].read()
+            except client.exceptions.NoSuchKey:
+                return cls()
+        else:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return cls()
+        return cls.loads(data)
+
+    def save(self, path: str, client=None) -> None:
+        data = self.dumps()
+        if path.startswith("s3://"):
+            _, bucket, key, _, _ = urlsplit(path)
+            client.put_object(Bucket=bucket, Key=key.lstrip("/"), Body=data)
+        else:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
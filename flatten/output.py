@@ -0,0 +1,103 @@
+import math
+from typing import Dict
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+
+class StorageFormat(NamedTuple):
+    input_format: str
+    output_format: str
+    serde: str
+    # Table parameter that sets the codec of INSERT INTO queries
+    compression_parameter: str
+    compressions: Tuple[str, ...]
+
+
+STORAGE_FORMATS = {
+    "parquet": StorageFormat(
+        input_format="org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+        output_format="org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+        serde="org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe",
+        compression_parameter="parquet.compression",
+        compressions=("SNAPPY", "GZIP", "ZSTD", "LZ4", "UNCOMPRESSED"),
+    ),
+    "orc": StorageFormat(
+        input_format="org.apache.hadoop.hive.ql.io.orc.OrcInputFormat",
+        output_format="org.apache.hadoop.hive.ql.io.orc.OrcOutputFormat",
+        serde="org.apache.hadoop.hive.ql.io.orc.OrcSerde",
+        compression_parameter="orc.compress",
+        compressions=("SNAPPY", "ZLIB", "ZSTD", "LZ4", "NONE"),
+    ),
+}
+
+
+def bucket_count_for(
+    source_bytes: int,
+    partitions: int,
+    target_file_size: int,
+    compression_ratio: float,
+) -> int:
+    """
+    Number of buckets that gives files of about target_file_size, athena writes
+    one file per bucket and partition
+    :param source_bytes: Size of the source table
+    :param partitions: Number of partitions the data is spread over
+    :param target_file_size: Wanted size of the written files in bytes
+    :param compression_ratio: Expected size of the output relative to the source
+    :return:
+    """
+    partition_bytes = source_bytes * compression_ratio / max(partitions, 1)
+    return max(1, math.ceil(partition_bytes / target_file_size))
+
+
+class OutputOptions(NamedTuple):
+    """
+    Storage of the flat table
+    format: "parquet" or "orc"
+    compression: Codec, e.g. "ZSTD", "SNAPPY" or "GZIP" ("ZLIB" for orc)
+    partitioned_by: Flat columns the table is partitioned by, defaults to the
+        partition keys of the source table
+    bucketed_by: Flat columns whose hash distributes the rows over the buckets
+    bucket_count: Number of buckets, derived from the source size if None
+    target_file_size: Wanted file size in bytes for the derived bucket count
+    compression_ratio: Expected output size relative to the source size
+    """
+
+    format: str = "parquet"
+    compression: str = "SNAPPY"
+    partitioned_by: Tuple[str, ...] = ()
+    bucketed_by: Tuple[str, ...] = ()
+    bucket_count: Optional[int] = None
+    target_file_size: int = 256 * 1024 * 1024
+    compression_ratio: float = 0.25
+
+    @property
+    def storage(self) -> StorageFormat:
+        return STORAGE_FORMATS[self.format.lower()]
+
+    def validate(self) -> None:
+        if self.format.lower() not in STORAGE_FORMATS:
+            raise ValueError(
+                f"Unknown format {self.format}, use one of {list(STORAGE_FORMATS)}"
+            )
+        if self.compression.upper() not in self.storage.compressions:
+            raise ValueError(
+                f"{self.format} supports the compressions {self.storage.compressions}"
+            )
+        if self.bucket_count is not None and not self.bucketed_by:
+            raise ValueError("bucket_count needs bucketed_by columns")
+        if set(self.bucketed_by) & set(self.partitioned_by):
+            raise ValueError("Columns can't be used for partitioning and bucketing")
+
+    def table_parameters(self) -> Dict:
+        """
+        :return: Glue table parameters of the format, also used by INSERT INTO queries
+        """
+        return {
+            "classification": self.format.lower(),
+            "typeOfData": "file",
+            "has_encrypted_data": "false",
+            "EXTERNAL": "TRUE",
+            self.storage.compression_parameter: self.compression.upper(),
+        }
@@ -0,0 +1,93 @@
+from fnmatch import fnmatchcase
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+
+class ColumnProjection:
+    """
+    Selects the leaves of the flattened schema with dotted path patterns, e.g.
+    ["payload.device.*", "!payload.debug.**"]. Every segment is a glob pattern matched
+    case insensitively, "**" matches any number of segments and a pattern also matches
+    everything below the struct it names. Patterns prefixed with "!" exclude, the last
+    matching pattern wins. Without include patterns everything that isn't excluded
+    is selected.
+    """
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        self.patterns: List[Tuple[bool, Tuple[str, ...]]] = []
+        for pattern in patterns:
+            include = not pattern.startswith("!")
+            segments = tuple(pattern.lstrip("!").lower().split("."))
+            if not all(segments):
+                raise ValueError(f"Invalid column pattern {pattern}")
+            self.patterns.append((include, segments))
+        self.default = not any(include for include, _ in self.patterns)
+
+    def __repr__(self) -> str:
+        return f"ColumnProjection({self.key()})"
+
+    def key(self) -> List[str]:
+        return [
+            ("" if include else "!") + ".".join(segments)
+            for include, segments in self.patterns
+        ]
+
+    @staticmethod
+    def _states(segments: Tuple[str, ...], path: Tuple[str, ...]) -> Optional[Set[int]]:
+        """
+        Runs the pattern as an automaton over the path
+        :return: None if the pattern matches the path or one of its prefixes,
+            otherwise the pattern positions still alive after the whole path
+        """
+
+        def closure(states):
+            states = set(states)
+            for i in sorted(states):
+                while i < len(segments) and segments[i] == "**":
+                    i += 1
+                    states.add(i)
+            return states
+
+        states = closure({0})
+        for segment in path:
+            if len(segments) in states:
+                return None
+            next_states = set()
+            for i in states:
+                if i == len(segments):
+                    continue
+                if segments[i] == "**":
+                    next_states.add(i)
+                elif fnmatchcase(segment, segments[i]):
+                    next_states.add(i + 1)
+            states = closure(next_states)
+            if not states:
+                return states
+        return None if len(segments) in states else states
+
+    def _decide(self, path: Tuple[str, ...], leaf: bool) -> Optional[bool]:
+        path = tuple(segment.lower() for segment in path)
+        for include, segments in reversed(self.patterns):
+            states = self._states(segments, path)
+            if states is None:
+                return include
+            if states and not leaf:
+                # The pattern may match some leaves below the path but not others
+                return None
+        return self.default
+
+    def selects(self, path: Tuple[str, ...]) -> bool:
+        """
+        :param path: Field names of a leaf, starting with the column name
+        """
+        return self._decide(path, leaf=True)
+
+    def prunes(self, path: Tuple[str, ...]) -> bool:
+        """
+        :param path: Field names of a struct, starting with the column name
+        :return: True if no leaf below the struct is selected
+        """
+        return self._decide(path, leaf=False) is False
@@ -0,0 +1,177 @@
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Tuple
+
+from botocore.exceptions import ClientError
+from loguru import logger
+
+# Error codes of S3 worth retrying, SlowDown is S3's throttling response
+RETRYABLE_ERRORS = {"SlowDown", "InternalError", "ServiceUnavailable", "RequestTimeout"}
+
+
+class PurgeResult(NamedTuple):
+    objects: int
+    size: int
+    seconds: float
+    errors: List[Dict]
+    dry_run: bool = False
+
+    @property
+    def objects_per_second(self) -> float:
+        return self.objects / self.seconds if self.seconds else 0.0
+
+
+class S3Purger:
+    """
+    Deletes all objects under an S3 prefix. Listing pages are handed to a bounded
+    thread pool as DeleteObjects batches while the listing continues.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_workers=8,
+        max_retries=5,
+        retry_delay=0.5,
+        progress_every=10,
+    ):
+        """
+        :param client: Boto3 s3 client
+        :param max_workers: Number of concurrent DeleteObjects requests
+        :param max_retries: Retries of throttled or failed batches
+        :param retry_delay: Base delay of the exponential backoff in seconds
+        :param progress_every: Log progress every n deleted batches
+        """
+        self.client = client
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.progress_every = progress_every
+
+    def _backoff(self, attempt: int) -> None:
+        time.sleep(self.retry_delay * pow(2, attempt) * random.uniform(0.5, 1.5))
+
+    def _delete_batch(self, bucket: str, objects: List[Dict]) -> Tuple[List[Dict], int]:
+        """
+        Deletes up to 1000 listed objects, retrying throttled requests and keys
+        :return: Errors of keys that could not be deleted and the size of these keys
+        """
+        keys = [obj["Key"] for obj in objects]
+        # Errors that are not retried, collected over all attempts
+        failed = []
+        retryable = []
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.client.delete_objects(
+                    Bucket=bucket,
+                    Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+                )
+            except ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code not in RETRYABLE_ERRORS or attempt == self.max_retries:
+                    raise
+                logger.debug(f"DeleteObjects failed with {code}, retrying.")
+                self._backoff(attempt)
+                continue
+
+            errors = response.get("Errors", [])
+            failed.extend(e for e in errors if e.get("Code") not in RETRYABLE_ERRORS)
+            retryable = [e for e in errors if e.get("Code") in RETRYABLE_ERRORS]
+            keys = [e["Key"] for e in retryable]
+            if not keys or attempt == self.max_retries:
+                break
+            logger.debug(f"{len(keys)} keys were throttled, retrying.")
+            self._backoff(attempt)
+        errors = failed + retryable
+        failed_keys = {e.get("Key") for e in errors}
+        return errors, sum(
+            obj.get("Size", 0) for obj in objects if obj["Key"] in failed_keys
+        )
+
+    def _pages(self, bucket: str, prefix: str, recursive=True):
+        paginator = self.client.get_paginator("list_objects_v2")
+        delimiter = {} if recursive else {"Delimiter": "/"}
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, **delimiter):
+            yield page.get("Contents", [])
+
+    @staticmethod
+    def _collect(future, errors: List[Dict]) -> int:
+        """
+        Adds the errors of a finished batch to errors
+        :return: Size of the objects that could not be deleted
+        """
+        batch_errors, failed_size = future.result()
+        errors.extend(batch_errors)
+        return failed_size
+
+    def purge(
+        self, bucket: str, prefix: str, dry_run=False, recursive=True
+    ) -> PurgeResult:
+        """
+        :param bucket:
+        :param prefix: Key prefix, has to be non-empty
+        :param dry_run: Only count the objects and bytes that would be deleted
+        :param recursive: Also delete the objects in the "folders" below prefix,
+            otherwise only the objects directly under it
+        :return:
+        """
+        if not prefix:
+            raise ValueError(f"Refusing to purge the whole bucket {bucket}")
+        start = time.monotonic()
+        objects = 0
+        size = 0
+        errors = []
+        failed_size = 0
+        batches = 0
+
+        if dry_run:
+            for contents in self._pages(bucket, prefix, recursive):
+                objects += len(contents)
+                size += sum(obj.get("Size", 0) for obj in contents)
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                pending = set()
+                for contents in self._pages(bucket, prefix, recursive):
+                    if not contents:
+                        continue
+                    # Bound the number of listed but not yet deleted batches
+                    if len(pending) >= 2 * self.max_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            failed_size += self._collect(future, errors)
+                    pending.add(executor.submit(self._delete_batch, bucket, contents))
+                    objects += len(contents)
+                    size += sum(obj.get("Size", 0) for obj in contents)
+                    batches += 1
+                    if batches % self.progress_every == 0:
+                        elapsed = time.monotonic() - start
+                        logger.info(
+                            f"Purging s3://{bucket}/{prefix}: {objects} objects listed, "
+                            f"{objects / elapsed:.0f} objects/s"
+                        )
+                for future in pending:
+                    failed_size += self._collect(future, errors)
+            objects -= len(errors)
+            size -= failed_size
+
+        result = PurgeResult(
+            objects=objects,
+            size=size,
+            seconds=time.monotonic() - start,
+            errors=errors,
+            dry_run=dry_run,
+        )
+        logger.info(
+            f"{'Would delete' if dry_run else 'Deleted'} {result.objects} objects "
+            f"({result.size / 1024 / 1024:.1f} MiB) from s3://{bucket}/{prefix} "
+            f"in {result.seconds:.1f}s"
+        )
+        if errors:
+            logger.warning(f"{len(errors)} objects could not be deleted: {errors[:5]}")
+        return result
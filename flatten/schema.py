@@ -0,0 +1,191 @@
+import re
+from typing import Callable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+from flatten.hive_parser import HiveParser
+from lark import Tree
+
+# Integer and floating point types that Athena reads from Parquet as a wider type.
+# Integers can't become doubles and decimals can't change precision or scale.
+NUMERIC_WIDENINGS = {
+    "tinyint": ("smallint", "int", "integer", "bigint"),
+    "smallint": ("int", "integer", "bigint"),
+    "int": ("integer", "bigint"),
+    "integer": ("int", "bigint"),
+    "bigint": (),
+    "float": ("double",),
+}
+_STRING_TYPES = re.compile(r"(string|varchar(\(\d+\))?|char\(\d+\))")
+
+# Kinds of changes that update_table can apply without rewriting data
+COMPATIBLE_CHANGES = ("add", "drop", "widen")
+
+
+class ColumnChange(NamedTuple):
+    kind: str
+    name: str
+    old_type: Optional[str] = None
+    new_type: Optional[str] = None
+    reason: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self.kind == "add":
+            return f"+ {self.name} {self.new_type}"
+        if self.kind == "drop":
+            return f"- {self.name} {self.old_type}"
+        text = f"~ {self.name} {self.old_type} -> {self.new_type}"
+        return f"{text} ({self.reason})" if self.reason else text
+
+
+class SchemaDiff(NamedTuple):
+    changes: List[ColumnChange]
+
+    @property
+    def compatible(self) -> bool:
+        """Whether all changes can be applied in place"""
+        return all(change.kind in COMPATIBLE_CHANGES for change in self.changes)
+
+    def __bool__(self) -> bool:
+        return bool(self.changes)
+
+    def report(self) -> str:
+        if not self.changes:
+            return "The schema is unchanged."
+        lines = [
+            f"{len(self.changes)} column changes, "
+            + (
+                "applied in place."
+                if self.compatible
+                else "incompatible, the data has to be rewritten."
+            )
+        ]
+        lines.extend(str(change) for change in self.changes)
+        return "\n".join(lines)
+
+
+def _normalize(type_str: str) -> str:
+    return re.sub(r"\s+", "", type_str.lower())
+
+
+def _readable_as(old, new) -> Optional[str]:
+    """
+    Checks if data written as the parsed type old can be read as the parsed type new
+    :return: None if it can, otherwise the reason why not
+    """
+    if isinstance(old, str) and isinstance(new, str):
+        old, new = _normalize(old), _normalize(new)
+        if old == new or new in NUMERIC_WIDENINGS.get(old, ()):
+            return None
+        if _STRING_TYPES.fullmatch(old) and new == "string":
+            return None
+        return f"{old} can't be read as {new}"
+    if isinstance(old, dict) and isinstance(new, dict):
+        new_fields = {name.lower(): type_ for name, type_ in new.items()}
+        for name, type_ in old.items():
+            if name.lower() not in new_fields:
+                return f"field {name} was removed"
+            reason = _readable_as(type_, new_fields[name.lower()])
+            if reason:
+                return f"{name}: {reason}"
+        return None
+    if isinstance(old, list) and isinstance(new, list):
+        if not old or not new:
+            return None if old == new else "the element type changed"
+        return _readable_as(old[0], new[0])
+    if isinstance(old, Tree) and isinstance(new, Tree):
+        return _readable_as(old.children[-2], new.children[-2]) or _readable_as(
+            old.children[-1], new.children[-1]
+        )
+    return "the kind of type changed"
+
+
+def diff_schema(
+    current: List[tuple],
+    desired: List[tuple],
+    parse: Callable = None,
+    partition_keys: List[tuple] = (),
+    by_index=False,
+) -> SchemaDiff:
+    """
+    Compares the columns of a flat table with the columns it should have.
+    Parquet columns are resolved by name, so added and dropped columns and wider types
+    only need a new table definition. Narrower or otherwise changed types and columns
+    colliding with partition keys need a rewrite of the data.
+    :param current: Columns of the table [("name", "type"), ...]
+    :param desired: Columns the table should have, e.g. of the flat mapping
+    :param parse: Parses hive type strings, defaults to a new HiveParser
+    :param partition_keys: Partition keys of the table, they can't become columns
+    :param by_index: The files are read by column index like ORC, only columns
+        appended at the end can be applied in place
+    :return:
+    """
+    parse = parse or HiveParser()
+    current_types = {name.lower(): (name, type_) for name, type_ in current}
+    desired_names = {name.lower() for name, _ in desired}
+    partition_names = {name.lower() for name, _ in partition_keys}
+    changes = []
+    for name, type_ in desired:
+        if name.lower() in partition_names:
+            changes.append(
+                ColumnChange(
+                    "incompatible", name, None, type_, "collides with a partition key"
+                )
+            )
+        elif name.lower() not in current_types:
+            changes.append(ColumnChange("add", name, new_type=type_))
+        else:
+            old_type = current_types[name.lower()][1]
+            if _normalize(old_type) == _normalize(type_):
+                continue
+            reason = _readable_as(parse(old_type), parse(type_))
+            changes.append(
+                ColumnChange(
+                    "widen" if reason is None else "incompatible",
+                    name,
+                    old_type,
+                    type_,
+                    reason,
+                )
+            )
+    for key, (name, type_) in current_types.items():
+        if key not in desired_names:
+            changes.append(ColumnChange("drop", name, old_type=type_))
+    if by_index:
+        changes = _appended_only(current, desired, changes)
+    return SchemaDiff(changes)
+
+
+def _appended_only(
+    current: List[tuple], desired: List[tuple], changes: List[ColumnChange]
+) -> List[ColumnChange]:
+    """
+    Marks every change but columns appended after the existing ones as incompatible
+    """
+    reason = "columns are read by index"
+    current_names = [name.lower() for name, _ in current]
+    desired_names = [name.lower() for name, _ in desired]
+    appended = (
+        set(desired_names[len(current_names) :])
+        if desired_names[: len(current_names)] == current_names
+        else set()
+    )
+    result = [
+        change
+        if change.kind == "incompatible"
+        or (change.kind == "add" and change.name.lower() in appended)
+        else change._replace(kind="incompatible", reason=reason)
+        for change in changes
+    ]
+    if not changes and desired_names != current_names:
+        result.append(
+            ColumnChange(
+                "incompatible",
+                "column order",
+                ", ".join(current_names),
+                ", ".join(desired_names),
+                reason,
+            )
+        )
+    return result
@@ -0,0 +1,124 @@
+import os
+from functools import lru_cache
+from typing import IO
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import sqlparse
+from jinja2 import Template
+from loguru import logger
+
+# sqlparse needs seconds and lots of memory for statements of thousands of columns
+PRETTY_MAX_BYTES = 64 * 1024
+
+
+@lru_cache(maxsize=64)
+def compiled_template(path: str, modified: float) -> Template:
+    """
+    Compiled jinja template, compiled once per process and file version
+    :param modified: Modification time of the file, a changed file is compiled again
+    """
+    with open(path) as f:
+        return Template(f.read())
+
+
+def render_template(path: str, query_args: dict) -> str:
+    return compiled_template(path, os.path.getmtime(path)).render(query_args)
+
+
+def format_sql(sql: str, max_bytes: Optional[int] = PRETTY_MAX_BYTES) -> str:
+    """
+    Pretty prints sql with comma first reindented lines and lower case keywords
+    :param max_bytes: Larger statements are returned unchanged, None formats all
+    """
+    if max_bytes is not None and len(sql) > max_bytes:
+        logger.debug(f"Not formatting {len(sql)} bytes of sql.")
+        return sql
+    return sqlparse.format(
+        sql,
+        comma_first=True,
+        reindent=True,
+        keyword_case="lower",
+        strip_comments=True,
+    )
+
+
+def _array(values: Iterable[str]) -> str:
+    return "ARRAY[" + ", ".join(f"'{value}'" for value in values) + "]"
+
+
+def _select(
+    columns: List[Tuple[str, str]], source_tb_name: str, where: Optional[str]
+) -> Iterator[str]:
+    for i, (source_column, target_column) in enumerate(columns):
+        yield f"{'select ' if i == 0 else '     ,  '}{source_column} as {target_column}\n"
+    yield f"from {source_tb_name}"
+    if where:
+        yield f"\nwhere {where}"
+
+
+def create_table_as(
+    tmp_table: str,
+    source_tb_name: str,
+    location: str,
+    columns: List[Tuple[str, str]],
+    format="parquet",
+    compression="SNAPPY",
+    partitioned_by: List[str] = (),
+    bucketed_by: List[str] = (),
+    bucket_count: Optional[int] = None,
+    where: Optional[str] = None,
+) -> Iterator[str]:
+    """
+    Builds the CTAS query of a flat table line by line, in the layout format_sql
+    gives it, without parsing the statement
+    :param columns: (source expression, target name) of the selected columns
+    :return: Lines of the statement
+    """
+    head = f"create table {tmp_table} with ("
+    properties = [
+        f"external_location = '{location}'",
+        f"format = '{format.upper()}'",
+        f"{format.lower()}_compression = '{compression.upper()}'",
+    ]
+    if bucketed_by:
+        properties.append(
+            f"bucketed_by = {_array(bucketed_by)}, bucket_count = {bucket_count}"
+        )
+    if partitioned_by:
+        properties.append(f"partitioned_by = {_array(partitioned_by)}")
+    indent = " " * (len(head) - 2)
+    yield head + f"\n{indent},  ".join(properties) + ") as\n"
+    yield from _select(columns, source_tb_name, where)
+
+
+def insert_into(
+    target_table: str,
+    source_tb_name: str,
+    columns: List[Tuple[str, str]],
+    where: Optional[str] = None,
+) -> Iterator[str]:
+    """
+    Builds the INSERT INTO query of a flat table line by line
+    :return: Lines of the statement
+    """
+    yield f"insert into {target_table}\n"
+    yield from _select(columns, source_tb_name, where)
+
+
+def write_sql(lines: Iterable[str], output: Union[str, IO[str]]) -> None:
+    """
+    Streams the lines of a statement to a file without joining them in memory
+    :param output: Path or text file
+    """
+    if isinstance(output, str):
+        with open(output, "w") as f:
+            f.writelines(lines)
+            f.write(";\n")
+    else:
+        output.writelines(lines)
+        output.write(";\n")
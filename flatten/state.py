@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+from datetime import timezone
+from typing import Dict
+
+from flatten.utils import cache_dir
+
+
+class RunState:
+    """
+    Progress of a single flatten run, persisted as JSON after every step so that
+    an interrupted run can be resumed.
+    Steps: "started", "refreshed" (target table refreshed), "submitted" (query started),
+    "succeeded" (query finished). The file is removed once the run is cleaned up.
+    """
+
+    def __init__(self, path: str, run_id: str, data: Dict = None) -> None:
+        self.path = path
+        self.run_id = run_id
+        self.data = data or {}
+
+    @property
+    def step(self):
+        return self.data.get("step")
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def update(self, **kwargs) -> None:
+        self.data.update(kwargs)
+        self.data["updated"] = datetime.now(timezone.utc).isoformat()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self) -> None:
+        self.data = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class RunStateStore:
+    """
+    Local directory of run states, one file per source/target combination
+    """
+
+    def __init__(self, directory: str = None) -> None:
+        self.directory = directory or os.path.join(cache_dir(), "runs")
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def run_id(*parts) -> str:
+        return hashlib.sha256("\x1f".join(map(str, parts)).encode()).hexdigest()[:16]
+
+    def load(self, *parts) -> RunState:
+        """
+        :param parts: Values identifying the run, e.g. source and target table
+        :return: The state of the unfinished run or an empty state
+        """
+        run_id = self.run_id(*parts)
+        path = os.path.join(self.directory, f"{run_id}.json")
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        return RunState(path, run_id, data)
@@ -0,0 +1,279 @@
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+TRACE_FORMATS = ("chrome", "json")
+
+
+class Span:
+    __slots__ = ("id", "name", "parent", "thread", "start", "end", "attributes")
+
+    def __init__(self, id, name, parent, thread, start, attributes) -> None:
+        self.id = id
+        self.name = name
+        self.parent = parent
+        self.thread = thread
+        self.start = start
+        self.end = None
+        self.attributes = attributes
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end - self.start) / 1e6
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """
+    Collects nested spans of the phases of flatten runs. Spans started in a thread are
+    children of the innermost open span of that thread. With profile=True the local
+    CPU phases are run under cProfile and memory allocations are traced.
+    """
+
+    def __init__(self, profile=False) -> None:
+        self.profile = profile
+        self.spans: List[Span] = []
+        self.wall_start = time.time()
+        self._start = time.perf_counter_ns()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = iter(range(1, 2**62))
+        self._profiles: Dict[int, cProfile.Profile] = {}
+        if profile and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stack(self) -> List[Span]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+            self._local.cpu_depth = 0
+        return self._local.stack
+
+    def current(self) -> Optional[Span]:
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def _new_span(self, name, parent, attributes) -> Span:
+        with self._lock:
+            span_id = next(self._ids)
+        return Span(
+            span_id,
+            name,
+            parent.id if parent else None,
+            threading.get_ident(),
+            time.perf_counter_ns(),
+            attributes,
+        )
+
+    @contextmanager
+    def span(self, name: str, cpu=False, **attributes) -> Iterator[Span]:
+        """
+        :param name: Name of the phase, e.g. "glue.get_table"
+        :param cpu: Local CPU work, profiled if profiling is enabled
+        :param attributes: Values describing the span, more can be added with set
+        """
+        stack = self._stack()
+        span = self._new_span(name, self.current(), attributes)
+        stack.append(span)
+        profiled = cpu and self.profile and self._local.cpu_depth == 0
+        if cpu:
+            self._local.cpu_depth += 1
+        if profiled:
+            try:
+                self._profile().enable()
+            except ValueError:
+                # Newer Pythons allow only one active profiler at a time
+                profiled = False
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            if profiled:
+                self._profile().disable()
+            if cpu:
+                self._local.cpu_depth -= 1
+            span.end = time.perf_counter_ns()
+            stack.pop()
+            with self._lock:
+                self.spans.append(span)
+
+    def record(
+        self, name: str, start_ns: int, parent: Optional[Span] = None, **attributes
+    ) -> None:
+        """
+        Adds a finished span, e.g. of an Athena query that was watched by another thread
+        :param start_ns: time.perf_counter_ns() at the start of the span
+        """
+        span = self._new_span(name, parent, attributes)
+        span.start = start_ns
+        span.end = time.perf_counter_ns()
+        with self._lock:
+            self.spans.append(span)
+
+    def _profile(self) -> cProfile.Profile:
+        thread = threading.get_ident()
+        with self._lock:
+            if thread not in self._profiles:
+                self._profiles[thread] = cProfile.Profile()
+            return self._profiles[thread]
+
+    def to_json(self) -> Dict:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        return {
+            "start": self.wall_start,
+            "spans": [
+                {
+                    "id": span.id,
+                    "parent": span.parent,
+                    "name": span.name,
+                    "thread": span.thread,
+                    "start_ms": (span.start - self._start) / 1e6,
+                    "duration_ms": span.duration_ms,
+                    "attributes": span.attributes,
+                }
+                for span in spans
+            ],
+        }
+
+    def to_chrome_trace(self) -> Dict:
+        """
+        :return: Trace in the Chrome trace event format, viewable in chrome://tracing
+            or Perfetto
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        return {
+            "traceEvents": [
+                {
+                    "name": span.name,
+                    "ph": "X",
+                    "ts": (span.start - self._start) / 1e3,
+                    "dur": (span.end - span.start) / 1e3,
+                    "pid": os.getpid(),
+                    "tid": span.thread,
+                    "args": span.attributes,
+                }
+                for span in spans
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def save(self, path: str, format="chrome") -> None:
+        if format not in TRACE_FORMATS:
+            raise ValueError(
+                f"Unknown trace format {format}, use one of {TRACE_FORMATS}"
+            )
+        trace = self.to_chrome_trace() if format == "chrome" else self.to_json()
+        with open(path, "w") as f:
+            json.dump(trace, f, default=str)
+
+    def save_profile(self, directory: str, limit=40) -> List[str]:
+        """
+        Writes the cProfile statistics of the CPU phases (cpu.pstats and the readable
+        cpu.txt) and the biggest memory allocations (memory.txt)
+        :return: Paths of the written files
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        with self._lock:
+            profiles = list(self._profiles.values())
+        if profiles:
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            paths.append(os.path.join(directory, "cpu.pstats"))
+            stats.dump_stats(paths[-1])
+            text = io.StringIO()
+            pstats.Stats(paths[-1], stream=text).sort_stats("cumulative").print_stats(
+                limit
+            )
+            paths.append(os.path.join(directory, "cpu.txt"))
+            with open(paths[-1], "w") as f:
+                f.write(text.getvalue())
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            paths.append(os.path.join(directory, "memory.txt"))
+            with open(paths[-1], "w") as f:
+                f.write(f"current {current} bytes, peak {peak} bytes\n")
+                for stat in snapshot.statistics("lineno")[:limit]:
+                    f.write(f"{stat}\n")
+        return paths
+
+    def close(self) -> None:
+        if self.profile and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+_tracer: Optional[Tracer] = None
+
+
+def enable_tracing(profile=False) -> Tracer:
+    global _tracer
+    _tracer = Tracer(profile=profile)
+    return _tracer
+
+
+def disable_tracing() -> None:
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = None
+
+
+def tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+def annotate(**attributes) -> None:
+    """
+    Adds attributes to the innermost open span of the active tracer
+    """
+    current = _tracer.current() if _tracer is not None else None
+    if current is not None:
+        current.set(**attributes)
+
+
+@contextmanager
+def span(name: str, cpu=False, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Span of the active tracer, does nothing if tracing is disabled
+    """
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.span(name, cpu=cpu, **attributes) as current:
+        yield current
+
+
+def traced(name: str, cpu=False):
+    """
+    Runs a function in a span of the active tracer
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            with _tracer.span(name, cpu=cpu):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
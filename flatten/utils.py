@@ -1,9 +1,26 @@
+import os
 from functools import lru_cache
+from typing import Any
 from typing import Dict
+from typing import Iterator
+from typing import Tuple
 
 from slugify import slugify
 
 
+def cache_dir() -> str:
+    """
+    Directory for on-disk caches, overridable with FLATTEN_CACHE_DIR
+    :return:
+    """
+    path = os.environ.get(
+        "FLATTEN_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "flatten-athena-table"),
+    )
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
 @lru_cache(maxsize=1024)
 def slugify_key(
     key,
@@ -59,3 +76,46 @@ def flatten_dict(
                 yield format_func(key=key), value
 
     return dict(items())
+
+
+@lru_cache(maxsize=65536)
+def slugify_segment(key: str, separator="_") -> str:
+    return slugify_key(key, separator=separator)
+
+
+def flatten_struct(
+    name: str, fields: Dict, projection=None
+) -> Iterator[Tuple[str, str, Any]]:
+    """
+    Walks a parsed struct column depth first, without recursion, and yields the
+    query path, the slugified target name and the type of every leaf. Gives the same
+    names as flatten_dict with column_query_path_format and slugify_key, but slugifies
+    every field name only once.
+    :param name: Name of the struct column
+    :param fields: Parsed struct type
+    :param projection: ColumnProjection, skips unselected leaves and whole structs
+        without selected leaves
+    :return:
+    """
+    stack = [((name,), f'"{name}"', slugify_segment(name), iter(fields.items()))]
+    while stack:
+        path, source, target, items = stack[-1]
+        for key, value in items:
+            child_path = path + (key,)
+            child_source = f'{source}."{key}"'
+            segment = slugify_segment(key)
+            if target and segment:
+                child_target = f"{target}_{segment}"
+            else:
+                child_target = target or segment
+            if isinstance(value, dict):
+                if projection is not None and projection.prunes(child_path):
+                    continue
+                stack.append(
+                    (child_path, child_source, child_target, iter(value.items()))
+                )
+                break
+            if projection is None or projection.selects(child_path):
+                yield child_source, child_target, value
+        else:
+            stack.pop()
@@ -0,0 +1,230 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import List
+from typing import Sequence
+
+from flatten.aws import GlueColumnMapping
+from flatten.aws import GlueTable
+from flatten.aws import ToFlatParquet
+from loguru import logger
+
+# Athena rejects query strings above 256 KB, the budget leaves room for the rest of the CTAS
+MAX_SQL_BYTES = 200_000
+MAX_COLUMNS = 1000
+
+
+def column_sql_size(col: GlueColumnMapping) -> int:
+    """Estimated bytes of a column in the formatted select list"""
+    return len(col.source_name) + len(col.target_name) + 12
+
+
+def split_mapping(
+    mapping: List[GlueColumnMapping],
+    row_key: Sequence[str],
+    max_columns=MAX_COLUMNS,
+    max_sql_bytes=MAX_SQL_BYTES,
+) -> List[List[GlueColumnMapping]]:
+    """
+    Splits a flat mapping into consecutive parts within the budgets,
+    every part starts with the row key columns
+    :param mapping:
+    :param row_key: Target names of the columns identifying a row
+    :param max_columns: Maximum number of columns per part, including the row key
+    :param max_sql_bytes: Maximum estimated size of the select list of a part
+    :return:
+    """
+    row_key = [name.lower() for name in row_key]
+    by_name = {col.target_name.lower(): col for col in mapping}
+    missing = [name for name in row_key if name not in by_name]
+    if missing:
+        raise ValueError(f"Row key columns {missing} are not in the flat mapping")
+    key_columns = [by_name[name] for name in row_key]
+    key_size = sum(column_sql_size(col) for col in key_columns)
+    if len(key_columns) >= max_columns or key_size >= max_sql_bytes:
+        raise ValueError("The row key alone exceeds the column or sql budget")
+
+    parts = []
+    part, size = list(key_columns), key_size
+    for col in mapping:
+        if col.target_name.lower() in row_key:
+            continue
+        if len(part) >= max_columns or size + column_sql_size(col) > max_sql_bytes:
+            parts.append(part)
+            part, size = list(key_columns), key_size
+        part.append(col)
+        size += column_sql_size(col)
+    if len(part) > len(key_columns) or not parts:
+        parts.append(part)
+    return parts
+
+
+class MappingSlice(GlueTable):
+    """
+    A source table restricted to some of its flat columns
+    """
+
+    def __init__(self, table: GlueTable, mapping: List[GlueColumnMapping]) -> None:
+        super().__init__(
+            table.database_name,
+            table.table_name,
+            metadata=table._metadata,
+            table_version_id=table.table_version_id,
+            projection=table.projection,
+        )
+        self.mapping = mapping
+
+    def flat_mapping(self) -> List[GlueColumnMapping]:
+        return list(self.mapping)
+
+
+class VerticalSplit:
+    """
+    Flattens ultra wide tables into several tables of at most max_columns columns,
+    <target_table>_part00, <target_table>_part01, ... stored in part_00/, part_01/, ...
+    below the target location. Every part contains the row key, the optional view named
+    like the target table joins the parts again.
+    """
+
+    def __init__(
+        self,
+        flat_table: ToFlatParquet,
+        row_key: Sequence[str],
+        max_columns=MAX_COLUMNS,
+        max_sql_bytes=MAX_SQL_BYTES,
+        join_view=True,
+        concurrency=4,
+    ):
+        """
+        :param flat_table: Flattens the whole table, its settings are used for all parts
+        :param row_key: Target names of the columns identifying a row
+        :param max_columns: Maximum number of columns per part
+        :param max_sql_bytes: Maximum estimated size of the select list of a part
+        :param join_view: Create a view joining the parts, named like the target table
+        :param concurrency: Number of parts flattened at the same time
+        """
+        self.flat_table = flat_table
+        self.row_key = list(row_key)
+        self.max_columns = max_columns
+        self.max_sql_bytes = max_sql_bytes
+        self.join_view = join_view
+        self.concurrency = concurrency
+
+    def parts(self) -> List[ToFlatParquet]:
+        """
+        :return: One ToFlatParquet per part, only the flat table if it needs no split
+        """
+        source = self.flat_table.source_table
+        # Custom partition columns have to be part of every table, like the row key
+        mappings = split_mapping(
+            source.flat_mapping(),
+            self.row_key
+            + [
+                name
+                for name in self.flat_table.output.partitioned_by
+                if name.lower() not in (key.lower() for key in self.row_key)
+            ],
+            self.max_columns,
+            self.max_sql_bytes,
+        )
+        if len(mappings) == 1:
+            return [self.flat_table]
+        target = self.flat_table.target_table
+        location = self.flat_table.target_table_location.rstrip("/")
+        flat_table = self.flat_table
+        parts = []
+        for i, mapping in enumerate(mappings):
+            # Every part gets its own connection and run state, like a separate table
+            parts.append(
+                ToFlatParquet(
+                    database=flat_table.database,
+                    source_table=MappingSlice(source, mapping),
+                    target_table=GlueTable(
+                        target.database_name, f"{target.table_name}_part{i:02d}"
+                    ),
+                    target_table_location=f"{location}/part_{i:02d}/",
+                    workgroup=flat_table.workgroup,
+                    s3_staging_dir=flat_table.s3_staging_dir,
+                    source_table_version_id=flat_table.source_table_version_id,
+                    state_store=flat_table._state_store,
+                    refresh_mode=flat_table.refresh_mode,
+                    keep_versions=flat_table.keep_versions,
+                    shards=flat_table.shards,
+                    shard_by=flat_table.shard_by,
+                    shard_key=flat_table.shard_key,
+                    shard_retries=flat_table.shard_retries,
+                    max_concurrent_queries=flat_table.max_concurrent_queries,
+                    verify_shards=flat_table.verify_shards,
+                    file_manifest=flat_table._file_manifest
+                    and f"{flat_table._file_manifest}.part{i:02d}",
+                    rebuild_manifest=flat_table.rebuild_manifest,
+                    output=flat_table.output,
+                    ledger=flat_table.ledger,
+                    query_slots=flat_table.query_slots,
+                )
+            )
+        return parts
+
+    def join_keys(self) -> List[str]:
+        """
+        :return: Lowercased names of the row key and the partition keys of the parts
+        """
+        return [
+            key.lower()
+            for key in self.row_key
+            + [name for name, _ in self.flat_table.target_partition_keys()]
+        ]
+
+    def validate_row_key(self, part: ToFlatParquet) -> None:
+        """
+        The view joins the parts on the row key, so it has to be unique and non-null.
+        Otherwise the join would drop rows with a null key and multiply rows sharing a key.
+        :param part: A flattened part, all parts contain the same rows
+        :return:
+        """
+        columns = ", ".join(f'"{key}"' for key in self.join_keys())
+        null_key = " or ".join(f'"{key}" is null' for key in self.join_keys())
+        duplicates, null_keys = part.conn.query(
+            f"select coalesce(sum(n - 1), 0), "
+            f"coalesce(sum(case when {null_key} then n else 0 end), 0) "
+            f"from (select {columns}, count(*) as n "
+            f"from {part.target_table.full_name} group by {columns})"
+        ).fetchone()
+        if duplicates or null_keys:
+            raise ValueError(
+                f"The row key {self.row_key} of {part.target_table.full_name} has "
+                f"{duplicates} duplicate and {null_keys} null values, "
+                f"the view joining the parts would drop or multiply rows"
+            )
+
+    def join_view_query(self, parts: List[ToFlatParquet]) -> str:
+        using = ", ".join(f'"{key}"' for key in self.join_keys())
+        joins = "".join(
+            f" join {part.target_table.full_name} using ({using})" for part in parts[1:]
+        )
+        return (
+            f"create or replace view {self.flat_table.target_table.full_name} as "
+            f"select * from {parts[0].target_table.full_name}{joins}"
+        )
+
+    def run(self, flatten: Callable[[ToFlatParquet], object]) -> List[ToFlatParquet]:
+        """
+        :param flatten: Flattens a part, e.g. lambda part: part.insert_overwrite()
+        :return: The flattened parts
+        """
+        parts = self.parts()
+        if len(parts) == 1:
+            flatten(parts[0])
+            return parts
+        logger.info(
+            f"Flattening {self.flat_table.source_table.full_name} into {len(parts)} "
+            f"tables with {self.concurrency} concurrent parts."
+        )
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # Raises the error of the first failed part after all parts finished
+            for future in [executor.submit(flatten, part) for part in parts]:
+                future.result()
+        if self.join_view:
+            self.validate_row_key(parts[0])
+            logger.info(f"Creating view {self.flat_table.target_table.full_name}.")
+            self.flat_table.conn.execute(self.join_view_query(parts))
+        return parts
@@ -22,5 +22,10 @@ setup(
     },
     packages=["flatten"],
     package_data={"": ["*.sql", "*.lark"]},
-    extras_require={"test": ["pytest", "flake8"]},
+    extras_require={
+        "test": ["pytest", "flake8", "moto"],
+        "yaml": ["pyyaml"],
+        "local": ["duckdb"],
+        "arrow": ["pyarrow"],
+    },
 )
@@ -0,0 +1,28 @@
+import flatten.backend
+import pytest  # noqa
+from flatten import aws
+from flatten.aws import GlueTable
+from flatten.aws import ToFlatParquet
+from flatten.backend import current_backend
+from flatten.backend import use_backend
+from flatten.local import LocalBackend
+
+
+@pytest.fixture
+def backend(tmp_path):
+    previous = (
+        current_backend(),
+        GlueTable.glue_client,
+        aws.s3_client,
+        ToFlatParquet.connection_factory,
+    )
+    backend = LocalBackend(str(tmp_path / "local"))
+    use_backend(backend)
+    yield backend
+    (
+        flatten.backend._backend,
+        GlueTable.glue_client,
+        aws.s3_client,
+        ToFlatParquet.connection_factory,
+    ) = previous
+    GlueTable.metadata_cache.clear()
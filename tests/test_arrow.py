@@ -0,0 +1,150 @@
+import json
+
+import pytest  # noqa
+from flatten.aws import GlueTable
+from flatten.aws import RUN_FINGERPRINT_PARAMETER
+from flatten.aws import ToFlatParquet
+from flatten.hive_parser import HiveParser
+from flatten.output import OutputOptions
+from flatten.state import RunStateStore
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+from flatten.arrow import ArrowFlattener  # noqa: E402
+from flatten.arrow import arrow_schema  # noqa: E402
+from flatten.arrow import arrow_type  # noqa: E402
+from flatten.arrow import source_path  # noqa: E402
+
+PARQUET_SERDE = "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
+JSON_SERDE = "org.openx.data.jsonserde.JsonSerDe"
+
+
+def flat_table(tmp_path, **kwargs) -> ToFlatParquet:
+    return ToFlatParquet(
+        database="db",
+        source_table=GlueTable("db", "raw"),
+        target_table=GlueTable("db", "flat"),
+        target_table_location="s3://b/flat/",
+        workgroup="primary",
+        s3_staging_dir="s3://b/staging/",
+        state_store=RunStateStore(str(tmp_path / "runs")),
+        file_manifest=str(tmp_path / "manifest.json.gz"),
+        **kwargs,
+    )
+
+
+def test_arrow_type():
+    parse = HiveParser()
+    assert arrow_type(parse("struct<a:int,b:array<decimal(10,2)>>")) == pa.struct(
+        [("a", pa.int32()), ("b", pa.list_(pa.decimal128(10, 2)))]
+    )
+    assert arrow_type(parse("map<string,bigint>")) == pa.map_(pa.string(), pa.int64())
+    assert arrow_type(parse("varchar(10)")) == pa.string()
+    assert source_path('"concert"."venue"') == ("concert", "venue")
+    assert source_path("id") == ("id",)
+
+
+def test_flatten_parquet_with_arrow(backend, tmp_path):
+    source = pa.table(
+        {
+            "id": [str(i) for i in range(10)],
+            "concert": [
+                None if i == 3 else {"Venue": f"hall {i % 2}", "seats": i}
+                for i in range(10)
+            ],
+        }
+    )
+    directory = tmp_path / "local" / "s3" / "b" / "raw"
+    directory.mkdir(parents=True)
+    pq.write_table(source, str(directory / "data.parquet"))
+    GlueTable("db", "raw").create(
+        columns=[
+            ("id", "string"),
+            ("concert", "struct<venue:string,seats:int,missing:string>"),
+        ],
+        location="s3://b/raw/",
+        serde=PARQUET_SERDE,
+    )
+    table = flat_table(tmp_path)
+    flattener = ArrowFlattener(table, batch_size=4, processes=1)
+
+    run = flattener.run()
+    assert run.rows == 10 and run.files == 1
+    target = GlueTable("db", "flat")
+    assert target.columns() == [
+        ("id", "string"),
+        ("concert_venue", "string"),
+        ("concert_seats", "int"),
+        ("concert_missing", "string"),
+    ]
+    assert target.metadata["Parameters"][RUN_FINGERPRINT_PARAMETER]
+    files = list((tmp_path / "local" / "s3" / "b" / "flat").glob("*.parquet"))
+    flat = pq.read_table(str(files[0]))
+    assert flat.schema.equals(arrow_schema(target.columns()))
+    assert flat.column("concert_seats").to_pylist() == [
+        None if i == 3 else i for i in range(10)
+    ]
+    assert flat.column("concert_venue").to_pylist()[:2] == ["hall 0", "hall 1"]
+    assert flat.column("concert_missing").null_count == 10
+    # Unchanged sources are skipped
+    assert flattener.run() is None
+
+
+def test_arrow_partitions_by_flat_column(backend, tmp_path):
+    source = GlueTable("db", "raw")
+    source.create(
+        columns=[("id", "string"), ("concert", "struct<venue:string,seats:int>")],
+        location="s3://b/raw/",
+        partitions=[("dt", "string")],
+        serde=JSON_SERDE,
+    )
+    partitions = []
+    for dt in ("2020-01-01", "2020-01-02"):
+        rows = [
+            {"id": f"{dt}-{i}", "concert": {"venue": f"hall {i % 2}", "seats": i}}
+            for i in range(5)
+        ]
+        backend.s3.put_object(
+            Bucket="b",
+            Key=f"raw/dt={dt}/data.json",
+            Body="".join(json.dumps(row) + "\n" for row in rows),
+        )
+        partitions.append(
+            {
+                "Values": [dt],
+                "StorageDescriptor": {
+                    **source.metadata["StorageDescriptor"],
+                    "Location": f"s3://b/raw/dt={dt}/",
+                },
+                "Parameters": {},
+            }
+        )
+    source.replace_partitions(partitions)
+    table = flat_table(
+        tmp_path, output=OutputOptions(partitioned_by=("concert_venue",))
+    )
+
+    run = ArrowFlattener(table, batch_size=2, processes=1).run()
+    assert run.rows == 10 and run.files == 4
+    target = GlueTable("db", "flat")
+    assert target.partition_keys() == [("concert_venue", "string")]
+    assert [p["Values"] for p in target.partitions()] == [["hall 0"], ["hall 1"]]
+    location = target.partitions()[0]["StorageDescriptor"]["Location"]
+    assert location == "s3://b/flat/concert_venue=hall%200/"
+    flat = pq.read_table(backend.local_path(location))
+    assert (
+        sorted(flat.column("dt").to_pylist()) == ["2020-01-01"] * 3 + ["2020-01-02"] * 3
+    )
+    assert "concert_venue" not in flat.column_names
+
+
+def test_arrow_output_options(tmp_path):
+    table = flat_table(tmp_path, output=OutputOptions(format="orc"))
+    with pytest.raises(ValueError):
+        ArrowFlattener(table).validate()
+    table = flat_table(
+        tmp_path, output=OutputOptions(bucketed_by=("id",), bucket_count=4)
+    )
+    with pytest.raises(ValueError):
+        ArrowFlattener(table).validate()
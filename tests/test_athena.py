@@ -0,0 +1,109 @@
+import boto3
+import pytest  # noqa
+from botocore.stub import ANY
+from botocore.stub import Stubber
+from flatten.athena import AthenaQueryPoller
+from pyathena.error import OperationalError
+
+
+def execution(query_id, state, reason=None):
+    status = {"State": state}
+    if reason:
+        status["StateChangeReason"] = reason
+    return {"QueryExecutionId": query_id, "Query": "select 1", "Status": status}
+
+
+def batch_response(*executions):
+    return {"QueryExecutions": list(executions), "UnprocessedQueryExecutionIds": []}
+
+
+def stubbed_poller():
+    client = boto3.client("athena", region_name="eu-central-1")
+    return AthenaQueryPoller(client), Stubber(client)
+
+
+def test_poll_many_queries_in_one_call():
+    poller, stubber = stubbed_poller()
+    stubber.add_response(
+        "batch_get_query_execution",
+        batch_response(execution("a", "RUNNING"), execution("b", "QUEUED")),
+        {"QueryExecutionIds": ["a", "b"]},
+    )
+    stubber.add_response(
+        "batch_get_query_execution",
+        batch_response(execution("a", "SUCCEEDED"), execution("b", "FAILED", "boom")),
+        {"QueryExecutionIds": ["a", "b"]},
+    )
+    with stubber:
+        first = poller.watch("a", poll_interval=0.01)
+        second = poller.watch("b", poll_interval=0.01)
+        assert first.result(timeout=5).state == "SUCCEEDED"
+        with pytest.raises(OperationalError, match="boom"):
+            second.result(timeout=5)
+    stubber.assert_no_pending_responses()
+
+
+def test_backoff():
+    poller, stubber = stubbed_poller()
+    for _ in range(3):
+        stubber.add_response(
+            "batch_get_query_execution", batch_response(execution("a", "RUNNING"))
+        )
+    stubber.add_response(
+        "batch_get_query_execution", batch_response(execution("a", "SUCCEEDED"))
+    )
+    with stubber:
+        future = poller.watch("a", poll_interval=0.01, max_poll_interval=0.02)
+        assert future.result(timeout=5).query_id == "a"
+
+
+def test_timeout_stops_query():
+    poller, stubber = stubbed_poller()
+    stubber.add_response(
+        "batch_get_query_execution", batch_response(execution("a", "RUNNING"))
+    )
+    stubber.add_response("stop_query_execution", {}, {"QueryExecutionId": "a"})
+    with stubber:
+        future = poller.watch("a", poll_interval=0.05, timeout=0.01)
+        with pytest.raises(TimeoutError):
+            future.result(timeout=5)
+    stubber.assert_no_pending_responses()
+
+
+def test_cancel():
+    poller, stubber = stubbed_poller()
+    stubber.add_response("stop_query_execution", {}, {"QueryExecutionId": ANY})
+    stubber.add_response(
+        "batch_get_query_execution",
+        batch_response(execution("a", "CANCELLED", "stopped by user")),
+    )
+    with stubber:
+        future = poller.watch("a", poll_interval=60)
+        poller.cancel("a")
+        with pytest.raises(OperationalError, match="stopped by user"):
+            future.result(timeout=5)
+
+
+def test_cancelled_future_does_not_fail_the_batch():
+    poller, stubber = stubbed_poller()
+    stubber.add_response(
+        "batch_get_query_execution",
+        batch_response(
+            execution("a", "SUCCEEDED"),
+            execution("b", "SUCCEEDED"),
+            execution("c", "RUNNING"),
+        ),
+        {"QueryExecutionIds": ["a", "b", "c"]},
+    )
+    stubber.add_response(
+        "batch_get_query_execution",
+        batch_response(execution("c", "SUCCEEDED")),
+        {"QueryExecutionIds": ["c"]},
+    )
+    with stubber:
+        futures = [poller.watch(query_id, poll_interval=0.05) for query_id in "abc"]
+        assert futures[0].cancel()
+        assert futures[1].result(timeout=5).state == "SUCCEEDED"
+        assert futures[2].result(timeout=5).state == "SUCCEEDED"
+    assert futures[0].cancelled()
+    stubber.assert_no_pending_responses()
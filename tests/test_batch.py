@@ -0,0 +1,138 @@
+import json
+import threading
+
+import pytest  # noqa
+from flatten.athena import QueryFuture
+from flatten.aws import ToFlatParquet
+from flatten.batch import BatchFlattener
+from flatten.batch import FlattenJob
+from flatten.batch import load_manifest
+from flatten.batch import plan_jobs
+from flatten.batch import summary
+
+TABLES = [
+    {"Name": "raw_small", "Parameters": {"sizeKey": "10"}},
+    {"Name": "raw_large", "Parameters": {"sizeKey": "1000"}},
+    {"Name": "raw_unknown"},
+    {"Name": "raw_view", "TableType": "VIRTUAL_VIEW"},
+    {"Name": "tmp_raw", "Parameters": {"sizeKey": "5000"}},
+    {"Name": "flat_raw_small"},
+]
+
+
+def test_plan_jobs():
+    jobs = plan_jobs(TABLES, "s3://bucket/flat", include=["raw_*", "flat_*"])
+    assert jobs == [
+        FlattenJob(
+            "raw_large", "flat_raw_large", "s3://bucket/flat/flat_raw_large/", 1000
+        ),
+        FlattenJob(
+            "raw_small", "flat_raw_small", "s3://bucket/flat/flat_raw_small/", 10
+        ),
+        FlattenJob(
+            "raw_unknown", "flat_raw_unknown", "s3://bucket/flat/flat_raw_unknown/"
+        ),
+    ]
+    jobs = plan_jobs(TABLES, "s3://bucket/flat/", exclude=["raw_*", "flat_*"])
+    assert [job.source_table for job in jobs] == ["tmp_raw"]
+
+
+def test_plan_jobs_manifest(tmp_path):
+    manifest_file = tmp_path / "manifest.json"
+    manifest_file.write_text(
+        json.dumps(
+            {
+                "tables": [
+                    "raw_small",
+                    {"source": "raw_large", "target": "large", "location": "s3://x/"},
+                ]
+            }
+        )
+    )
+    jobs = plan_jobs(TABLES, "s3://bucket", manifest=load_manifest(str(manifest_file)))
+    assert jobs == [
+        FlattenJob("raw_large", "large", "s3://x/", 1000),
+        FlattenJob("raw_small", "flat_raw_small", "s3://bucket/flat_raw_small/", 10),
+    ]
+    with pytest.raises(ValueError):
+        plan_jobs(TABLES, "s3://bucket", manifest=[{"source": "missing"}])
+
+
+class FakeFlatTable:
+    def __init__(self, source_table, **kwargs):
+        self.source_table = source_table
+
+    def insert_overwrite(self, temp_db=None, resume=True, force=False):
+        if self.source_table.table_name == "broken":
+            raise ValueError("broken source")
+
+
+def test_batch_continues_past_failures(monkeypatch):
+    monkeypatch.setattr("flatten.batch.ToFlatParquet", FakeFlatTable)
+    jobs = [
+        FlattenJob(name, f"flat_{name}", "s3://x/") for name in ["a", "broken", "b"]
+    ]
+    results = BatchFlattener("db", "primary", "s3://staging", concurrency=2).run(jobs)
+    assert [result.job for result in results] == jobs
+    assert [result.succeeded for result in results] == [True, False, True]
+    assert results[1].error == "ValueError('broken source')"
+    lines = summary(results).splitlines()
+    assert lines[0].startswith("Flattened 2/3 tables")
+    assert lines[1:] == ["FAILED broken: ValueError('broken source')"]
+
+
+def test_batch_file_manifests(tmp_path):
+    job = FlattenJob("a", "flat_a", "s3://x/")
+    assert BatchFlattener("db", "primary", "s3://staging").file_manifest(job) is None
+    assert (
+        BatchFlattener(
+            "db", "primary", "s3://staging", file_manifests="s3://m/manifests/"
+        ).file_manifest(job)
+        == "s3://m/manifests/flat_a.json.gz"
+    )
+    local = BatchFlattener(
+        "db", "primary", "s3://staging", file_manifests=str(tmp_path / "manifests")
+    )
+    assert local.file_manifest(job) == str(tmp_path / "manifests" / "flat_a.json.gz")
+
+
+class SlowConnection:
+    """Resolves every query after a while and counts the queries in flight"""
+
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def __init__(self, **kwargs):
+        pass
+
+    def submit(self, sql):
+        cls = SlowConnection
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        future = QueryFuture(sql)
+
+        def resolve():
+            with cls.lock:
+                cls.in_flight -= 1
+            future.set_result(None)
+
+        threading.Timer(0.02, resolve).start()
+        return future
+
+
+def test_batch_limits_queries_in_flight(monkeypatch):
+    monkeypatch.setattr(ToFlatParquet, "connection_factory", SlowConnection)
+
+    def insert_overwrite(self, **kwargs):
+        # like the shards of a full refresh
+        futures = [self.submit(f"shard {i}") for i in range(3)]
+        for future in futures:
+            future.result()
+
+    monkeypatch.setattr(ToFlatParquet, "insert_overwrite", insert_overwrite)
+    jobs = [FlattenJob(name, f"flat_{name}", "s3://x/") for name in "abcd"]
+    results = BatchFlattener("db", "primary", "s3://staging", concurrency=2).run(jobs)
+    assert all(result.succeeded for result in results)
+    assert SlowConnection.max_in_flight == 2
@@ -0,0 +1,47 @@
+import pytest  # noqa
+from benchmarks.run import compare
+from benchmarks.run import measure
+from benchmarks.run import Case
+from benchmarks.schemas import array_heavy_struct
+from benchmarks.schemas import deep_struct
+from benchmarks.schemas import wide_struct
+from flatten.hive_parser import HiveParser
+from flatten.hive_parser import serialize_type
+from flatten.utils import flatten_dict
+
+
+def test_synthetic_schemas():
+    parse = HiveParser()
+    wide = parse(wide_struct(1000, fanout=10))
+    assert len(flatten_dict(wide)) == 1000
+    assert serialize_type(wide) == wide_struct(1000, fanout=10)
+
+    deep = parse(deep_struct(40, siblings=2))
+    depth = 0
+    while isinstance(deep, dict):
+        deep = deep.get(f"level_{depth + 1}")
+        depth += 1
+    assert depth == 41
+
+    arrays = parse(array_heavy_struct(9))
+    assert sum(isinstance(value, list) for value in arrays.values()) == 9
+
+
+def test_measure():
+    result = measure(Case("sum", "range", lambda: range(1000), sum), repeat=3)
+    assert result["runs"] == 3
+    assert result["min_s"] <= result["median_s"]
+    assert result["peak_bytes"] >= 0
+
+
+def test_compare():
+    def results(seconds, peak):
+        return {"results": {"parse/wide": {"median_s": seconds, "peak_bytes": peak}}}
+
+    baseline = results(1.0, 1000)
+    assert compare(results(1.2, 1200), baseline, threshold=0.25) == []
+    assert len(compare(results(1.3, 1000), baseline, threshold=0.25)) == 1
+    assert len(compare(results(1.3, 2000), baseline, threshold=0.25)) == 2
+    # Tiny absolute differences are noise
+    assert compare(results(0.0002, 1000), results(0.0001, 1000)) == []
+    assert compare(results(2.0, 1000), {"results": {}}) == []
@@ -0,0 +1,63 @@
+import json
+from pathlib import Path
+
+import pytest  # noqa
+from flatten.aws import GlueTable
+from flatten.cache import TieredCache
+
+
+def test_memory_lru():
+    cache = TieredCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+
+def test_disk_tier(tmp_path):
+    cache = TieredCache(directory=str(tmp_path))
+    key = cache.key("struct<a:string>")
+    cache.set(key, {"a": "string"})
+
+    reloaded = TieredCache(directory=str(tmp_path))
+    assert reloaded.get(key) == {"a": "string"}
+    assert reloaded.get(key) == {"a": "string"}
+    assert reloaded.stats()["disk_hits"] == 1
+    assert reloaded.stats()["hits"] == 1
+
+
+def test_disk_eviction(tmp_path):
+    cache = TieredCache(directory=str(tmp_path), max_disk_bytes=100)
+    for i in range(10):
+        cache.set(cache.key(i), "x" * 20)
+    assert cache.stats()["evictions"] > 0
+    assert sum(f.stat().st_size for f in tmp_path.iterdir()) <= 100
+    assert cache.stats()["disk_bytes"] <= 100
+
+
+def test_flat_mapping_cached_by_version():
+    with open(Path(Path(__file__).parent.absolute(), "glue_table.json")) as f:
+        table_metadata = json.load(f)
+    table_metadata["VersionId"] = "1"
+    test_table = GlueTable("test", "versioned", metadata=table_metadata)
+    mapping = test_table.flat_mapping()
+
+    # The cached mapping is served without flattening the columns again
+    cached_table = GlueTable("test", "versioned", metadata=table_metadata)
+    cached_table._flat_mapping = lambda: pytest.fail("the mapping wasn't cached")
+    assert cached_table.flat_mapping() == mapping
+
+    table_metadata["VersionId"] = "2"
+    assert GlueTable("test", "versioned", metadata=table_metadata).flat_mapping() == (
+        mapping
+    )
+
+    # Metadata changed in place keeps its version, the columns are part of the key
+    table_metadata["StorageDescriptor"]["Columns"] = [{"Name": "a", "Type": "int"}]
+    changed = GlueTable("test", "versioned", metadata=table_metadata).flat_mapping()
+    assert [col.target_name for col in changed] == ["a"]
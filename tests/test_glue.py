@@ -1,10 +1,30 @@
 import json
+from copy import deepcopy
+from datetime import datetime
 from pathlib import Path
 
+import boto3
 import pytest  # noqa
+from botocore.stub import Stubber
+from flatten.athena import QueryFuture
+from flatten.aws import FINGERPRINT_PARAMETER
 from flatten.aws import GlueColumnMapping
+from flatten.aws import GlueMetadataCache
 from flatten.aws import GlueTable
+from flatten.aws import HIVE_NULL_PARTITION
+from flatten.aws import partition_filter
+from flatten.aws import partition_fingerprint
+from flatten.aws import PRE_SWAP_DATA_PARAMETER
 from flatten.aws import ToFlatParquet
+from flatten.ledger import QueryStats
+from flatten.ledger import RunLedger
+from flatten.ledger import WRITING_QUERY
+from flatten.manifest import ObjectManifest
+from flatten.output import OutputOptions
+from flatten.projection import ColumnProjection
+from flatten.schema import ColumnChange
+from flatten.state import RunStateStore
+from pyathena.error import OperationalError
 
 
 def test_duplicate_columns():
@@ -21,6 +41,17 @@ def test_duplicate_columns():
         test_table.flat_mapping()
 
 
+def test_flattened_name_collision():
+    with open(Path(Path(__file__).parent.absolute(), "glue_table.json")) as f:
+        table_metadata = json.load(f)
+    table_metadata["StorageDescriptor"]["Columns"].append(
+        {"Name": "concert_Venue", "Type": "string"}
+    )
+    test_table = GlueTable("test", "test", metadata=table_metadata)
+    with pytest.raises(ValueError, match="concert_Venue"):
+        test_table.flat_mapping()
+
+
 def test_columns_mapping():
     with open(Path(Path(__file__).parent.absolute(), "glue_table.json")) as f:
         table_metadata = json.load(f)
@@ -108,3 +139,1027 @@ def test_generated_sql():
     assert " ".join(
         flat_table.generate_insert_overwrite_query(test_table).split()
     ) == " ".join(expected.split())
+
+
+def stubbed_glue_client():
+    client = boto3.client("glue", region_name="eu-central-1")
+    return client, Stubber(client)
+
+
+def test_metadata_cache_single_fetch():
+    with open(Path(Path(__file__).parent.absolute(), "glue_table.json")) as f:
+        table_metadata = json.load(f)
+    table_metadata.pop("CreateTime")
+    table_metadata.pop("LastAccessTime")
+    table_metadata["UpdateTime"] = datetime(2021, 1, 4)
+    client, stubber = stubbed_glue_client()
+    stubber.add_response(
+        "get_table",
+        {"Table": table_metadata},
+        {"DatabaseName": "default", "Name": "raw_nyphilarchive"},
+    )
+    stubber.add_client_error("get_table", "EntityNotFoundException")
+    cache = GlueMetadataCache()
+    with stubber:
+        assert cache.get(client, "default", "raw_nyphilarchive") == table_metadata
+        assert cache.get(client, "default", "raw_nyphilarchive") == table_metadata
+        assert cache.get(client, "default", "missing") is None
+        assert cache.get(client, "default", "missing") is None
+    assert cache.fetches == 2
+    stubber.assert_no_pending_responses()
+
+
+def test_metadata_cache_prefetch():
+    tables = [
+        {"Name": "a", "VersionId": "1", "DatabaseName": "default"},
+        {"Name": "b", "VersionId": "1", "DatabaseName": "default"},
+    ]
+    client, stubber = stubbed_glue_client()
+    stubber.add_response(
+        "get_tables",
+        {"TableList": tables[:1], "NextToken": "next"},
+        {"DatabaseName": "default"},
+    )
+    stubber.add_response(
+        "get_tables",
+        {"TableList": tables[1:]},
+        {"DatabaseName": "default", "NextToken": "next"},
+    )
+    updated = {"Name": "b", "VersionId": "2", "DatabaseName": "default"}
+    stubber.add_response(
+        "get_tables", {"TableList": [updated]}, {"DatabaseName": "default"}
+    )
+    cache = GlueMetadataCache()
+    with stubber:
+        assert cache.prefetch(client, "default") == tables
+        assert cache.get(client, "default", "a") == tables[0]
+        cache.prefetch(client, "default")
+        assert cache.get(client, "default", "b") == updated
+        cache.invalidate("default", "a")
+        stubber.add_client_error("get_table", "EntityNotFoundException")
+        assert cache.get(client, "default", "a") is None
+
+
+class FakeTable:
+    def __init__(self, name, exists=True):
+        self.full_name = name
+        self._exists = exists
+        self.deleted = 0
+
+    def exists(self):
+        return self._exists
+
+    def delete(self):
+        self.deleted += 1
+        self._exists = False
+
+
+class FakeConnection:
+    def __init__(self, error=None):
+        self.submitted = []
+        self.attached = []
+        self.error = error
+
+    def _future(self, query_id):
+        future = QueryFuture(query_id)
+        if self.error:
+            future.set_exception(self.error)
+        else:
+            future.set_result(None)
+        return future
+
+    def submit(self, sql):
+        self.submitted.append(sql)
+        return self._future(f"query-{len(self.submitted)}")
+
+    def attach(self, query_id):
+        self.attached.append(query_id)
+        return self._future(query_id)
+
+
+def resumable_flat_table(tmp_path, monkeypatch, **kwargs):
+    with open(Path(Path(__file__).parent.absolute(), "glue_table.json")) as f:
+        table_metadata = json.load(f)
+    flat_table = ToFlatParquet(
+        database="test",
+        source_table=GlueTable("test", "test", metadata=table_metadata),
+        target_table=GlueTable("test", "test", metadata=deepcopy(table_metadata)),
+        target_table_location="test",
+        workgroup="test",
+        s3_staging_dir="test",
+        state_store=RunStateStore(str(tmp_path / "runs")),
+        file_manifest=str(tmp_path / "manifest.json.gz"),
+        **kwargs,
+    )
+    monkeypatch.setattr("flatten.aws.s3_listing_digest", lambda location: "digest")
+    monkeypatch.setattr(flat_table, "source_objects", lambda: [("raw/a.json", "1")])
+
+    def update(parameters=None, **kwargs):
+        flat_table.target_table._metadata["Parameters"].update(parameters or {})
+
+    monkeypatch.setattr(flat_table.target_table, "update", update)
+    refreshed = []
+    temp_table = FakeTable('"test"."tmp"')
+    monkeypatch.setattr(
+        flat_table, "refresh_target_table", lambda **kwargs: refreshed.append(1)
+    )
+    monkeypatch.setattr(flat_table, "temp_table", lambda db, run_id: temp_table)
+    return flat_table, refreshed, temp_table
+
+
+def test_insert_overwrite_records_state(tmp_path, monkeypatch):
+    flat_table, refreshed, temp_table = resumable_flat_table(tmp_path, monkeypatch)
+    flat_table.conn = FakeConnection()
+    flat_table.insert_overwrite()
+    assert refreshed == [1]
+    assert len(flat_table.conn.submitted) == 1
+    # temporary table of a previous run, cleaned up after the query
+    assert temp_table.deleted == 1
+    assert list((tmp_path / "runs").iterdir()) == []
+
+
+def test_insert_overwrite_resumes_submitted_query(tmp_path, monkeypatch):
+    flat_table, refreshed, temp_table = resumable_flat_table(tmp_path, monkeypatch)
+    flat_table.run_state().update(step="submitted", query_id="running-query")
+    flat_table.conn = FakeConnection()
+    flat_table.insert_overwrite()
+    assert refreshed == []
+    assert flat_table.conn.submitted == []
+    assert flat_table.conn.attached == ["running-query"]
+    assert flat_table.run_state().step is None
+
+
+def test_insert_overwrite_restarts_failed_query(tmp_path, monkeypatch):
+    flat_table, refreshed, temp_table = resumable_flat_table(tmp_path, monkeypatch)
+    flat_table.run_state().update(step="submitted", query_id="failed-query")
+    flat_table.conn = FakeConnection(error=OperationalError("failed"))
+    with pytest.raises(OperationalError):
+        flat_table.insert_overwrite()
+    assert refreshed == [1]
+    assert flat_table.conn.attached == ["failed-query"]
+    assert flat_table.run_state().get("query_id") == "query-1"
+
+
+def test_insert_overwrite_swaps_location(tmp_path, monkeypatch):
+    flat_table, refreshed, temp_table = resumable_flat_table(
+        tmp_path, monkeypatch, refresh_mode="swap"
+    )
+    updates = []
+    collected = []
+    monkeypatch.setattr(
+        flat_table.target_table, "update", lambda **kwargs: updates.append(kwargs)
+    )
+    monkeypatch.setattr(
+        flat_table,
+        "collect_old_versions",
+        lambda location, pre_swap_data: collected.append((location, pre_swap_data)),
+    )
+    flat_table.conn = FakeConnection()
+    flat_table.insert_overwrite()
+    flat_table.gc_thread.join()
+
+    location = updates[0]["location"]
+    assert location.startswith("test/run_") and location.endswith("/")
+    assert f"external_location = '{location}'" in flat_table.conn.submitted[0]
+    assert collected == [(location, False)]
+    assert PRE_SWAP_DATA_PARAMETER not in updates[0]["parameters"]
+    assert updates[0]["bucket_columns"] == ()
+    assert updates[0]["bucket_count"] is None
+
+    # the first swap of a table that was flattened in purge mode
+    flat_table.target_table._metadata["StorageDescriptor"]["Location"] = "test/"
+    flat_table.insert_overwrite(force=True)
+    flat_table.gc_thread.join()
+    assert updates[1]["parameters"][PRE_SWAP_DATA_PARAMETER] == "true"
+    assert collected[1] == (updates[1]["location"], True)
+
+
+def test_insert_overwrite_resumes_swap_location(tmp_path, monkeypatch):
+    flat_table, refreshed, temp_table = resumable_flat_table(
+        tmp_path, monkeypatch, refresh_mode="swap"
+    )
+    updates = []
+    monkeypatch.setattr(
+        flat_table.target_table, "update", lambda **kwargs: updates.append(kwargs)
+    )
+    monkeypatch.setattr(
+        flat_table, "collect_old_versions", lambda location, pre_swap_data: None
+    )
+    flat_table.run_state().update(
+        step="submitted", query_id="running-query", location="test/run_1/"
+    )
+    flat_table.conn = FakeConnection()
+    flat_table.insert_overwrite()
+    assert updates[0]["location"] == "test/run_1/"
+
+
+def swap_flat_table(client, monkeypatch, keep_versions=2):
+    monkeypatch.setattr("flatten.aws.s3_client", client)
+    return ToFlatParquet(
+        database="test",
+        source_table=GlueTable("test", "test", metadata={}),
+        target_table=GlueTable("test", "flat", metadata={}),
+        target_table_location="s3://bucket/flat",
+        workgroup="test",
+        s3_staging_dir="test",
+        refresh_mode="swap",
+        keep_versions=keep_versions,
+    )
+
+
+def remaining_keys(client):
+    return sorted(
+        obj["Key"] for obj in client.list_objects_v2(Bucket="bucket")["Contents"]
+    )
+
+
+def test_collect_old_versions(monkeypatch):
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="bucket")
+        runs = [f"run_2020010{i}T000000000000Z" for i in range(1, 5)]
+        for run in runs:
+            client.put_object(Bucket="bucket", Key=f"flat/{run}/part-0", Body=b"x")
+        client.put_object(Bucket="bucket", Key="flat/other/part-0", Body=b"x")
+        flat_table = swap_flat_table(client, monkeypatch)
+        # the current version is never deleted, even if it is not the newest one
+        flat_table.collect_old_versions(f"s3://bucket/flat/{runs[0]}/")
+        keys = remaining_keys(client)
+    assert keys == [
+        "flat/other/part-0",
+        f"flat/{runs[0]}/part-0",
+        f"flat/{runs[2]}/part-0",
+        f"flat/{runs[3]}/part-0",
+    ]
+
+
+def test_collect_pre_swap_data(monkeypatch):
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="bucket")
+        for key in ("flat/part-0", "flat/dt=1/part-0", "flat_2/part-0"):
+            client.put_object(Bucket="bucket", Key=key, Body=b"x")
+        first, second = "run_20200101T000000000000Z", "run_20200102T000000000000Z"
+        client.put_object(Bucket="bucket", Key=f"flat/{first}/part-0", Body=b"x")
+        flat_table = swap_flat_table(client, monkeypatch)
+        # the data of the purge mode is the previous version after the first swap
+        flat_table.collect_old_versions(f"s3://bucket/flat/{first}/", True)
+        assert len(remaining_keys(client)) == 4
+
+        client.put_object(Bucket="bucket", Key=f"flat/{second}/part-0", Body=b"x")
+        flat_table.collect_old_versions(f"s3://bucket/flat/{second}/", True)
+        assert remaining_keys(client) == [
+            f"flat/{first}/part-0",
+            f"flat/{second}/part-0",
+            "flat_2/part-0",
+        ]
+
+
+def test_update_keeps_table_input():
+    client = boto3.client("glue", region_name="eu-central-1")
+    table = GlueTable(
+        "db",
+        "flat",
+        metadata={
+            "Name": "flat",
+            "DatabaseName": "db",
+            "CreateTime": datetime(2020, 1, 1),
+            "TableType": "EXTERNAL_TABLE",
+            "Parameters": {"classification": "parquet"},
+            "StorageDescriptor": {
+                "Columns": [{"Name": "a", "Type": "int"}],
+                "Location": "s3://bucket/flat/run_1/",
+            },
+        },
+    )
+    table.glue_client = client
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "update_table",
+            {},
+            {
+                "DatabaseName": "db",
+                "TableInput": {
+                    "Name": "flat",
+                    "TableType": "EXTERNAL_TABLE",
+                    "Parameters": {"classification": "parquet", "version": "2"},
+                    "StorageDescriptor": {
+                        "Columns": [
+                            {"Name": "a", "Type": "int"},
+                            {"Name": "b", "Type": "string"},
+                        ],
+                        "Location": "s3://bucket/flat/run_2/",
+                    },
+                },
+            },
+        )
+        table.update(
+            columns=[("a", "int"), ("b", "string")],
+            location="s3://bucket/flat/run_2/",
+            parameters={"version": "2"},
+        )
+        stubber.assert_no_pending_responses()
+
+
+def test_update_sets_bucketing():
+    client = boto3.client("glue", region_name="eu-central-1")
+    table = GlueTable(
+        "db",
+        "flat",
+        metadata={
+            "Name": "flat",
+            "StorageDescriptor": {
+                "Columns": [{"Name": "a", "Type": "int"}],
+                "BucketColumns": [],
+                "NumberOfBuckets": -1,
+            },
+        },
+    )
+    table.glue_client = client
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "update_table",
+            {},
+            {
+                "DatabaseName": "db",
+                "TableInput": {
+                    "Name": "flat",
+                    "StorageDescriptor": {
+                        "Columns": [{"Name": "a", "Type": "int"}],
+                        "BucketColumns": ["a"],
+                        "NumberOfBuckets": 4,
+                    },
+                },
+            },
+        )
+        table.update(bucket_columns=("a",), bucket_count=4)
+        stubber.assert_no_pending_responses()
+
+
+def partitioned_metadata(name="test"):
+    with open(Path(Path(__file__).parent.absolute(), "glue_table.json")) as f:
+        table_metadata = json.load(f)
+    table_metadata["Name"] = name
+    table_metadata["PartitionKeys"] = [{"Name": "dt", "Type": "string"}]
+    return table_metadata
+
+
+def glue_partition(dt, location=None, parameters=None):
+    return {
+        "Values": [dt],
+        "StorageDescriptor": {"Location": location or f"s3://bucket/raw/dt={dt}/"},
+        "Parameters": parameters or {},
+    }
+
+
+def test_generated_sql_partitioned():
+    test_table = GlueTable("test", "test", metadata=partitioned_metadata())
+    flat_table = ToFlatParquet(
+        database="test",
+        source_table=test_table,
+        target_table=test_table,
+        target_table_location="test",
+        workgroup="test",
+        s3_staging_dir="test",
+    )
+    sql = " ".join(flat_table.generate_insert_overwrite_query(test_table).split())
+    assert "partitioned_by = ARRAY['dt']" in sql
+    assert sql.endswith('"dt" as dt from "test"."test"')
+
+    sql = " ".join(flat_table.generate_insert_into_query("\"dt\" = '1'").split())
+    assert sql.startswith('insert into "test"."test" select id as id')
+    assert sql.endswith('"dt" as dt from "test"."test" where "dt" = \'1\'')
+
+
+def test_generated_sql_output_options(monkeypatch):
+    test_table = GlueTable("test", "test", metadata=partitioned_metadata())
+    flat_table = ToFlatParquet(
+        database="test",
+        source_table=test_table,
+        target_table=test_table,
+        target_table_location="test",
+        workgroup="test",
+        s3_staging_dir="test",
+        output=OutputOptions(
+            format="orc",
+            compression="zstd",
+            partitioned_by=("season",),
+            bucketed_by=("id",),
+            bucket_count=8,
+        ),
+    )
+    assert flat_table.target_partition_keys() == [("season", "string")]
+    assert flat_table.target_columns()[-1] == ("dt", "string")
+    assert "season" not in dict(flat_table.target_columns())
+    sql = " ".join(
+        flat_table.generate_insert_overwrite_query(test_table, "s3://b/f/").split()
+    )
+    assert (
+        "format = 'ORC' , orc_compression = 'ZSTD' , bucketed_by = ARRAY['id'], "
+        "bucket_count = 8 , partitioned_by = ARRAY['season']"
+    ) in sql
+    assert sql.endswith('"dt" as dt , season as season from "test"."test"')
+
+    created = []
+    monkeypatch.setattr(flat_table.target_table, "exists", lambda: False)
+    monkeypatch.setattr(
+        flat_table.target_table, "create", lambda **kwargs: created.append(kwargs)
+    )
+    flat_table.refresh_target_table()
+    assert created[0]["serde"] == "org.apache.hadoop.hive.ql.io.orc.OrcSerde"
+    assert created[0]["parameters"]["orc.compress"] == "ZSTD"
+    assert created[0]["bucket_columns"] == ("id",)
+    assert created[0]["bucket_count"] == 8
+    assert created[0]["partitions"] == [("season", "string")]
+
+    with pytest.raises(ValueError):
+        flat_table.insert_incremental()
+
+
+def test_derived_bucket_count(monkeypatch):
+    metadata = partitioned_metadata()
+    metadata["Parameters"]["sizeKey"] = str(40 * 1024**3)
+    test_table = GlueTable("test", "test", metadata=metadata)
+    flat_table = ToFlatParquet(
+        database="test",
+        source_table=test_table,
+        target_table=test_table,
+        target_table_location="test",
+        workgroup="test",
+        s3_staging_dir="test",
+        output=OutputOptions(bucketed_by=("id",)),
+    )
+    monkeypatch.setattr(test_table, "partitions", lambda: [{}] * 10)
+    # 40 GiB * 0.25 over 10 partitions in 256 MiB files
+    assert flat_table.bucket_count() == 4
+    with pytest.raises(ValueError):
+        ToFlatParquet(
+            database="test",
+            source_table=test_table,
+            target_table=test_table,
+            target_table_location="test",
+            workgroup="test",
+            s3_staging_dir="test",
+            output=OutputOptions(partitioned_by=("missing",)),
+        ).target_columns()
+
+
+def test_partition_filter():
+    keys = [("dt", "date"), ("hour", "int"), ("name", "string"), ("flag", "boolean")]
+    assert partition_filter(keys, ("2020-01-01", "3", "o'neil", "TRUE")) == (
+        '"dt" = date \'2020-01-01\' and "hour" = 3 '
+        "and \"name\" = 'o''neil' and \"flag\" = true"
+    )
+    assert partition_filter(keys[:1], (HIVE_NULL_PARTITION,)) == '"dt" is null'
+    with pytest.raises(ValueError):
+        partition_filter(keys[1:2], ("1 or 1=1",))
+    for value in ("nan", "inf", "1_000", "1.5"):
+        with pytest.raises(ValueError):
+            partition_filter(keys[1:2], (value,))
+    amounts = [("amount", "decimal(10,2)"), ("ratio", "double")]
+    assert partition_filter(amounts, ("-1.50", "2e-3")) == (
+        '"amount" = -1.50 and "ratio" = 2e-3'
+    )
+    with pytest.raises(ValueError):
+        partition_filter(amounts, ("1", "Infinity"))
+
+
+def incremental_flat_table(monkeypatch, source_partitions, target_partitions):
+    flat_table = ToFlatParquet(
+        database="test",
+        source_table=GlueTable("test", "raw", metadata=partitioned_metadata("raw")),
+        target_table=GlueTable("test", "flat", metadata=partitioned_metadata("flat")),
+        target_table_location="s3://bucket/flat/",
+        workgroup="test",
+        s3_staging_dir="test",
+    )
+    flat_table.target_table._metadata["StorageDescriptor"]["Columns"] = [
+        {"Name": name, "Type": type_}
+        for name, type_ in flat_table.source_table.flat_columns
+    ]
+    flat_table.target_table._metadata["StorageDescriptor"]["SerdeInfo"] = {
+        "SerializationLibrary": flat_table.output.storage.serde
+    }
+    purged = []
+    updated = {}
+    monkeypatch.setattr("flatten.aws.purge_location", purged.append)
+    monkeypatch.setattr(
+        flat_table.source_table, "partitions", lambda: source_partitions
+    )
+    monkeypatch.setattr(flat_table.target_table, "exists", lambda: True)
+    monkeypatch.setattr(
+        flat_table.target_table, "partitions", lambda: target_partitions
+    )
+    monkeypatch.setattr(
+        flat_table.target_table, "update_partition_parameters", updated.update
+    )
+    return flat_table, purged, updated
+
+
+def test_insert_incremental(monkeypatch):
+    source_partitions = [glue_partition("1"), glue_partition("2"), glue_partition("3")]
+    target_partitions = [
+        glue_partition(
+            "1",
+            "s3://bucket/flat/dt=1/",
+            {FINGERPRINT_PARAMETER: partition_fingerprint(source_partitions[0])},
+        ),
+        glue_partition("2", "s3://bucket/flat/dt=2/", {FINGERPRINT_PARAMETER: "old"}),
+    ]
+    flat_table, purged, updated = incremental_flat_table(
+        monkeypatch, source_partitions, target_partitions
+    )
+    flat_table.conn = FakeConnection()
+    assert flat_table.insert_incremental(max_concurrent_queries=1) == [("2",), ("3",)]
+    assert purged == ["s3://bucket/flat/dt=2/"]
+    assert [sql.split("where")[-1].strip() for sql in flat_table.conn.submitted] == [
+        "\"dt\" = '2'",
+        "\"dt\" = '3'",
+    ]
+    assert updated == {
+        ("2",): {FINGERPRINT_PARAMETER: partition_fingerprint(source_partitions[1])},
+        ("3",): {FINGERPRINT_PARAMETER: partition_fingerprint(source_partitions[2])},
+    }
+
+
+def test_insert_incremental_failed_partitions_are_retried(monkeypatch):
+    flat_table, purged, updated = incremental_flat_table(
+        monkeypatch, [glue_partition("1")], []
+    )
+    flat_table.conn = FakeConnection(error=OperationalError("failed"))
+    with pytest.raises(OperationalError):
+        flat_table.insert_incremental()
+    assert updated == {}
+
+
+def test_insert_incremental_new_files(tmp_path, monkeypatch):
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="bucket")
+        for key in ("raw/a.json", "raw/b.json", "raw/_SUCCESS", "raw_2/c.json"):
+            client.put_object(Bucket="bucket", Key=key, Body=key.encode())
+        monkeypatch.setattr("flatten.aws.s3_client", client)
+        flat_table, purged, updated = incremental_flat_table(monkeypatch, [], [])
+        flat_table.source_table._metadata["PartitionKeys"] = []
+        flat_table.target_table._metadata["PartitionKeys"] = []
+        flat_table.source_table._metadata["StorageDescriptor"][
+            "Location"
+        ] = "s3://bucket/raw"
+        flat_table._file_manifest = str(tmp_path / "manifest.json.gz")
+        ObjectManifest(
+            [
+                (
+                    "raw/a.json",
+                    client.head_object(Bucket="bucket", Key="raw/a.json")["ETag"],
+                )
+            ]
+        ).save(flat_table.file_manifest)
+
+        flat_table.conn = FakeConnection()
+        assert flat_table.insert_incremental() == ["raw/b.json"]
+        assert (
+            flat_table.conn.submitted[0]
+            .rstrip()
+            .endswith("where \"$path\" in ('s3://bucket/raw/b.json')")
+        )
+        assert len(ObjectManifest.load(flat_table.file_manifest)) == 2
+
+        assert flat_table.insert_incremental() == []
+        assert len(flat_table.conn.submitted) == 1
+
+
+def test_update_partition_parameters():
+    client, stubber = stubbed_glue_client()
+    table = GlueTable("db", "flat", metadata=partitioned_metadata("flat"))
+    table.glue_client = client
+    partition = glue_partition("1", parameters={"a": "1"})
+    with stubber:
+        stubber.add_response(
+            "get_partitions",
+            {"Partitions": [partition, glue_partition("2")]},
+            {"DatabaseName": "db", "TableName": "flat"},
+        )
+        stubber.add_response(
+            "batch_update_partition",
+            {},
+            {
+                "DatabaseName": "db",
+                "TableName": "flat",
+                "Entries": [
+                    {
+                        "PartitionValueList": ["1"],
+                        "PartitionInput": {
+                            **partition,
+                            "Parameters": {"a": "1", "b": "2"},
+                        },
+                    }
+                ],
+            },
+        )
+        table.update_partition_parameters({("1",): {"b": "2"}})
+        stubber.assert_no_pending_responses()
+
+
+def test_replace_partitions_updates_existing():
+    client, stubber = stubbed_glue_client()
+    table = GlueTable("db", "flat", metadata=partitioned_metadata("flat"))
+    table.glue_client = client
+    new = [glue_partition("2", parameters={"a": "1"}), glue_partition("3")]
+    with stubber:
+        stubber.add_response(
+            "get_partitions",
+            {"Partitions": [glue_partition("1"), glue_partition("2")]},
+            {"DatabaseName": "db", "TableName": "flat"},
+        )
+        stubber.add_response(
+            "batch_create_partition",
+            {},
+            {"DatabaseName": "db", "TableName": "flat", "PartitionInputList": new[1:]},
+        )
+        stubber.add_response(
+            "batch_update_partition",
+            {},
+            {
+                "DatabaseName": "db",
+                "TableName": "flat",
+                "Entries": [{"PartitionValueList": ["2"], "PartitionInput": new[0]}],
+            },
+        )
+        stubber.add_response(
+            "batch_delete_partition",
+            {},
+            {
+                "DatabaseName": "db",
+                "TableName": "flat",
+                "PartitionsToDelete": [{"Values": ["1"]}],
+            },
+        )
+        table.replace_partitions(new)
+        stubber.assert_no_pending_responses()
+
+
+def test_fingerprinted_partitions(monkeypatch):
+    source_partitions = [glue_partition("1"), glue_partition("2")]
+    flat_table, purged, updated = incremental_flat_table(
+        monkeypatch, source_partitions, []
+    )
+    fingerprints = flat_table.source_partition_fingerprints()
+    assert fingerprints == {
+        ("1",): partition_fingerprint(source_partitions[0]),
+        ("2",): partition_fingerprint(source_partitions[1]),
+    }
+    target = flat_table.fingerprinted(
+        [glue_partition("1", "s3://bucket/flat/dt=1/", {"a": "1"})], fingerprints
+    )
+    assert target[0]["Parameters"] == {
+        "a": "1",
+        FINGERPRINT_PARAMETER: fingerprints[("1",)],
+    }
+
+    flat_table.output = OutputOptions(partitioned_by=("season",))
+    assert flat_table.source_partition_fingerprints() == {}
+
+
+def test_shard_filters_respect_partition_limit(monkeypatch):
+    test_table = GlueTable("test", "test", metadata=partitioned_metadata())
+    partitions = [glue_partition(f"{i:03d}") for i in range(250)]
+    monkeypatch.setattr(test_table, "partitions", lambda: partitions)
+    flat_table = ToFlatParquet(
+        database="test",
+        source_table=test_table,
+        target_table=test_table,
+        target_table_location="test",
+        workgroup="test",
+        s3_staging_dir="test",
+    )
+    filters = flat_table.shard_filters()
+    assert len(filters) == 3
+    assert [len(f.split(" or ")) for f in filters] == [84, 84, 82]
+    assert filters[0].startswith("(\"dt\" = '000') or (\"dt\" = '001')")
+
+    flat_table.shard_by = "path"
+    with pytest.raises(ValueError):
+        flat_table.shard_filters()
+
+    partitions[3:] = []
+    flat_table.shards = 2
+    with pytest.raises(ValueError, match="same partitions"):
+        flat_table.shard_filters()
+
+    # shards of source partitions overlap in the partitions of flat columns
+    flat_table.shard_by = "partition"
+    assert len(flat_table.shard_filters()) == 2
+    flat_table.output = OutputOptions(partitioned_by=("id",))
+    with pytest.raises(ValueError, match="same partitions"):
+        flat_table.shard_filters()
+
+
+def test_shard_filters_by_path():
+    with open(Path(Path(__file__).parent.absolute(), "glue_table.json")) as f:
+        table_metadata = json.load(f)
+    test_table = GlueTable("test", "test", metadata=table_metadata)
+    flat_table = ToFlatParquet(
+        database="test",
+        source_table=test_table,
+        target_table=test_table,
+        target_table_location="test",
+        workgroup="test",
+        s3_staging_dir="test",
+        shards=4,
+    )
+    filters = flat_table.shard_filters()
+    assert len(filters) == 4
+    assert all(
+        '"$path"' in f and f.endswith(f", 4)) = {i}") for i, f in enumerate(filters)
+    )
+    sql = flat_table.generate_insert_overwrite_query(test_table, "s3://b/", filters[1])
+    assert " ".join(sql.split()).endswith(f'from "test"."test" where {filters[1]}')
+
+    with pytest.raises(ValueError):
+        ToFlatParquet(
+            database="test",
+            source_table=test_table,
+            target_table=test_table,
+            target_table_location="test",
+            workgroup="test",
+            s3_staging_dir="test",
+            shards=4,
+            shard_by="hash",
+        )
+
+
+class FlakyConnection(FakeConnection):
+    """Fails the first submitted query that contains the given text"""
+
+    def __init__(self, fail_on):
+        super().__init__()
+        self.fail_on = fail_on
+
+    def submit(self, sql):
+        self.submitted.append(sql)
+        future = QueryFuture(f"query-{len(self.submitted)}")
+        if self.fail_on and self.fail_on in sql:
+            self.fail_on = None
+            future.set_exception(OperationalError("failed"))
+        else:
+            future.set_result(None)
+        return future
+
+
+def test_insert_overwrite_sharded_retries_shards(tmp_path, monkeypatch):
+    flat_table, refreshed, temp_table = resumable_flat_table(
+        tmp_path, monkeypatch, shards=3
+    )
+    purged = []
+    monkeypatch.setattr("flatten.aws.purge_location", purged.append)
+    monkeypatch.setattr(flat_table.target_table, "location", lambda: "s3://b/flat/")
+    flat_table.conn = FlakyConnection(fail_on=", 3)) = 1")
+    flat_table.insert_overwrite()
+    assert refreshed == [1]
+    assert len(flat_table.conn.submitted) == 4
+    assert purged == [
+        "s3://b/flat/shard_0000/",
+        "s3://b/flat/shard_0001/",
+        "s3://b/flat/shard_0002/",
+        "s3://b/flat/shard_0001/",
+    ]
+    assert (
+        "external_location = 's3://b/flat/shard_0001/'" in flat_table.conn.submitted[3]
+    )
+    assert list((tmp_path / "runs").iterdir()) == []
+
+
+def test_insert_overwrite_sharded_gives_up(tmp_path, monkeypatch):
+    flat_table, refreshed, temp_table = resumable_flat_table(
+        tmp_path, monkeypatch, shards=2, shard_retries=0
+    )
+    monkeypatch.setattr("flatten.aws.purge_location", lambda location: None)
+    monkeypatch.setattr(flat_table.target_table, "location", lambda: "s3://b/flat/")
+    flat_table.conn = FlakyConnection(fail_on=", 2)) = 0")
+    with pytest.raises(OperationalError):
+        flat_table.insert_overwrite()
+    assert flat_table.run_state().get("shards_done") == [1]
+
+
+def test_insert_overwrite_resumes_unfinished_shards(tmp_path, monkeypatch):
+    flat_table, refreshed, temp_table = resumable_flat_table(
+        tmp_path, monkeypatch, shards=3
+    )
+    monkeypatch.setattr("flatten.aws.purge_location", lambda location: None)
+    monkeypatch.setattr(flat_table.target_table, "location", lambda: "s3://b/flat/")
+    flat_table.run_state().update(
+        step="submitted",
+        shard_filters=["a = 0", "a = 1", "a = 2"],
+        shards_done=[0, 2],
+    )
+    flat_table.conn = FakeConnection()
+    flat_table.insert_overwrite()
+    assert refreshed == []
+    assert len(flat_table.conn.submitted) == 1
+    assert flat_table.conn.submitted[0].rstrip().endswith("where a = 1")
+
+
+def test_evolve_schema(monkeypatch):
+    flat_table, purged, updated = incremental_flat_table(monkeypatch, [], [])
+    columns = flat_table.target_table._metadata["StorageDescriptor"]["Columns"]
+    del columns[-1]
+    columns[0]["Type"] = "varchar(10)"
+    updates = []
+    monkeypatch.setattr(
+        flat_table.target_table, "update", lambda **kwargs: updates.append(kwargs)
+    )
+
+    diff = flat_table.evolve_schema(dry_run=True)
+    assert [change.kind for change in diff.changes] == ["widen", "add"]
+    assert updates == []
+
+    flat_table.evolve_schema()
+    assert updates == [{"columns": flat_table.source_table.flat_columns}]
+
+    columns[0]["Type"] = "bigint"
+    with pytest.raises(ValueError):
+        flat_table.insert_incremental()
+
+
+def test_schema_diff_storage_changes(monkeypatch):
+    flat_table, purged, updated = incremental_flat_table(monkeypatch, [], [])
+    assert not flat_table.schema_diff()
+    descriptor = flat_table.target_table._metadata["StorageDescriptor"]
+    descriptor["BucketColumns"] = ["id"]
+    descriptor["NumberOfBuckets"] = 8
+    assert flat_table.schema_diff().changes == [
+        ColumnChange("incompatible", "bucketing", "id (8)", "", "the bucketing changed")
+    ]
+    flat_table.output = OutputOptions(bucketed_by=("ID",))
+    assert not flat_table.schema_diff()
+    flat_table.output = OutputOptions(bucketed_by=("id",), bucket_count=8)
+    assert not flat_table.schema_diff()
+    flat_table.output = OutputOptions(bucketed_by=("id",), bucket_count=16)
+    assert not flat_table.schema_diff().compatible
+
+    # ORC columns are read by index, only appending columns is compatible
+    flat_table.output = OutputOptions(format="orc", bucketed_by=("id",), bucket_count=8)
+    descriptor["SerdeInfo"] = {"SerializationLibrary": flat_table.output.storage.serde}
+    columns = descriptor["Columns"]
+    last = columns.pop()
+    assert flat_table.schema_diff().compatible
+    columns.insert(0, last)
+    assert not flat_table.schema_diff().compatible
+
+
+class StatsConnection(FakeConnection):
+    def __init__(self):
+        super().__init__()
+        self.query_stats = []
+
+    def submit(self, sql):
+        future = super().submit(sql)
+        self.query_stats.append(
+            QueryStats(
+                future.query_id,
+                "DML",
+                2000,
+                100,
+                50,
+                10,
+                5,
+                writes=bool(WRITING_QUERY.match(sql)),
+            )
+        )
+        return future
+
+    def output_rows(self, query_id):
+        return 42
+
+
+def test_insert_overwrite_recorded_in_ledger(tmp_path, monkeypatch):
+    ledger = RunLedger(str(tmp_path / "ledger.jsonl"))
+    flat_table, refreshed, temp_table = resumable_flat_table(
+        tmp_path, monkeypatch, ledger=ledger
+    )
+    flat_table.conn = StatsConnection()
+    monkeypatch.setattr(flat_table.target_table, "location", lambda: "s3://b/flat/")
+    monkeypatch.setattr("flatten.aws.s3_listing_totals", lambda location: (3, 300))
+    flat_table.insert_overwrite()
+    flat_table.insert_overwrite()
+    flat_table.conn.error = OperationalError("failed")
+    with pytest.raises(OperationalError):
+        flat_table.insert_overwrite(force=True)
+
+    succeeded, skipped, failed = ledger.records()
+    assert succeeded["status"] == "succeeded"
+    assert succeeded["source_table"] == '"test"."test"'
+    assert succeeded["queries"] == 1
+    assert succeeded["data_scanned_bytes"] == 2000
+    assert succeeded["queue_ms"] == 50
+    assert succeeded["rows_written"] == 42
+    assert (succeeded["target_files"], succeeded["target_bytes"]) == (3, 300)
+    assert succeeded["query_stats"][0]["query_id"] == "query-1"
+    assert skipped["status"] == "skipped"
+    assert skipped["queries"] == 0
+    assert failed["status"] == "failed"
+    assert failed["error"] == "OperationalError: failed"
+    assert failed["target_bytes"] is None
+
+
+def test_ledger_without_target_listing(tmp_path, monkeypatch):
+    ledger = RunLedger(str(tmp_path / "ledger.jsonl"), list_target=False)
+    flat_table, refreshed, temp_table = resumable_flat_table(
+        tmp_path, monkeypatch, ledger=ledger
+    )
+    flat_table.conn = StatsConnection()
+
+    def listing(location):
+        raise AssertionError("The target must not be listed")
+
+    monkeypatch.setattr("flatten.aws.s3_listing_totals", listing)
+    flat_table.insert_overwrite()
+    (record,) = ledger.records()
+    assert record["status"] == "succeeded"
+    assert record["rows_written"] == 42
+    assert (record["target_files"], record["target_bytes"]) == (None, None)
+
+
+def test_insert_overwrite_skips_unchanged_source(tmp_path, monkeypatch):
+    flat_table, refreshed, temp_table = resumable_flat_table(tmp_path, monkeypatch)
+    flat_table.conn = FakeConnection()
+    flat_table.insert_overwrite()
+    fingerprint = flat_table.stored_fingerprint()
+    assert fingerprint == flat_table.run_fingerprint()
+
+    flat_table.insert_overwrite()
+    assert refreshed == [1]
+    assert len(flat_table.conn.submitted) == 1
+
+    monkeypatch.setattr("flatten.aws.s3_listing_digest", lambda location: "new files")
+    assert flat_table.run_fingerprint() != fingerprint
+    flat_table.insert_overwrite()
+    assert len(flat_table.conn.submitted) == 2
+
+
+def test_forced_insert_overwrite_clears_fingerprint(tmp_path, monkeypatch):
+    flat_table, refreshed, temp_table = resumable_flat_table(tmp_path, monkeypatch)
+    flat_table.conn = FakeConnection()
+    flat_table.insert_overwrite()
+    assert flat_table.stored_fingerprint()
+
+    def listing(location):
+        raise AssertionError("A forced run must not list the source")
+
+    monkeypatch.setattr("flatten.aws.s3_listing_digest", listing)
+    flat_table.insert_overwrite(force=True)
+    assert len(flat_table.conn.submitted) == 2
+    assert flat_table.stored_fingerprint() is None
+
+
+def test_run_fingerprint_lists_partitions_outside_the_location(monkeypatch):
+    source_partitions = [
+        glue_partition("1", "s3://xxxxx/nyphilarchive/dt=1/"),
+        glue_partition("2", "s3://other-bucket/late/dt=2"),
+    ]
+    flat_table, purged, updated = incremental_flat_table(
+        monkeypatch, source_partitions, []
+    )
+    listed = []
+    monkeypatch.setattr(
+        "flatten.aws.s3_listing_digest", lambda location: listed.append(location)
+    )
+    fingerprint = flat_table.run_fingerprint()
+    assert listed == ["s3://other-bucket/late/dt=2/", "s3://xxxxx/nyphilarchive/"]
+
+    monkeypatch.setattr("flatten.aws.s3_listing_digest", lambda location: location)
+    assert flat_table.run_fingerprint() != fingerprint
+
+
+def test_flat_mapping_projection(monkeypatch):
+    with open(Path(Path(__file__).parent.absolute(), "glue_table.json")) as f:
+        table_metadata = json.load(f)
+    table = GlueTable(
+        "test",
+        "test",
+        metadata=table_metadata,
+        projection=ColumnProjection(["id", "work.**", "!work.soloists"]),
+    )
+    parsed = []
+    parse_type = table.parse_type
+    monkeypatch.setattr(
+        table,
+        "parse_type",
+        lambda col_type: parsed.append(col_type) or parse_type(col_type),
+    )
+    assert [col.target_name for col in table.flat_mapping()] == [
+        "id",
+        "work_id",
+        "work_composername",
+        "work_worktitle",
+        "work_conductorname",
+    ]
+    # the concert struct is pruned without parsing it
+    assert not any(col_type.startswith("struct<eventType") for col_type in parsed)
+
+    table.projection = ColumnProjection(["missing"])
+    with pytest.raises(ValueError):
+        table.flat_mapping()
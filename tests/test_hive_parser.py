@@ -1,5 +1,17 @@
+import random
+from pathlib import Path
+
 import pytest  # noqa
+from flatten.hive_parser import fast_parse
+from flatten.hive_parser import flatten_type
 from flatten.hive_parser import HiveParser
+from flatten.hive_parser import SchemaTransformer
+from flatten.hive_parser import serialize_type
+from flatten.hive_parser import UnsupportedType
+from lark import Lark
+from lark import Token
+from lark import Tree
+from lark.reconstruct import Reconstructor
 
 
 def test_nested_struct():
@@ -96,3 +108,187 @@ def test_array():
             {"loc_lat": "decimal", "service_handler": "string"},
         ]
     }
+
+
+HIVE_TYPES = [
+    "string",
+    "integer",
+    "interval",
+    "decimal(12,1)",
+    "varchar(65535)",
+    "timestamp",
+    "numeric",
+    "dec(10,2)",
+    "map<string,array<int>>",
+    "array<string>",
+    "array<string,string,struct<loc_lat:decimal,service_handler:string>>",
+    "struct<string:string,int:int,struct:struct<array:array<bigint>>>",
+    "struct<a:map<string,struct<x:double,y:timestamp>>,b:char(3)>",
+    "struct<loc_lat:double,source:struct<id:string,contacts:struct<admin:struct<"
+    "email:string,name:array<string>>>>,tags:array<struct<key:string,value:string>>>",
+]
+
+
+@pytest.fixture(scope="module")
+def baseline_parser():
+    """Earley parser of the grammar before it was made LALR compatible"""
+    with open(Path(__file__).parent / "hive_grammar_baseline.lark") as f:
+        return Lark(f.read(), start="type_db_col")
+
+
+@pytest.mark.parametrize("hive_str", HIVE_TYPES)
+def test_lalr_matches_earley(hive_str, baseline_parser):
+    baseline = baseline_parser.parse(hive_str)
+    earley = HiveParser(parser="earley", cache=False, fast_path=False)
+    lalr = HiveParser(cache=False, fast_path=False)
+    assert lalr.parser.parse(hive_str) == baseline
+    assert earley.parser.parse(hive_str) == baseline
+    expected = SchemaTransformer().transform(baseline)
+    assert lalr(hive_str) == expected
+    assert HiveParser(cache=False)(hive_str) == expected
+
+
+def test_parser_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("FLATTEN_CACHE_DIR", str(tmp_path))
+    hive = HiveParser()
+    assert Path(hive.cache_file).parent == tmp_path
+    assert Path(hive.cache_file).exists()
+
+    cached = HiveParser()
+    assert cached(HIVE_TYPES[-1]) == hive(HIVE_TYPES[-1])
+
+
+def test_parser_cache_corrupted(tmp_path, monkeypatch):
+    monkeypatch.setenv("FLATTEN_CACHE_DIR", str(tmp_path))
+    Path(HiveParser().cache_file).write_bytes(b"corrupted")
+    assert HiveParser()("array<string>") == ["string"]
+
+
+def test_parser_cache_not_writable(tmp_path, monkeypatch):
+    monkeypatch.setenv("FLATTEN_CACHE_DIR", str(tmp_path))
+
+    def full_disk(*args, **kwargs):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr("flatten.hive_parser.tempfile.NamedTemporaryFile", full_disk)
+    assert HiveParser()("array<string>") == ["string"]
+    assert list(tmp_path.iterdir()) == []
+
+
+def random_hive_type(rng, depth=0):
+    ws = rng.choice(["", "", " ", "\n  "])
+    kind = rng.random()
+    if depth < 4 and kind < 0.25:
+        fields = [
+            f"{rng.choice(['a', 'B_1', '-x', 'string', 'struct', 'int'])}{i}{ws}:"
+            f"{ws}{random_hive_type(rng, depth + 1)}"
+            for i in range(rng.randint(0, 4))
+        ]
+        return f"struct{ws}<{ws}{(ws + ',').join(fields)}{ws}>"
+    if depth < 4 and kind < 0.4:
+        items = [random_hive_type(rng, depth + 1) for _ in range(rng.randint(0, 3))]
+        return f"array<{ws}{','.join(items)}>"
+    if kind < 0.45:
+        return f"map<string,{random_hive_type(rng, depth + 1)}>"
+    if kind < 0.55:
+        return rng.choice(
+            ["decimal(12, 1)", "dec(3)", "numeric", "char(5)", "varchar (10)"]
+        )
+    return rng.choice(
+        ["string", "bigint", "integer", "int", "double", "timestamp", "date", "boolean"]
+    )
+
+
+def test_fast_parse_matches_lark():
+    rng = random.Random(42)
+    lark_parser = HiveParser(fast_path=False)
+    for _ in range(300):
+        hive_str = random_hive_type(rng)
+        expected = lark_parser(hive_str)
+        try:
+            assert fast_parse(hive_str) == expected
+        except UnsupportedType:
+            assert "map<" in hive_str
+
+
+@pytest.mark.parametrize(
+    "hive_str",
+    [
+        "",
+        "String",
+        "stringx",
+        "struct<a:string",
+        "struct<a:string,>",
+        "struct<1a:string>",
+        "array<string>>",
+        "decimal(1.5)",
+        "decimal(1)(2)",
+        "char",
+        "varchar()",
+        "struct<a string>",
+    ],
+)
+def test_fast_parse_falls_back(hive_str):
+    with pytest.raises(UnsupportedType):
+        fast_parse(hive_str)
+
+
+def reconstruct_struct_type(type: dict):
+    """Reference implementation of serialize_type using the lark Reconstructor"""
+    tree = Tree("structtype", [])
+    for k, v in type.items():
+        if isinstance(v, dict):
+            value = reconstruct_struct_type(v)
+        else:
+            value = Tree("primitivetype", [Tree(v, [])])
+        tree.children.append(Tree("name_type", [Token("NAME", k), value]))
+    return tree
+
+
+def reconstruct_array(parser, type: list):
+    tree = Tree("listtype", [])
+    for i in type:
+        if isinstance(i, dict):
+            tree.children.append(reconstruct_struct_type(i))
+        else:
+            tree.children.append(Tree("primitivetype", [Tree(i, [])]))
+    return Reconstructor(parser).reconstruct(tree)
+
+
+@pytest.mark.parametrize(
+    "hive_str",
+    [
+        "array<string>",
+        "array<string,bigint>",
+        "array<struct<key:string,value:string>>",
+        "array<struct<a:int,b:struct<c:double,d:timestamp>>>",
+    ],
+)
+def test_serialize_matches_reconstructor(hive_str):
+    hive = HiveParser(cache=False)
+    parsed = hive(hive_str)
+    assert serialize_type(parsed) == reconstruct_array(hive.parser, parsed)
+    assert serialize_type(parsed) == hive_str
+
+
+@pytest.mark.parametrize("hive_str", HIVE_TYPES)
+def test_serialize_round_trip(hive_str):
+    hive = HiveParser()
+    parsed = hive(hive_str)
+    assert hive(serialize_type(parsed)) == parsed
+
+
+def test_serialize_canonical():
+    hive = HiveParser()
+    parsed = hive("struct< a : integer, b:array<decimal( 12 , 1 )>, c:map<string,dec>>")
+    assert serialize_type(parsed) == (
+        "struct<a:int,b:array<decimal(12,1)>,c:map<string,decimal>>"
+    )
+
+
+def test_flatten_type():
+    hive = HiveParser()
+    assert flatten_type(hive, "struct<a:struct<b:decimal(1,2)>,c:array<int>>") == [
+        "a_b:decimal(1,2)",
+        "c:string",
+    ]
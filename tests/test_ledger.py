@@ -0,0 +1,118 @@
+import pytest  # noqa
+from flatten.athena import QueryFuture
+from flatten.aws import AthenaConnection
+from flatten.ledger import format_trends
+from flatten.ledger import QueryStats
+from flatten.ledger import RunLedger
+from flatten.ledger import summarize
+from flatten.ledger import table_trends
+from pyathena.error import OperationalError
+from pyathena.model import AthenaQueryExecution
+
+
+def execution(query_id, scanned, query="select 1"):
+    return AthenaQueryExecution(
+        {
+            "QueryExecution": {
+                "QueryExecutionId": query_id,
+                "Query": query,
+                "StatementType": "DML",
+                "Status": {"State": "SUCCEEDED"},
+                "Statistics": {
+                    "DataScannedInBytes": scanned,
+                    "EngineExecutionTimeInMillis": 1200,
+                    "QueryQueueTimeInMillis": 300,
+                    "QueryPlanningTimeInMillis": 100,
+                    "ServiceProcessingTimeInMillis": 20,
+                },
+            }
+        }
+    )
+
+
+def test_connection_records_successful_queries():
+    conn = AthenaConnection("test", "primary", None)
+    succeeded, failed = QueryFuture("q1"), QueryFuture("q2")
+    for future in (succeeded, failed):
+        future.add_done_callback(conn._record_stats)
+    succeeded.set_result(execution("q1", 2000))
+    failed.set_exception(OperationalError("failed"))
+    assert conn.query_stats == [QueryStats("q1", "DML", 2000, 1200, 300, 100, 20, None)]
+
+
+def test_writing_queries():
+    ctas = 'create TABLE "db"."tmp"\n with (format = \'PARQUET\')\n as\n select 1'
+    assert QueryStats.from_execution(execution("q1", 0, ctas)).writes
+    insert = '  insert into "db"."flat"\n select 1'
+    assert QueryStats.from_execution(execution("q2", 0, insert)).writes
+    assert not QueryStats.from_execution(execution("q3", 0)).writes
+
+
+def test_summarize():
+    queries = [
+        QueryStats(
+            "q1", data_scanned_bytes=10**12, queue_ms=5, output_rows=3, writes=True
+        ),
+        QueryStats("q2", data_scanned_bytes=1, engine_ms=7, output_rows=4, writes=True),
+    ]
+    totals = summarize(queries)
+    assert totals["data_scanned_bytes"] == 10**12 + 1
+    assert totals["cost_usd"] == 5.00005
+    assert totals["rows_written"] == 7
+    assert (totals["queue_ms"], totals["engine_ms"]) == (5, 7)
+    # selects don't write rows, writing queries without statistics are left out
+    more = [QueryStats("q3", output_rows=100), QueryStats("q4", writes=True)]
+    assert summarize(queries + more)["rows_written"] == 7
+    assert summarize([QueryStats("q1", writes=True)])["rows_written"] is None
+
+
+def record(table, scanned, status="succeeded", queue_ms=0):
+    return {
+        "target_table": table,
+        "started": "2026-01-01T00:00:00",
+        "status": status,
+        "data_scanned_bytes": scanned,
+        "queue_ms": queue_ms,
+        "engine_ms": 100,
+        "cost_usd": 0.01,
+        "target_bytes": 10,
+    }
+
+
+def test_ledger_is_append_only(tmp_path):
+    ledger = RunLedger(str(tmp_path / "runs" / "ledger.jsonl"))
+    ledger.append(record('"db"."flat_a"', 1))
+    with open(ledger.path, "a") as f:
+        f.write("{broken\n")
+    RunLedger(ledger.path).append(record('"db"."flat_b"', 2))
+    assert [r["data_scanned_bytes"] for r in ledger.records()] == [1, 2]
+    assert [r["data_scanned_bytes"] for r in ledger.records("db.flat_b")] == [2]
+    assert list(RunLedger(str(tmp_path / "missing.jsonl")).records()) == []
+
+
+def test_table_trends():
+    records = [
+        record("a", 100, queue_ms=100),
+        record("a", 100, queue_ms=300),
+        record("b", 50),
+        record("a", 0, status="failed"),
+        record("a", 150),
+    ]
+    trend_a, trend_b = table_trends(records)
+    assert (trend_a.table, trend_a.runs, trend_a.failed) == ("a", 4, 1)
+    assert trend_a.data_scanned_bytes == 150
+    assert trend_a.scanned_change == pytest.approx(0.5)
+    assert trend_a.queue_share == pytest.approx(400 / 800)
+    assert trend_b.scanned_change is None
+    lines = format_trends([trend_a, trend_b]).splitlines()
+    assert lines[0].split() == [
+        "table",
+        "runs",
+        "failed",
+        "scanned",
+        "change",
+        "cost",
+        "queue",
+        "size",
+    ]
+    assert lines[1].split()[:6] == ["a", "4", "1", "150", "B", "+50%"]
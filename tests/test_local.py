@@ -0,0 +1,277 @@
+import json
+
+import pytest  # noqa
+from flatten.aws import GlueTable
+from flatten.aws import purge_location
+from flatten.aws import ToFlatParquet
+from flatten.backend import Backend
+from flatten.cli import app
+from flatten.hive_parser import HiveParser
+from flatten.output import OutputOptions
+from flatten.local import duckdb_type
+from flatten.manifest import ObjectManifest
+from flatten.state import RunStateStore
+from typer.testing import CliRunner
+
+JSON_SERDE = "org.openx.data.jsonserde.JsonSerDe"
+
+
+def test_local_s3(backend):
+    s3 = backend.s3
+    for i in range(3):
+        s3.put_object(Bucket="b", Key=f"raw/part-{i}.json", Body=b"{}\n")
+    s3.put_object(Bucket="b", Key="raw_2/other.json", Body="{}")
+    pages = list(
+        s3.get_paginator("list_objects_v2").paginate(Bucket="b", Prefix="raw/")
+    )
+    assert [obj["Key"] for obj in pages[0]["Contents"]] == [
+        "raw/part-0.json",
+        "raw/part-1.json",
+        "raw/part-2.json",
+    ]
+    assert s3.get_object(Bucket="b", Key="raw/part-1.json")["Body"].read() == b"{}\n"
+    with pytest.raises(s3.exceptions.NoSuchKey):
+        s3.get_object(Bucket="b", Key="missing")
+
+    result = purge_location("s3://b/raw")
+    assert result.objects == 3
+    assert s3.list_objects_v2(Bucket="b", Prefix="raw/")["KeyCount"] == 0
+    assert s3.list_objects_v2(Bucket="b", Prefix="raw_2/")["KeyCount"] == 1
+
+    manifest = ObjectManifest.load("s3://b/manifest.json.gz", s3)
+    manifest.update([("raw/a.json", '"1"')])
+    manifest.save("s3://b/manifest.json.gz", s3)
+    assert ObjectManifest.load("s3://b/manifest.json.gz", s3).get("raw/a.json") == '"1"'
+
+
+def test_local_catalog(backend):
+    table = GlueTable("db", "flat")
+    assert not table.exists()
+    table.create(
+        columns=[("id", "string")],
+        location="s3://b/flat/",
+        partitions=[("dt", "string")],
+    )
+    version = table.metadata["VersionId"]
+    table.update(columns=[("id", "string"), ("n", "bigint")])
+    assert table.columns() == [("id", "string"), ("n", "bigint")]
+    assert GlueTable("db", "flat", table_version_id=version).columns() == [
+        ("id", "string")
+    ]
+
+    partitions = [
+        {
+            "Values": [dt],
+            "StorageDescriptor": {"Location": f"s3://b/flat/dt={dt}/"},
+            "Parameters": {},
+        }
+        for dt in ("1", "2")
+    ]
+    table.replace_partitions(partitions)
+    table.update_partition_parameters({("2",): {"flatten.source_fingerprint": "x"}})
+    assert [p["Values"] for p in table.partitions()] == [["1"], ["2"]]
+    assert table.partitions()[1]["Parameters"] == {"flatten.source_fingerprint": "x"}
+    table.replace_partitions(partitions[:1])
+    assert [p["Values"] for p in table.partitions()] == [["1"]]
+
+    assert [
+        t["Name"] for t in GlueTable.metadata_cache.prefetch(backend.glue, "db")
+    ] == ["flat"]
+    table.delete()
+    assert not table.exists()
+
+
+def test_incomplete_backend():
+    class CatalogOnly(Backend):
+        def glue_client(self):
+            return None
+
+    with pytest.raises(TypeError):
+        CatalogOnly()
+
+
+def test_duckdb_type():
+    parse = HiveParser()
+    assert duckdb_type(parse("array<struct<a:int,b:varchar(3)>>")) == (
+        'STRUCT("a" INTEGER, "b" VARCHAR)[]'
+    )
+    assert (
+        duckdb_type(parse("map<string,decimal(10,2)>")) == "MAP(VARCHAR, DECIMAL(10,2))"
+    )
+
+
+def test_flatten_locally(backend, tmp_path):
+    pytest.importorskip("duckdb")
+    rows = [
+        {"id": str(i), "concert": {"venue": f"hall {i % 2}", "seats": i}}
+        for i in range(10)
+    ]
+    backend.s3.put_object(
+        Bucket="b",
+        Key="raw/data.json",
+        Body="".join(json.dumps(row) + "\n" for row in rows),
+    )
+    GlueTable("db", "raw").create(
+        columns=[("id", "string"), ("concert", "struct<venue:string,seats:int>")],
+        location="s3://b/raw/",
+        serde=JSON_SERDE,
+    )
+    flat_table = ToFlatParquet(
+        database="db",
+        source_table=GlueTable("db", "raw"),
+        target_table=GlueTable("db", "flat"),
+        target_table_location="s3://b/flat/",
+        workgroup="primary",
+        s3_staging_dir="s3://b/staging/",
+        state_store=RunStateStore(str(tmp_path / "runs")),
+        file_manifest=str(tmp_path / "manifest.json.gz"),
+    )
+    flat_table.insert_overwrite()
+
+    assert GlueTable("db", "flat").columns() == [
+        ("id", "string"),
+        ("concert_venue", "string"),
+        ("concert_seats", "int"),
+    ]
+    assert flat_table.conn.query(
+        'select count(*), sum(concert_seats) from "db"."flat"'
+    ).fetchone() == (10, 45)
+    assert flat_table.conn.query_stats[0].data_scanned_bytes > 0
+    # Unchanged sources are skipped
+    flat_table.insert_overwrite()
+    assert len(flat_table.conn.query_stats) == 2
+
+
+def test_incremental_after_full_refresh(backend, tmp_path):
+    pytest.importorskip("duckdb")
+    source = GlueTable("db", "raw")
+    source.create(
+        columns=[("id", "string"), ("concert", "struct<venue:string,seats:int>")],
+        location="s3://b/raw/",
+        partitions=[("dt", "string")],
+        serde=JSON_SERDE,
+    )
+    partitions = []
+    for dt in ("2020-01-01", "2020-01-02"):
+        row = {"id": dt, "concert": {"venue": "hall", "seats": 1}}
+        backend.s3.put_object(
+            Bucket="b", Key=f"raw/dt={dt}/data.json", Body=json.dumps(row) + "\n"
+        )
+        partitions.append(
+            {
+                "Values": [dt],
+                "StorageDescriptor": {
+                    **source.metadata["StorageDescriptor"],
+                    "Location": f"s3://b/raw/dt={dt}/",
+                },
+                "Parameters": {},
+            }
+        )
+    source.replace_partitions(partitions)
+    flat_table = ToFlatParquet(
+        database="db",
+        source_table=GlueTable("db", "raw"),
+        target_table=GlueTable("db", "flat"),
+        target_table_location="s3://b/flat/",
+        workgroup="primary",
+        s3_staging_dir="s3://b/staging/",
+        state_store=RunStateStore(str(tmp_path / "runs")),
+        file_manifest=str(tmp_path / "manifest.json.gz"),
+    )
+    flat_table.insert_overwrite()
+    queries = len(flat_table.conn.query_stats)
+
+    # The partitions of the full refresh are up to date
+    assert flat_table.insert_incremental() == []
+    assert len(flat_table.conn.query_stats) == queries
+
+    partitions[1]["Parameters"] = {"updated": "1"}
+    source.replace_partitions(partitions)
+    assert flat_table.insert_incremental() == [("2020-01-02",)]
+    assert flat_table.conn.query('select count(*) from "db"."flat"').fetchone() == (2,)
+
+
+def test_new_files_after_full_refresh(backend, tmp_path):
+    pytest.importorskip("duckdb")
+
+    def put(name, seats):
+        row = {"id": name, "concert": {"venue": "hall", "seats": seats}}
+        backend.s3.put_object(
+            Bucket="b", Key=f"raw/{name}.json", Body=json.dumps(row) + "\n"
+        )
+
+    put("a", 1)
+    put("b", 2)
+    GlueTable("db", "raw").create(
+        columns=[("id", "string"), ("concert", "struct<venue:string,seats:int>")],
+        location="s3://b/raw/",
+        serde=JSON_SERDE,
+    )
+    manifest = str(tmp_path / "manifest.json.gz")
+
+    def flat_table(**kwargs):
+        return ToFlatParquet(
+            database="db",
+            source_table=GlueTable("db", "raw"),
+            target_table=GlueTable("db", "flat"),
+            target_table_location="s3://b/flat/",
+            workgroup="primary",
+            s3_staging_dir="s3://b/staging/",
+            state_store=RunStateStore(str(tmp_path / "runs")),
+            file_manifest=manifest,
+            **kwargs,
+        )
+
+    def rows(table):
+        return table.conn.query('select count(*) from "db"."flat"').fetchone()[0]
+
+    table = flat_table()
+    table.insert_overwrite()
+    assert len(ObjectManifest.load(manifest)) == 2
+    # Only the files added after the full refresh are appended
+    put("c", 3)
+    assert table.insert_incremental() == ["raw/c.json"]
+    assert rows(table) == 3
+
+    # A lost manifest would append all files again
+    (tmp_path / "manifest.json.gz").unlink()
+    with pytest.raises(ValueError, match="rebuild-manifest"):
+        table.insert_incremental()
+    assert rows(table) == 3
+
+    table = flat_table(rebuild_manifest=True)
+    assert sorted(table.insert_incremental()) == [
+        "raw/a.json",
+        "raw/b.json",
+        "raw/c.json",
+    ]
+    assert rows(table) == 3
+    assert table.insert_incremental() == []
+
+
+def test_schema_command_with_output_options(backend):
+    GlueTable("db", "raw").create(
+        columns=[("id", "string"), ("concert", "struct<venue:string,seats:int>")],
+        location="s3://b/raw/",
+        serde=JSON_SERDE,
+    )
+    ToFlatParquet(
+        database="db",
+        source_table=GlueTable("db", "raw"),
+        target_table=GlueTable("db", "flat"),
+        target_table_location="s3://b/flat/",
+        workgroup="primary",
+        s3_staging_dir="s3://b/staging/",
+        output=OutputOptions(format="orc", bucketed_by=("id",), bucket_count=4),
+    ).refresh_target_table()
+
+    runner = CliRunner()
+    options = ["--format", "orc", "--bucketed-by", "id", "--bucket-count", "4"]
+    result = runner.invoke(app, ["schema", "db", "raw", "flat"] + options)
+    assert result.exit_code == 0, result.output
+    assert "The schema is unchanged." in result.output
+
+    result = runner.invoke(app, ["schema", "db", "raw", "flat"])
+    assert result.exit_code == 1
+    assert "the bucketing changed" in result.output
+    assert "the storage format changed" in result.output
@@ -0,0 +1,51 @@
+import boto3
+import pytest  # noqa
+from flatten.manifest import BloomFilter
+from flatten.manifest import ObjectManifest
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000)
+    for i in range(1000):
+        bloom.add(f"key-{i}")
+    assert all(f"key-{i}" in bloom for i in range(1000))
+    false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+    assert false_positives < 300
+
+    restored = BloomFilter.from_dict(bloom.to_dict())
+    assert "key-1" in restored
+
+
+def test_manifest_diff():
+    manifest = ObjectManifest([("b", "1"), ("a", "1")])
+    assert manifest.keys == ["a", "b"]
+    assert manifest.get("a") == "1"
+    assert manifest.get("c") is None
+    assert manifest.diff([("a", "1"), ("b", "2"), ("c", "1")]) == [
+        ("b", "2"),
+        ("c", "1"),
+    ]
+    manifest.update([("c", "1"), ("b", "2")])
+    assert manifest.diff([("a", "1"), ("b", "2"), ("c", "1")]) == []
+    assert len(manifest) == 3
+
+
+def test_manifest_local_roundtrip(tmp_path):
+    path = str(tmp_path / "manifest.json.gz")
+    assert len(ObjectManifest.load(path)) == 0
+    keys = [(f"data/part-{i:06d}.json", f'"{i}"') for i in range(10000)]
+    ObjectManifest(keys).save(path)
+    manifest = ObjectManifest.load(path)
+    assert manifest.diff(keys) == []
+    assert manifest.get("data/part-000042.json") == '"42"'
+
+
+def test_manifest_s3_roundtrip():
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="bucket")
+        path = "s3://bucket/manifests/flat.json.gz"
+        assert len(ObjectManifest.load(path, client)) == 0
+        ObjectManifest([("a", "1")]).save(path, client)
+        assert ObjectManifest.load(path, client).get("a") == "1"
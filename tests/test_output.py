@@ -0,0 +1,31 @@
+import pytest  # noqa
+from flatten.output import bucket_count_for
+from flatten.output import OutputOptions
+
+
+def test_bucket_count_for():
+    mib = 1024 * 1024
+    assert bucket_count_for(0, 1, 256 * mib, 0.25) == 1
+    assert bucket_count_for(4096 * mib, 1, 256 * mib, 0.25) == 4
+    assert bucket_count_for(4096 * mib, 4, 256 * mib, 0.25) == 1
+    assert bucket_count_for(4097 * mib, 1, 256 * mib, 0.25) == 5
+
+
+def test_output_options_validate():
+    OutputOptions().validate()
+    OutputOptions(format="ORC", compression="zlib").validate()
+    for options in [
+        OutputOptions(format="avro"),
+        OutputOptions(format="orc", compression="GZIP"),
+        OutputOptions(bucket_count=4),
+        OutputOptions(partitioned_by=("dt",), bucketed_by=("dt",)),
+    ]:
+        with pytest.raises(ValueError):
+            options.validate()
+
+
+def test_table_parameters():
+    parameters = OutputOptions(compression="zstd").table_parameters()
+    assert parameters["classification"] == "parquet"
+    assert parameters["parquet.compression"] == "ZSTD"
+    assert OutputOptions(format="orc").table_parameters()["orc.compress"] == "SNAPPY"
@@ -0,0 +1,57 @@
+import pytest  # noqa
+from flatten.projection import ColumnProjection
+
+
+def test_include_and_exclude():
+    projection = ColumnProjection(["payload.device.*", "!payload.device.debug.**"])
+    assert projection.selects(("payload", "device", "id"))
+    assert projection.selects(("Payload", "Device", "os", "version"))
+    assert not projection.selects(("payload", "device", "debug", "trace"))
+    assert not projection.selects(("payload", "user"))
+    assert not projection.selects(("id",))
+
+
+def test_only_excludes_select_the_rest():
+    projection = ColumnProjection(["!payload.debug"])
+    assert projection.selects(("id",))
+    assert projection.selects(("payload", "user", "name"))
+    assert not projection.selects(("payload", "debug", "trace"))
+
+
+def test_last_pattern_wins():
+    projection = ColumnProjection(["!payload.**", "payload.user.name"])
+    assert projection.selects(("payload", "user", "name"))
+    assert not projection.selects(("payload", "user", "id"))
+
+
+@pytest.mark.parametrize(
+    "pattern, path, selected",
+    [
+        ("**.id", ("a", "b", "id"), True),
+        ("**.id", ("id",), True),
+        ("a.**.id", ("a", "id"), True),
+        ("a.**.id", ("a", "x", "y", "id"), True),
+        ("a.**.id", ("b", "x", "id"), False),
+        ("a.dev*", ("a", "device", "x"), True),
+        ("a.dev*", ("a", "user"), False),
+    ],
+)
+def test_patterns(pattern, path, selected):
+    assert ColumnProjection([pattern]).selects(path) == selected
+
+
+def test_prunes():
+    projection = ColumnProjection(["payload.device.*", "!payload.device.debug"])
+    assert not projection.prunes(("payload",))
+    assert not projection.prunes(("payload", "device"))
+    assert projection.prunes(("payload", "user"))
+    assert projection.prunes(("payload", "device", "debug"))
+    assert projection.prunes(("other",))
+    # a later include below an excluded struct keeps it
+    projection = ColumnProjection(["!payload", "payload.**.id"])
+    assert not projection.prunes(("payload", "user"))
+
+
+def test_invalid_pattern():
+    with pytest.raises(ValueError):
+        ColumnProjection(["payload..id"])
@@ -0,0 +1,105 @@
+import boto3
+import pytest  # noqa
+from botocore.stub import Stubber
+from flatten.purge import S3Purger
+
+moto = pytest.importorskip("moto")
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="bucket")
+        for i in range(1100):
+            client.put_object(Bucket="bucket", Key=f"flat/part-{i}.parquet", Body=b"x")
+        client.put_object(Bucket="bucket", Key="flat_other/keep.parquet", Body=b"x")
+        yield client
+
+
+def remaining_keys(client):
+    paginator = client.get_paginator("list_objects_v2")
+    return [
+        obj["Key"]
+        for page in paginator.paginate(Bucket="bucket")
+        for obj in page.get("Contents", [])
+    ]
+
+
+def test_dry_run(s3_client):
+    result = S3Purger(s3_client).purge("bucket", "flat/", dry_run=True)
+    assert result.objects == 1100
+    assert result.size == 1100
+    assert result.dry_run
+    assert len(remaining_keys(s3_client)) == 1101
+
+
+def test_purge(s3_client):
+    result = S3Purger(s3_client, max_workers=2).purge("bucket", "flat/")
+    assert result.objects == 1100
+    assert result.errors == []
+    assert remaining_keys(s3_client) == ["flat_other/keep.parquet"]
+
+
+def test_refuses_empty_prefix(s3_client):
+    with pytest.raises(ValueError):
+        S3Purger(s3_client).purge("bucket", "")
+
+
+def test_retries_slow_down():
+    client = boto3.client("s3", region_name="us-east-1")
+    stubber = Stubber(client)
+    stubber.add_response(
+        "list_objects_v2", {"Contents": [{"Key": "flat/a"}, {"Key": "flat/b"}]}
+    )
+    stubber.add_client_error("delete_objects", "SlowDown")
+    stubber.add_response(
+        "delete_objects",
+        {"Errors": [{"Key": "flat/b", "Code": "SlowDown"}]},
+    )
+    stubber.add_response(
+        "delete_objects",
+        {},
+        {"Bucket": "bucket", "Delete": {"Objects": [{"Key": "flat/b"}], "Quiet": True}},
+    )
+    with stubber:
+        result = S3Purger(client, retry_delay=0).purge("bucket", "flat/")
+    assert result.objects == 2
+    assert result.errors == []
+    stubber.assert_no_pending_responses()
+
+
+def test_keeps_errors_of_earlier_attempts():
+    client = boto3.client("s3", region_name="us-east-1")
+    stubber = Stubber(client)
+    stubber.add_response(
+        "list_objects_v2",
+        {
+            "Contents": [
+                {"Key": "flat/a", "Size": 10},
+                {"Key": "flat/b", "Size": 20},
+                {"Key": "flat/c", "Size": 30},
+            ]
+        },
+    )
+    stubber.add_response(
+        "delete_objects",
+        {
+            "Errors": [
+                {"Key": "flat/a", "Code": "AccessDenied"},
+                {"Key": "flat/b", "Code": "SlowDown"},
+            ]
+        },
+    )
+    stubber.add_response(
+        "delete_objects",
+        {},
+        {"Bucket": "bucket", "Delete": {"Objects": [{"Key": "flat/b"}], "Quiet": True}},
+    )
+    with stubber:
+        result = S3Purger(client, retry_delay=0).purge("bucket", "flat/")
+    assert result.objects == 2
+    assert result.size == 50
+    assert result.errors == [{"Key": "flat/a", "Code": "AccessDenied"}]
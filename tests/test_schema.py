@@ -0,0 +1,89 @@
+import pytest  # noqa
+from flatten.schema import ColumnChange
+from flatten.schema import diff_schema
+
+
+def test_additive_changes():
+    diff = diff_schema(
+        [("id", "int"), ("a_b", "string"), ("old", "string")],
+        [("id", "bigint"), ("a_b", "string"), ("a_c", "double")],
+    )
+    assert diff.compatible
+    assert diff.changes == [
+        ColumnChange("widen", "id", "int", "bigint"),
+        ColumnChange("add", "a_c", new_type="double"),
+        ColumnChange("drop", "old", old_type="string"),
+    ]
+    assert diff.report().splitlines()[1:] == [
+        "~ id int -> bigint",
+        "+ a_c double",
+        "- old string",
+    ]
+
+
+def test_unchanged():
+    diff = diff_schema(
+        [("ID", "array<struct<a:int>>")], [("id", "array<struct<a: int>>")]
+    )
+    assert not diff
+    assert diff.report() == "The schema is unchanged."
+
+
+@pytest.mark.parametrize(
+    "old, new",
+    [
+        ("array<struct<a:int>>", "array<struct<a:bigint,b:string>>"),
+        ("map<string,int>", "map<string,bigint>"),
+        ("varchar(10)", "string"),
+        ("smallint", "bigint"),
+        ("float", "double"),
+    ],
+)
+def test_widening(old, new):
+    assert diff_schema([("c", old)], [("c", new)]).compatible
+
+
+@pytest.mark.parametrize(
+    "old, new",
+    [
+        ("bigint", "int"),
+        ("string", "int"),
+        ("decimal(10,2)", "decimal(10,4)"),
+        ("decimal(10,2)", "decimal(12,2)"),
+        ("int", "double"),
+        ("array<>", "array<int>"),
+        ("array<struct<a:int>>", "array<>"),
+        ("array<struct<a:int,b:string>>", "array<struct<a:int>>"),
+        ("array<int>", "map<string,int>"),
+    ],
+)
+def test_incompatible(old, new):
+    diff = diff_schema([("c", old)], [("c", new)])
+    assert not diff.compatible
+    assert diff.changes[0].kind == "incompatible"
+    assert "incompatible" in diff.report()
+
+
+def test_partition_key_collision():
+    diff = diff_schema(
+        [("a", "int")],
+        [("a", "int"), ("dt", "string")],
+        partition_keys=[("dt", "string")],
+    )
+    assert not diff.compatible
+    assert diff.changes[0].reason == "collides with a partition key"
+
+
+def test_by_index():
+    current = [("a", "int"), ("b", "string")]
+    diff = diff_schema(current, current + [("c", "int")], by_index=True)
+    assert diff.compatible
+    for desired in (
+        [("a", "int")],
+        [("a", "bigint"), ("b", "string")],
+        [("c", "int"), ("a", "int"), ("b", "string")],
+        [("b", "string"), ("a", "int")],
+    ):
+        diff = diff_schema(current, desired, by_index=True)
+        assert not diff.compatible
+        assert diff.changes[-1].reason == "columns are read by index"
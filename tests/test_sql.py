@@ -0,0 +1,97 @@
+import io
+import json
+import os
+from pathlib import Path
+
+import pytest  # noqa
+from flatten.aws import GlueTable
+from flatten.aws import query_gen
+from flatten.aws import ToFlatParquet
+from flatten.output import OutputOptions
+from flatten.sql import compiled_template
+from flatten.sql import format_sql
+from flatten.sql import write_sql
+
+
+def flat_table(output=None) -> ToFlatParquet:
+    with open(Path(Path(__file__).parent.absolute(), "glue_table.json")) as f:
+        table_metadata = json.load(f)
+    test_table = GlueTable("test", "test", metadata=table_metadata)
+    return ToFlatParquet(
+        database="test",
+        source_table=test_table,
+        target_table=test_table,
+        target_table_location="s3://b/flat/",
+        workgroup="test",
+        s3_staging_dir="test",
+        output=output,
+    )
+
+
+@pytest.mark.parametrize(
+    "output",
+    [
+        OutputOptions(),
+        OutputOptions(format="orc", compression="zlib", partitioned_by=("season",)),
+        OutputOptions(bucketed_by=("id",), bucket_count=4),
+    ],
+)
+def test_built_sql_matches_formatted_template(output):
+    table = flat_table(output)
+    temp_table = GlueTable("test", "tmp")
+    for where in (None, "\"dt\" = '1'"):
+        assert table.generate_insert_overwrite_query(
+            temp_table, where=where
+        ) == table.generate_insert_overwrite_query(temp_table, where=where, pretty=True)
+        assert table.generate_insert_into_query(
+            where
+        ) == table.generate_insert_into_query(where, pretty=True)
+
+
+def test_built_sql_multiple_partition_keys():
+    table = flat_table(
+        OutputOptions(partitioned_by=("season", "orchestra"), bucketed_by=("id",))
+    )
+    sql = table.generate_insert_overwrite_query(GlueTable("test", "tmp"))
+    pretty = table.generate_insert_overwrite_query(
+        GlueTable("test", "tmp"), pretty=True
+    )
+    # sqlparse breaks the arrays into lines, the tokens are the same
+    assert "".join(sql.split()) == "".join(pretty.split())
+    assert "partitioned_by = ARRAY['season', 'orchestra']) as\nselect id as id\n" in sql
+
+
+def test_format_sql_size_limit():
+    sql = "select a, b from t"
+    assert format_sql(sql) == "select a\n     , b\nfrom t"
+    assert format_sql(sql, max_bytes=10) == sql
+    assert format_sql(sql, max_bytes=None) == "select a\n     , b\nfrom t"
+
+
+def test_query_gen_compiles_templates_once(tmp_path):
+    template = str(tmp_path / "query.sql")
+    with open(template, "w") as f:
+        f.write("SELECT {{column}} FROM t")
+    compiled_template.cache_clear()
+    assert query_gen(template, {"column": "a"}) == "select a\nfrom t"
+    assert query_gen(template, {"column": "b"}, pretty=False) == "SELECT b FROM t"
+    assert compiled_template.cache_info().misses == 1
+    assert compiled_template.cache_info().hits == 1
+
+    with open(template, "w") as f:
+        f.write("SELECT {{column}} FROM u")
+    os.utime(template, (0, 0))
+    assert query_gen(template, {"column": "a"}, pretty=False) == "SELECT a FROM u"
+
+
+def test_write_sql_streams_statement(tmp_path):
+    table = flat_table()
+    lines = table.insert_into_statement("\"dt\" = '1'")
+    output = io.StringIO()
+    write_sql(lines, output)
+    assert output.getvalue() == table.generate_insert_into_query("\"dt\" = '1'") + ";\n"
+
+    path = str(tmp_path / "plan.sql")
+    write_sql(table.insert_overwrite_statement(GlueTable("test", "tmp")), path)
+    with open(path) as f:
+        assert f.read().startswith('create table "test"."tmp" with (')
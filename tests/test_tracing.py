@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+from pathlib import Path
+
+import pytest  # noqa
+from flatten.aws import GlueTable
+from flatten.aws import ToFlatParquet
+from flatten.cli import tracing
+from flatten.tracing import annotate
+from flatten.tracing import disable_tracing
+from flatten.tracing import enable_tracing
+from flatten.tracing import span
+from flatten.tracing import traced
+from flatten.tracing import tracer
+
+
+@pytest.fixture
+def active_tracer():
+    active = enable_tracing()
+    yield active
+    disable_tracing()
+
+
+def test_span_without_tracer():
+    disable_tracing()
+    with span("phase") as current:
+        assert current is None
+    annotate(ignored=True)
+
+
+def test_nested_spans(active_tracer):
+    @traced("inner")
+    def inner():
+        annotate(rows=3)
+
+    with span("outer", table="t"):
+        inner()
+        thread = threading.Thread(target=inner)
+        thread.start()
+        thread.join()
+    with pytest.raises(KeyError):
+        with span("failing"):
+            raise KeyError("x")
+
+    spans = {
+        (span["name"], span["thread"]): span
+        for span in active_tracer.to_json()["spans"]
+    }
+    outer = spans["outer", threading.get_ident()]
+    nested = spans["inner", threading.get_ident()]
+    assert outer["attributes"] == {"table": "t"}
+    assert nested["parent"] == outer["id"]
+    assert nested["attributes"] == {"rows": 3}
+    assert nested["duration_ms"] <= outer["duration_ms"]
+    other = [
+        s for (name, thread), s in spans.items() if name == "inner" and s is not nested
+    ]
+    assert other[0]["parent"] is None
+    assert spans["failing", threading.get_ident()]["attributes"] == {
+        "error": "KeyError"
+    }
+
+
+def test_record_and_chrome_trace(active_tracer, tmp_path):
+    start = time.perf_counter_ns()
+    with span("run") as parent:
+        pass
+    active_tracer.record("athena.query", start, parent, query_id="q1")
+    path = str(tmp_path / "trace.json")
+    active_tracer.save(path)
+    with open(path) as f:
+        events = json.load(f)["traceEvents"]
+    assert [event["name"] for event in events] == ["athena.query", "run"]
+    assert events[0]["ph"] == "X"
+    assert events[0]["args"] == {"query_id": "q1"}
+    assert events[0]["dur"] >= events[1]["dur"]
+    with pytest.raises(ValueError):
+        active_tracer.save(path, format="xml")
+
+
+def test_profile(tmp_path):
+    with tracing(None, "chrome", True, str(tmp_path)):
+        with span("parse", cpu=True):
+            assert len(sorted(str(i) for i in range(10000))) == 10000
+    assert tracer() is None
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "cpu.pstats",
+        "cpu.txt",
+        "memory.txt",
+    ]
+    assert "function calls" in (tmp_path / "cpu.txt").read_text()
+    assert (tmp_path / "memory.txt").read_text().startswith("current ")
+
+
+def test_flatten_phases_are_traced(active_tracer):
+    with open(Path(Path(__file__).parent.absolute(), "glue_table.json")) as f:
+        table_metadata = json.load(f)
+    table = GlueTable("test", "traced", metadata=table_metadata)
+    flat_table = ToFlatParquet(
+        database="test",
+        source_table=table,
+        target_table=table,
+        target_table_location="test",
+        workgroup="test",
+        s3_staging_dir="test",
+    )
+    flat_table.generate_insert_overwrite_query(table, "s3://bucket/flat/")
+    names = [span["name"] for span in active_tracer.to_json()["spans"]]
+    assert "flat_mapping" in names
+    assert "query_gen" in names
@@ -0,0 +1,43 @@
+import random
+
+import pytest  # noqa
+from flatten.utils import column_query_path_format
+from flatten.utils import flatten_dict
+from flatten.utils import flatten_struct
+
+
+def random_struct(rng, depth=0):
+    names = ["a", "Ab", "c d", "_e", "f-", "Ü", "g.h", "-", "id", "ID2"]
+    struct = {}
+    for _ in range(rng.randint(0, 4)):
+        name = rng.choice(names) + str(rng.randint(0, 3))
+        if depth < 5 and rng.random() < 0.3:
+            struct[name] = random_struct(rng, depth + 1)
+        else:
+            struct[name] = rng.choice(["string", ["int"], "decimal(1,2)"])
+    return struct
+
+
+def test_flatten_struct_matches_flatten_dict():
+    rng = random.Random(7)
+    for _ in range(200):
+        struct = random_struct(rng)
+        source_columns = flatten_dict(
+            {"col": struct}, format_func=column_query_path_format
+        )
+        target_columns = flatten_dict({"col": struct})
+        expected = [
+            (source, target, type_)
+            for source, (target, type_) in zip(source_columns, target_columns.items())
+        ]
+        assert list(flatten_struct("col", struct)) == expected
+
+
+def test_flatten_struct_deep():
+    struct = "string"
+    for i in range(3000):
+        struct = {f"l{i}": struct}
+    ((source, target, type_),) = flatten_struct("col", struct)
+    assert source.count(".") == 3000
+    assert target.startswith("col_l2999_l2998")
+    assert type_ == "string"
@@ -0,0 +1,138 @@
+import json
+from pathlib import Path
+
+import pytest  # noqa
+from flatten.aws import GlueColumnMapping
+from flatten.aws import GlueTable
+from flatten.aws import ToFlatParquet
+from flatten.vertical import split_mapping
+from flatten.vertical import VerticalSplit
+
+
+def wide_mapping(n):
+    return [GlueColumnMapping("id", "id", "string")] + [
+        GlueColumnMapping(f'"payload"."f{i}"', f"payload_f{i}", "int") for i in range(n)
+    ]
+
+
+def test_split_by_column_count():
+    parts = split_mapping(wide_mapping(10), ["ID"], max_columns=4)
+    assert [len(part) for part in parts] == [4, 4, 4, 2]
+    assert all(part[0].target_name == "id" for part in parts)
+    assert [col.target_name for part in parts for col in part[1:]] == [
+        f"payload_f{i}" for i in range(10)
+    ]
+
+
+def test_split_by_sql_size():
+    parts = split_mapping(wide_mapping(100), ["id"], max_sql_bytes=500)
+    assert len(parts) > 1
+    assert all(
+        sum(len(c.source_name) + len(c.target_name) + 12 for c in part) <= 500
+        for part in parts
+    )
+
+
+def test_split_needs_row_key():
+    with pytest.raises(ValueError):
+        split_mapping(wide_mapping(10), ["missing"])
+
+
+def split_table():
+    with open(Path(Path(__file__).parent.absolute(), "glue_table.json")) as f:
+        table_metadata = json.load(f)
+    table_metadata["PartitionKeys"] = [{"Name": "dt", "Type": "string"}]
+    flat_table = ToFlatParquet(
+        database="test",
+        source_table=GlueTable("test", "raw", metadata=table_metadata),
+        target_table=GlueTable("test", "flat"),
+        target_table_location="s3://bucket/flat/",
+        workgroup="test",
+        s3_staging_dir="test",
+    )
+    return VerticalSplit(flat_table, ["id"], max_columns=6, concurrency=2)
+
+
+def test_vertical_split_parts():
+    split = split_table()
+    parts = split.parts()
+    assert [part.target_table.table_name for part in parts] == [
+        "flat_part00",
+        "flat_part01",
+        "flat_part02",
+    ]
+    assert parts[1].target_table_location == "s3://bucket/flat/part_01/"
+    sql = " ".join(
+        parts[1]
+        .generate_insert_overwrite_query(
+            parts[1].target_table, parts[1].target_table_location
+        )
+        .split()
+    )
+    assert sql.startswith(
+        'create table "test"."flat_part01" with (external_location = \'s3://bucket/flat/part_01/\''
+    )
+    assert 'select id as id , "concert"."Venue" as concert_venue' in sql
+    assert split.join_view_query(parts[:2]) == (
+        'create or replace view "test"."flat" as select * from "test"."flat_part00" '
+        'join "test"."flat_part01" using ("id", "dt")'
+    )
+
+
+def test_vertical_split_run(monkeypatch):
+    split = split_table()
+    executed = []
+    monkeypatch.setattr(split.flat_table.conn, "execute", executed.append)
+    validated = []
+    monkeypatch.setattr(split, "validate_row_key", validated.append)
+    flattened = []
+    parts = split.run(lambda part: flattened.append(part.target_table.table_name))
+    assert sorted(flattened) == [part.target_table.table_name for part in parts]
+    assert validated == parts[:1]
+    assert executed == [split.join_view_query(parts)]
+
+
+def test_vertical_split_parts_are_separate_tables():
+    split = split_table()
+    split.flat_table.gc_thread = object()
+    parts = split.parts()
+    assert len({id(part.conn) for part in parts + [split.flat_table]}) == 4
+    assert all(part.gc_thread is None for part in parts)
+    assert all(part.output is split.flat_table.output for part in parts)
+
+
+class FakeCursor:
+    def __init__(self, row):
+        self.row = row
+
+    def fetchone(self):
+        return self.row
+
+
+@pytest.mark.parametrize(
+    "row, valid", [((0, 0), True), ((2, 0), False), ((0, 1), False)]
+)
+def test_validate_row_key(monkeypatch, row, valid):
+    split = split_table()
+    part = split.parts()[0]
+    queries = []
+
+    def query(sql):
+        queries.append(sql)
+        return FakeCursor(row)
+
+    monkeypatch.setattr(part.conn, "query", query)
+    if valid:
+        split.validate_row_key(part)
+    else:
+        with pytest.raises(ValueError, match="drop or multiply rows"):
+            split.validate_row_key(part)
+    assert 'from "test"."flat_part00" group by "id", "dt")' in queries[0]
+
+
+def test_vertical_split_not_needed():
+    split = split_table()
+    split.max_columns = 100
+    flattened = []
+    assert split.run(flattened.append) == [split.flat_table]
+    assert flattened == [split.flat_table]